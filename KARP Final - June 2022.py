@@ -12,26 +12,23 @@ Created on Thu Jun 10 16:56:39 2021
 """ Modification of Jack Barraclough's (jack@razorbillinstruments.com) app. """
 
 
+""" The instrument, acquisition and recording back end lives in karp_engine.py, this file is the Tk front end. """
+
+
 """"NOTE: Safety checks have been turned off for voltage between -210V and 210V"""
 
-import serial.tools.list_ports as list_ports
-import serial
+import time
+_started = time.perf_counter()
 from tkinter import *
 import tkinter.simpledialog
-from enum import Enum
-import time
-import datetime
 import os
+import sys
 import numpy as np
-import matplotlib.pyplot as plt
-import csv
-from itertools import count
-import matplotlib.animation as animation
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from tkinter import ttk
-import pyvisa
-
-rm = pyvisa.ResourceManager()
+from karp_engine import (KarpEngine, SerialStates, USBStates, PortEvents, RECORD_FORMATS,
+                         HDF5_AVAILABLE, profiler, write_aligned,
+                         TargetReached, KeysightStable, parse_targets, DeadbandFilter, DEADBAND_DEFAULTS, LogBuffer, StartupTimer)
+""" matplotlib and its Tk backend are imported by MainGui.build_plot, once the window is already on screen """
 
 
 """Changes working directory to the folder of the script.
@@ -70,20 +67,17 @@ class ScpiProperty:
         """ Get a property's value from the instrument, and update the GUI to reflect it"""
         """ if statement is for RP100, elif is for Keysight, else is for anything else"""
         if type(self.command) == bytes:
-            self.ser.write(self.command + b"?\n")
-            resp = self.ser.read()
+            resp = self.ser.query(self.command + b"?\n")
             self.value.set(self.scpi2human(resp))
         elif self.command == ":FETCh:IMPedance:FORMatted?":
-            perfTime2=time.time()
-            self.ser.write(self.command)
-            resp = self.ser.read().strip("\n").strip().split(",")
-            for i in range(len(resp)):
-                self.value[i].set(float(resp[i]))
-            print(time.time()-perfTime2)
+            resp = self.ser.query(self.command)
+            if resp:
+                resp = resp.strip("\n").strip().split(",")
+                for i in range(len(resp)):
+                    self.value[i].set(float(resp[i]))
                 
         else:
-            self.ser.write(self.command)
-            resp = self.ser.read()
+            resp = self.ser.query(self.command)
             self.value.set(resp)
 
     def scpi_set(self):
@@ -281,348 +275,445 @@ class ScpiErrorReporter(ScpiProperty):
             return scpi_bytes.decode().strip()
 
 
-class SerialStates(Enum):
-    UNCONFIGURED = 1
-    CONNECTED = 2
-    DROPPED = 3
-    
-class USBStates(Enum):
-    UNCONFIGURED = 1
-    CONNECTED = 2
-    DROPPED = 3
+class RingBuffer:
+    """
+    A preallocated (capacity, width) float64 buffer for the live plot. Appending is O(1) and once the buffer is full
+    each new row overwrites the oldest, so plotting cost stays flat however long the run is.
+    """
+    def __init__(self, capacity, width=2):
+        self.capacity = int(capacity)
+        self._data = np.zeros((self.capacity, width))
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, row):
+        self._data[self._next] = row
+        self._next = (self._next + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
 
+    def clear(self):
+        self._next = 0
+        self._count = 0
 
-class MonitoredSerial:
-    """ 
-    A class for serial connections, with some extra wrappers to release the port if the device is unplugged
-    or dropped, and grab it again when it reappears. Call update() about once every millisecond. 
+    """ Zero-copy view of the stored rows. Once the buffer has wrapped they are not in time order, which does not
+    matter for a scatter plot; use ordered() when it does"""
+    def view(self):
+        return self._data[:self._count]
+
+    def ordered(self):
+        if self._count < self.capacity:
+            return self._data[:self._count]
+        return np.roll(self._data, -self._next, axis=0)
+
+
+class MinMaxDecimator:
     """
-    def __init__(self, printer=None, print_io=False, print_conn=False):
-        self._pid = None
-        self._vid = None
-        self._serial_number = None
-        self._port = None
-        self._printer = printer
-        self._print_io = print_io
-        self._print_conn = print_conn
-        self.state = SerialStates.UNCONFIGURED
-        self.needs_reset = False
-
-    """ Used in choose_serial_port, takes the result of PortChooser as port_info, and attempts to open a serial connection"""
-    def connect(self, port_info):
-        try:
-            self._port = serial.Serial(port_info.device, timeout=0.1)
-        except Exception as e:
-            if self._printer is not None:
-                self._printer("Failed to open serial port: " + str(e))
-        else:
-            if not self._port.is_open:
-                self._port.open()
-            if self._print_conn:
-                self._printer("Opened serial port: " + port_info.description)
-            self._serial_number = port_info.serial_number
-            self._pid = port_info.pid
-            self._vid = port_info.vid
-            self.state = SerialStates.CONNECTED
-
-    """ Checks if the RP100 is still there"""
-    def update(self):
-        ports = list_ports.comports()
-        if self._port is not None:
-            if (self._port.name in (i.device for i in ports)) and not self.needs_reset:
-                # All is OK, the port is still there
-                self.state = SerialStates.CONNECTED
-                return False
-            else:
-                # Our port has vanished, or needs_reset has been set by something else
-                self._port.close()
-                self._port = None
-                if self._print_conn:
-                    self._printer("Lost connection to serial port")
-                self.state = SerialStates.DROPPED
-                time.sleep(0.05)
-                return True
-        else:
-            if self._serial_number is not None:
-                # Our port is missing. Look for it
-                for port in ports:
-                    if port.serial_number == self._serial_number and port.vid == self._vid and port.pid == self._pid:
-                        try:
-                            self._port = serial.Serial(port.device, timeout=0.1)
-                            if not self._port.is_open:
-                                self._port.open()
-                            if self._print_conn:
-                                self._printer("Reopened serial port " + port.device)
-                            self.state = SerialStates.CONNECTED
-                            return True
-                        except:
-                            if self._printer is not None:
-                                self._printer("Failed to reopen serial port")
-                                time.sleep(0.1)
-            else:
-                # Not configured, so no change.
-                return False
-
-    """ Back-end command for disconnecting the RP100"""
-    def disconnect(self):
-        if self._print_conn:
-            self._printer("Manually disconnected RP100 from serial port")
-        self._port.close()
-        self._pid = None
-        self._vid = None
-        self._serial_number = None
-        self._port = None
-        self.state = SerialStates.UNCONFIGURED
-
-    """ Reads from the RP100 using readline(), otherwise prints errors to the printer"""
-    def read(self):
-        if self.state != SerialStates.CONNECTED:
-            return None
-        else:
-            try:
-                resp = self._port.readline()
-                if self._print_io:
-                    if resp.decode().strip() == "":
-                        self._printer("Timeout or empty line on serial read")
-            except Exception as e:
-                resp = b""
-                if self._print_io:
-                    self._printer("IO Error on Serial Read: " + str(e))
-                self.needs_reset = True
-            return resp
-
-    """ Writes to the RP100 using write(), otherwise prints errors to the printer"""
-    def write(self, message):
-        if self.state != SerialStates.CONNECTED:
-            pass
-        else:
-            try:
-                self._port.write(message)
-            except Exception as e:
-                if self._print_io:
-                    self._printer("IO Error on Serial Write: " + str(e))
-                self.needs_reset = True
-
-class MonitoredUSB:
-    """ 
-    A class for USB connections, with some extra wrappers to release the port if the device is unplugged
-    or dropped, and grab it again when it reappears. Call update() about once every millisecond. 
+    Reduces a long (x, y) series to roughly one point per pixel column for the live plot. The x range on screen is
+    split into `buckets` columns and only the lowest and highest point of each column is drawn, so peaks and both
+    branches of a hysteresis loop survive. Every sample is also kept at full resolution; new samples update their
+    column in O(1), and a change of view (zoom, time axis moving on) re-decimates from the full-resolution store.
     """
-    def __init__(self, printer=None, print_io=False, print_conn=False):
-        self._alias = None
-        self._name = None
-        self._serial_number = None
-        self._port = None
-        self._printer = printer
-        self._print_io = print_io
-        self._print_conn = print_conn
-        self.state = USBStates.UNCONFIGURED
-        self.needs_reset = False
-        self.usb_ports = []
-
-    """ Used in choose_usb_port, takes the result of PortChooser as port_info, and attempts to open a USB connection"""
-    def connect(self, port_info):
-        try:
-            self._port = rm.open_resource(port_info)
-            try: self._port = rm.open_resource(self._port.resource_info.alias)
-            except: pass
-        except Exception as e:
-            if self._printer is not None:
-                self._printer("Failed to open serial port: " + str(e))
-        else:
-            if self._print_conn:
-                self._printer("Opened port: " + self._port.resource_info.alias)
-            self._alias = self._port.resource_info.alias
-            self._name = self._port.resource_info.resource_name
-            self._serial_number = self._name.split("::")[3]
-            self.state = USBStates.CONNECTED
-            
+    def __init__(self, buckets=800, initial_capacity=4096):
+        self.buckets = buckets
+        self._x = np.empty(initial_capacity)
+        self._y = np.empty(initial_capacity)
+        self._count = 0
+        self._monotonic = True
+        self._limits = None
+        self._min = None
+        self._max = None
+        self._stale = True
 
-    """ Checks if the Keysight is still there """
-    def update(self):
-        self.usb_ports = []
-        self.resources = rm.list_resources()
-        for i in range(len(self.resources)):
-            if str(self.resources[i])[0:3] == "USB":
-                self.usb_ports.append(self.resources[i])
-        if self._port is not None:
-            if (self._serial_number in (rm.open_resource(i).resource_info.resource_name.split("::")[3] for i in self.usb_ports)) and not self.needs_reset:
-                # All is OK, the port is still there
-                self.state = USBStates.CONNECTED
-                return False
-            else:
-                # Our port has vanished, or needs_reset has been set by something else
-                self._port = None
-                if self._print_conn:
-                    self._printer("Lost connection to USB port")
-                self.state = USBStates.DROPPED
-                self.MainGui.status_box2.configure(background='red')
-                time.sleep(0.05)
-                return True
-        else:
-            if self._serial_number is not None:
-                # Our port is missing. Look for it
-                for port in self.usb_ports:
-                    try:
-                        portcheck = rm.open_resource(port)
-                    except: pass
-                    else:
-                        namesplit=portcheck.resource_info.resource_name.split("::")
-                        if namesplit[3] == self._serial_number:
-                            self._printer("Reopened port " + str(namesplit[0]))
-                            self.state = USBStates.CONNECTED
-                            return True
-                if self._printer is not None:
-                    self._printer("Failed to find USB port")
-                    time.sleep(0.1)
-            else:
-                # Not configured, so no change.
-                return False
-
-    """ Back-end command for disconnecting the Keysight"""
-    def disconnect(self):
-        if self._print_conn:
-            self._printer("Manually disconnected Keysight from USB port")
-        self._serial_number = None
-        self._port = None
-        self._alias = None
-        self._name = None
-        self.state = USBStates.UNCONFIGURED
-        
-    
-    """ Reads from the Keysight using read(), otherwise prints errors to the printer"""
-    def read(self):
-        if self.state != USBStates.CONNECTED:
-            return None
-        else:
-            try:
-                resp = self._port.read()
-                if self._print_io:
-                    if resp == "":
-                        self._printer("Timeout or empty line on read")
-            except Exception as e:
-                resp = ""
-                if self._print_io:
-                    self._printer("IO Error on USB Read: " + str(e))
-                self.needs_reset = True
-            return resp
-    
-    """ Writes to the Keysight using write(), otherwise prints errors to the printer"""
-    def write(self, message):
-        if self.state != USBStates.CONNECTED:
-            pass
+    def __len__(self):
+        return self._count
+
+    def clear(self):
+        self._count = 0
+        self._monotonic = True
+        self._stale = True
+
+    def append(self, x, y):
+        if self._count == len(self._x):
+            self._x = np.resize(self._x, 2 * len(self._x))
+            self._y = np.resize(self._y, 2 * len(self._y))
+        if self._count > 0 and x < self._x[self._count - 1]:
+            self._monotonic = False
+        self._x[self._count] = x
+        self._y[self._count] = y
+        self._count += 1
+        if not self._stale:
+            self._add(x, y)
+
+    """ Tells the decimator what is on screen: the x limits and how many pixel columns they span"""
+    def set_view(self, xlim, buckets=None):
+        xlim = (float(min(xlim)), float(max(xlim)))
+        buckets = max(1, int(buckets or self.buckets))
+        if xlim != self._limits or buckets != self.buckets:
+            self._limits = xlim
+            self.buckets = buckets
+            self._stale = True
+
+    def _bucket(self, x):
+        x0, x1 = self._limits
+        return np.minimum(((x - x0) / (x1 - x0) * self.buckets).astype(int), self.buckets - 1)
+
+    def _add(self, x, y):
+        x0, x1 = self._limits
+        if not x0 <= x <= x1 or x1 == x0 or y != y:
+            return
+        b = int(self._bucket(np.float64(x)))
+        # an empty column holds NaN, which fails both comparisons
+        if not self._min[b, 1] <= y:
+            self._min[b] = (x, y)
+        if not self._max[b, 1] >= y:
+            self._max[b] = (x, y)
+
+    def _rebuild(self):
+        self._min = np.full((self.buckets, 2), np.nan)
+        self._max = np.full((self.buckets, 2), np.nan)
+        self._stale = False
+        if self._limits is None or self._limits[0] == self._limits[1]:
+            return
+        x = self._x[:self._count]
+        y = self._y[:self._count]
+        if self._monotonic:
+            # time on the x axis: only the samples in view need looking at
+            lo = np.searchsorted(x, self._limits[0])
+            hi = np.searchsorted(x, self._limits[1], side="right")
+            x = x[lo:hi]
+            y = y[lo:hi]
+        keep = (x >= self._limits[0]) & (x <= self._limits[1]) & ~np.isnan(y)
+        if not keep.any():
+            return
+        x = x[keep]
+        y = y[keep]
+        b = self._bucket(x)
+        order = np.lexsort((y, b))
+        b = b[order]
+        first = np.flatnonzero(np.r_[True, b[1:] != b[:-1]])
+        last = np.r_[first[1:] - 1, len(b) - 1]
+        self._min[b[first]] = np.c_[x[order[first]], y[order[first]]]
+        self._max[b[last]] = np.c_[x[order[last]], y[order[last]]]
+
+    """ The decimated points for the current view, at most two per pixel column"""
+    def points(self):
+        if self._stale:
+            self._rebuild()
+        points = np.concatenate((self._min, self._max))
+        return points[~np.isnan(points[:, 0])]
+
+
+class BlitRenderer:
+    """
+    Draws the live plot with blitting. The static parts of the figure (axes, grid, ticks, labels) are rendered into
+    a cached background only when the axis limits change or the canvas is redrawn for another reason (resize...);
+    every other frame just restores that background and redraws the animated artists. Frames are capped at
+    max_fps, samples arriving in between simply accumulate in the artists' data until the next frame.
+    """
+    def __init__(self, canvas, ax, artists, max_fps=25):
+        self.canvas = canvas
+        self.ax = ax
+        self.artists = artists
+        self.max_fps = max_fps
+        self._background = None
+        self._limits = None
+        self._last_frame = 0
+        self._dirty = True
+        for artist in self.artists:
+            artist.set_animated(True)
+        self.canvas.mpl_connect("draw_event", self._on_draw)
+
+    """ Any full draw (ours, a resize, startrecord's) re-caches the background and puts the artists back on top"""
+    def _on_draw(self, event):
+        self._background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self._limits = (self.ax.get_xlim(), self.ax.get_ylim())
+        self._draw_artists()
+
+    def _draw_artists(self):
+        for artist in self.artists:
+            self.ax.draw_artist(artist)
+
+    """ Flags that the artists have new data. Cheap, call as often as you like"""
+    def mark_dirty(self):
+        self._dirty = True
+
+    """ Draws a frame if there is something new and the frame budget allows it. Returns True if it drew"""
+    def frame(self):
+        now = time.perf_counter()
+        if not self._dirty or now - self._last_frame < 1.0 / self.max_fps:
+            return False
+        self._last_frame = now
+        self._dirty = False
+        if self._background is None or (self.ax.get_xlim(), self.ax.get_ylim()) != self._limits:
+            self.canvas.draw()
         else:
-            try:
-                
-                self._port.write(message)
-            except Exception as e:
-                if self._print_io:
-                    self._printer("IO Error on USB Write: " + str(e))
-                self.needs_reset = True
+            self.canvas.restore_region(self._background)
+            self._draw_artists()
+            self.canvas.blit(self.ax.bbox)
+        return True
+
+
+
     
 class MainGui:
-    """Main class"""
-    def __init__(self):
-        self.serial_port = MonitoredSerial(printer=self.printer, print_conn=True, print_io=True)
-        self.usb_port = MonitoredUSB(printer=self.printer, print_conn=True, print_io=True)
+    """Main class. Station 0's RP100 and E4980AL get the full control panels, further stations (see
+    PropertyRegistry) a connection row each; all of them are recorded and can be plotted"""
+    def __init__(self, stations=1, log_path=None, startup=None):
+        self.startup = startup if startup is not None else StartupTimer()
+        self.log = LogBuffer(path=log_path)
+        self.log_flush_interval = 0.25 # s between batched inserts into the log widget
+        self._log_flushed = 0
+        self.engine = KarpEngine(printer=self.printer, print_conn=True, print_io=True, stations=stations)
+        self.startup.mark("engine")
+        self.registry = self.engine.registry
+        self.port_watcher = self.engine.port_watcher
+        self.serial_port = self.engine.serial_port
+        self.usb_port = self.engine.usb_port
         self.win = None
         self.log_text = None
         self.recording = False
+        self.resume_session = None # an interrupted RecordingSession the next recording carries on
         self.isPlotOn = False
         self.indvar = None
         self.depvar = None
         self.counter = 0
         self._scpi_properties = []
-        self.data = []
+        self._widgets = {} # (instrument, command): the ScpiProperty showing it
+        self._rp100_properties = []
+        self._keysight_properties = []
+        self._station_boxes = {} # instrument name: its status and *IDN? labels, for stations after the first
+        self.plot_variables = self.registry.plot_variables()
+        self.plot_columns = [self.engine.labels.index(label) for label, _, _ in self.plot_variables]
+        self._value_columns = [] # store columns shown in a reading label, and the labels' variables
+        self._value_vars = []
+        self._shown_values = None
+        self._shown_generation = -1
+        self.plot_capacity = None
+        self.display_interval = 20 # ms between GUI refreshes, independent of the acquisition rate
+        self.max_fps = 25 # cap on live plot redraws per second
+        self.diagnostics_text = None
+        self.diagnostics_interval = 1.0 # s between diagnostics panel refreshes while profiling
+        self._diagnostics_shown = 0
+        self.statistics = None # the engine's ColumnStatistics shown in the statistics panel
+        self.stats_text = None
+        self.stats_interval = 1.0 # s between statistics panel refreshes
+        self._stats_shown = 0
+        self.plotframe = None
+        self.fig = None
+        self.renderer = None
 
         self.build_main_window()
+        rp100, keysight = self.registry.names(0)
+        for prop in self.registry.polled(rp100):
+            self._value_columns.append(self.engine.labels.index(prop.label))
+            self._value_vars.append(self._widgets[(rp100, prop.command)].value)
+        for prop in self.registry.polled(keysight):
+            self._value_columns.append(self.engine.labels.index(prop.label))
+            self._value_vars.append(self._widgets[(keysight, prop.command)].value[prop.index])
+        self._value_columns = np.array(self._value_columns, dtype=int)
+        self._shown_values = np.full(len(self._value_columns), np.nan)
+        profiler.attach(self, "animate", "gui.animate")
+        profiler.attach(self, "main_task", "gui.main_task")
+        profiler.attach(self, "flush_printer", "gui.flush_printer")
+        profiler.attach(self, "show_statistics", "gui.show_statistics")
+        for prop in self._scpi_properties:
+            profiler.attach(prop, "scpi_get", "gui.scpi_get")
         self.start()
 
-    """ Prints a message to the printer"""
+    """ Prints a message to the printer. Safe to call from any thread, the text is inserted by main_task"""
     def printer(self, message):
+        self.log(message)
+
+    """ Inserts the new log lines in one batch, at most every log_flush_interval, and trims the widget to the
+    log's capacity"""
+    def flush_printer(self):
+        if time.monotonic() - self._log_flushed < self.log_flush_interval:
+            return
+        self._log_flushed = time.monotonic()
+        lines = self.log.drain()
+        if not lines:
+            return
         self.log_text.config(state="normal")
-        self.log_text.insert(END, message + '\n')
+        self.log_text.insert(END, "\n".join(lines) + "\n")
+        excess = int(self.log_text.index("end-1c").split(".")[0]) - 1 - self.log.capacity
+        if excess > 0:
+            self.log_text.delete("1.0", str(excess + 1) + ".0")
         self.log_text.config(state="disabled")
 
-    """ Starts the program and begins the main_task loop"""
+    """ Shows the window, builds the plot, starts the acquisition thread and the program, and begins the main_task
+    loop"""
     def start(self):
+        self.win.update()
+        self.startup.mark("window")
+        self.build_plot()
+        self.startup.mark("plot")
+        self.engine.start()
         self.win.after(1, self.main_task)
         self.win.mainloop()
+        self.engine.close()
+        self.log.close()
+
+    """ Offers to carry on recording into the latest session a crash left behind. The other sessions, and that one
+    if declined, are saved as they are, as "<start date and time> recovered" """
+    def offer_resume(self):
+        sessions = self.engine.interrupted_sessions()
+        resume = None
+        if sessions and sessions[-1].labels == self.engine.labels and (sessions[-1].record_format != "HDF5" or HDF5_AVAILABLE):
+            MsgBox = messagebox.askquestion("Resume Recording?","KARP stopped while recording (the recording started " + str(sessions[-1].attrs.get("start_time")) + "). Would you like the next recording to carry on in the same file? Otherwise the data collected so far is saved as it is.",icon="question")
+            if MsgBox == 'yes':
+                resume = sessions[-1]
+                self.formatcombo.set(resume.record_format)
+                self.printer("Start Recording carries on the interrupted recording")
+        self.engine.recover_sessions(keep=resume)
+        self.resume_session = resume
+
+    """ Shows the newest readings in the property widgets, straight from the engine's value store. Only labels whose
+    value changed since the last refresh are touched, and nothing at all when the store has not been written"""
+    def show_values(self):
+        store = self.engine.values
+        if store.generation == self._shown_generation:
+            return
+        self._shown_generation = store.generation
+        values = store.values[self._value_columns]
+        changed = (values != self._shown_values) & ~(np.isnan(values) & np.isnan(self._shown_values))
+        for i in np.flatnonzero(changed):
+            self._value_vars[i].set(str(float(values[i])))
+        self._shown_values = values
     
-    """ Main loop for the software, repeats until the program is closed"""
+    """ Live-plot animation function. Only updates the data, the renderer decides when to actually draw"""
+    def animate(self):
+        if self.plot_variables[self.indcombo.current()][0] == "Time (s)":
+            # updates x axis as time passes, in 5 s jumps so the static background is not re-rendered every frame
+            now = time.time()-self.engine.init_time
+            if not self.ax.get_xlim()[0] < now < self.ax.get_xlim()[1]:
+                self.ax.set_xlim([now-10,now+5])
+        if self.decimate.get():
+            self.decimator.set_view(self.ax.get_xlim(), self.ax.bbox.width)
+            self.scattery.set_offsets(self.decimator.points())
+        else:
+            self.scattery.set_offsets(self.plot_buffer.view())
+        self.renderer.mark_dirty()
+
+    """ Refreshes the diagnostics panel with the profiler's report, at most every diagnostics_interval"""
+    def show_diagnostics(self):
+        if time.monotonic() - self._diagnostics_shown < self.diagnostics_interval:
+            return
+        self._diagnostics_shown = time.monotonic()
+        self.diagnostics_text.config(state="normal")
+        self.diagnostics_text.delete("1.0", END)
+        self.diagnostics_text.insert(END, profiler.report())
+        self.diagnostics_text.config(state="disabled")
+
+    """ (Re)starts the statistics of the column chosen in the statistics panel, over the window typed in"""
+    def watch_column(self):
+        if self.statistics is not None:
+            self.engine.unwatch(self.statistics.label)
+        try:
+            window = max(2, int(self.stats_window.get()))
+        except ValueError:
+            window = 1000
+        self.statistics = self.engine.watch(self.statscombo.get(), window=window)
+        self._stats_shown = 0
+
+    """ Refreshes the statistics panel, at most every stats_interval. The statistics themselves are kept up to date
+    by the engine as it polls, whether or not they are shown"""
+    def show_statistics(self):
+        if self.statistics is None or time.monotonic() - self._stats_shown < self.stats_interval:
+            return
+        self._stats_shown = time.monotonic()
+        self.stats_text.config(state="normal")
+        self.stats_text.delete("1.0", END)
+        self.stats_text.insert(END, self.statistics.report())
+        self.stats_text.config(state="disabled")
+
+    """ Main loop for the software, repeats at display rate until the program is closed. All instrument I/O
+    happens on the AcquisitionEngine thread, this only drains what it has published"""
     def main_task(self):
         
-        #perfTime = time.time()
-        
-        """ Live-plot animation function """
-        def animate(self):
-            
-            self.xval.append(timestepvalues[self.indcombo.current()])        
-            self.yval.append(timestepvalues[self.depcombo.current()])
-            self.scattery.set_offsets(np.c_[self.xval,self.yval])
-            
-            if self.indcombo.current() == 14:
-                self.ax.set_xlim([time.time()-init_time-10,time.time()-init_time+5]) #updates x axis as time passes
-            self.canvas.draw_idle()
-        
-        """ Check if connections have changed and act accordingly"""
-        serial_has_changed = self.serial_port.update()
-        usb_has_changed = self.usb_port.update()
-        if serial_has_changed:
-            self.status_box1.config(text=str(self.serial_port.state.name))
-            if self.serial_port.state == SerialStates.CONNECTED:
-                for i in range(12):
-                    self._scpi_properties[i].enable()
+        """ Report hotplug events picked up by the port watcher"""
+        event = self.port_watcher.poll_event()
+        while event is not None:
+            kind, port = event
+            if kind == PortEvents.APPEARED:
+                self.printer("Serial port appeared: " + str(port.description))
             else:
-                for i in range(12):
-                    self._scpi_properties[i].disable()
-        if usb_has_changed:
-            self.status_box2.config(text=str(self.usb_port._port))
-            if self.usb_port.state == USBStates.CONNECTED:
-                for i in range(len(self._scpi_properties)-12):
-                    self._scpi_properties[i+12].enable()
+                self.printer("Serial port vanished: " + str(port.description))
+            event = self.port_watcher.poll_event()
+
+        """ Act on connection changes seen by the acquisition thread"""
+        rp100, keysight = self.registry.names(0)
+        for event in self.engine.poll_events():
+            if event.instrument == rp100:
+                self.status_box1.config(text=str(event.state.name))
+                if event.state == SerialStates.CONNECTED:
+                    for prop in self._rp100_properties:
+                        prop.enable()
+                else:
+                    for prop in self._rp100_properties:
+                        prop.disable()
+            elif event.instrument == keysight:
+                self.status_box2.config(text=str(event.state.name))
+                if event.state == USBStates.CONNECTED:
+                    self.status_box2.configure(background='lime')
+                    for prop in self._keysight_properties:
+                        prop.enable()
+                else:
+                    self.status_box2.configure(background='red')
+                    for prop in self._keysight_properties:
+                        prop.disable()
             else:
-                for i in range(len(self._scpi_properties)-12):
-                    self._scpi_properties[i+12].disable()
+                status_box = self._station_boxes[event.instrument][0]
+                connected = event.state in (SerialStates.CONNECTED, USBStates.CONNECTED)
+                status_box.config(text=str(event.state.name), background='lime' if connected else 'red')
         
-        """ Live-update GUI with new values from instruments"""
-        if self.serial_port.state == SerialStates.CONNECTED:
-            for i in range(3):
-                self._scpi_properties[i+3].scpi_get()
-                self._scpi_properties[i+9].scpi_get()
-        if self.usb_port.state.name == "CONNECTED":
-            self._scpi_properties[12].scpi_get()
-            
-        """ Live-plot and record data """
-        if self.recording == True:
-            #init_time = time.time()
-            if self.serial_port.state == SerialStates.CONNECTED or self.usb_port.state == USBStates.CONNECTED:
+        """ Live-update GUI with the newest values, and record and plot every sample since the last refresh"""
+        polled = self.engine.poll()
+        self.show_values()
+        if polled.samples:
+            if self.recording == True:
                 """ Record Data """
-                timestepvalues = np.zeros(15, dtype = float)
-                if self.serial_port.state == SerialStates.CONNECTED:
-                    #for i in range(3):
-                        #timestepvalues[i] = float(self._scpi_properties[i].heldvalue.get())
-                        #timestepvalues[i+6] = float(self._scpi_properties[i+6].heldvalue.get())
-                        #print(float(self._scpi_properties[1].heldvalue.get()))
-                    for i in range(3):
-                        timestepvalues[i+3] = float(self._scpi_properties[i+3].value.get())
-                        timestepvalues[i+9] = float(self._scpi_properties[i+9].value.get())
-                if self.usb_port.state == USBStates.CONNECTED:
-                    for i in range(3):
-                        timestepvalues[12+i] = float(self._scpi_properties[12].value[i].get())
-                #timestepvalues[12] = timestepvalues[12]*(10**12) #from F to pF
-                #timestepvalues[13] = timestepvalues[13]/(10**3) #changes from Ohm to kOhm
-                #timestepvalues[15] = time.strftime("%H:%M:%S", time.localtime())
-                timestepvalues[14] = (time.time() - init_time)
-                self.data.append(timestepvalues)
+                x = self.plot_columns[self.indcombo.current()]
+                y = self.plot_columns[self.depcombo.current()]
+                for timestepvalues in self.engine.record(polled.rows):
+                    self.plot_buffer.append((timestepvalues[x], timestepvalues[y]))
+                    self.decimator.append(timestepvalues[x], timestepvalues[y])
                 """ Plot Data """
-                animate(self)
-                    
-        self.counter = 0
-        self.counter += 1
-        self.win.after(1, self.main_task)
-        
-        #print(time.time() - perfTime)
+                self.animate()
+        self.renderer.frame()
+        self.show_statistics()
+
+        if self.engine.sequence is not None:
+            self.sweep_status.config(text=self.engine.sequence.status())
+        if self.startup is not None:
+            self.startup.mark("first refresh")
+            self.printer(self.startup.report())
+            self.startup = None
+            # fill the instrument cache now the window is up, so the first port chooser opens with a list
+            self.engine.discovery.refresh()
+            self.win.after_idle(self.offer_resume)
+        self.flush_printer()
+        if profiler.enabled:
+            self.show_diagnostics()
+        self.win.after(self.display_interval, self.main_task)
+
+    """ Imports the plotting stack and fills the plot frame with the live plot"""
+    def build_plot(self):
+        import matplotlib.pyplot as plt
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+        self.fig = plt.Figure(tight_layout=True)
+        self.ax = self.fig.add_subplot(111)
+        self.ax.set_xlim([-20,120])
+        self.ax.set_ylim([-1,1])
+        self.scattery = self.ax.scatter([0],[0],color='red')
+        self.ax.grid()
+        self.ax.axvline(x=0,color='black')
+        self.ax.axhline(y=0,color='black')
+        self.canvas = FigureCanvasTkAgg(self.fig, master=self.plotframe)
+        self.canvas.get_tk_widget().pack(fill=tkinter.BOTH, expand=1)
+        self.renderer = BlitRenderer(self.canvas, self.ax, [self.scattery], max_fps=self.max_fps)
 
     def build_main_window(self):
         self.win = Tk()
@@ -638,17 +729,25 @@ class MainGui:
         
         """ Sequence to start recording data, bound to Start Recording button"""
         def startrecord(event):
-            global init_time
-            init_time = time.time()
             self.recording = True
             self.indcombo.configure(state="disabled")
             self.depcombo.configure(state="disabled")
+            self.formatcombo.configure(state="disabled")
+            self.capacitybox.configure(state="disabled")
             self.ax.set_xlabel(self.indcombo.get())
             self.ax.set_ylabel(self.depcombo.get())
-            #list of axes ranges, corresponding in order to the associated _scpi_property, being assigned based on selection
-            lims = [[-1,2],[-20,120],[0,100],[-20,120],[-20,120],[-20,100],[-1,2],[-20,120],[0,100],[-20,120],[-20,120],[-20,100],[-20/(10**12),10/(10**12)],[-200*(10**3),100*(10**3)],[0,10]]
-            self.ax.set_xlim(lims[self.indcombo.current()])
-            self.ax.set_ylim(lims[self.depcombo.current()])
+            #axes ranges of the chosen variables, from the property registry
+            self.ax.set_xlim(self.plot_variables[self.indcombo.current()][2])
+            self.ax.set_ylim(self.plot_variables[self.depcombo.current()][2])
+            try:
+                capacity = max(1, int(self.plot_capacity.get()))
+            except (TclError, ValueError):
+                capacity = self.plot_buffer.capacity
+            if capacity != self.plot_buffer.capacity:
+                self.plot_buffer = RingBuffer(capacity)
+            else:
+                self.plot_buffer.clear()
+            self.decimator.clear()
             #assigning which _scpi_property has been chosen for the independent/dependent variables for graphing
             #self.indvar = self._scpi_properties[self.indcombo.current()]
             #print(type(self.indvar))
@@ -656,114 +755,137 @@ class MainGui:
             self.canvas.draw()
             recordbutton.configure(state="disabled",background="white")
             stoprecbutton.configure(state="normal",background="light grey")
-            datalabels=["Output Relay 1","Target Voltage 1 (V)","Slew Rate 1 (V/s)","Output Voltage 1 (V)","Measured Voltage 1 (V)","Measured Current 1 (A)","Output Relay 2","Target Voltage 2 (V)","Slew Rate 2 (V/s)","Output Voltage 2 (V)","Measured Voltage 2 (V)","Measured Current 2 (A)","Primary Keysight Measurement","Secondary Keysight Measurement", "Time (s)"]
-            with open('data_in_progress.csv','w',newline='') as file:
-                    writer = csv.writer(file)
-                    writer.writerow(datalabels)
+            attrs = {"rp100_idn": str(self.idn_box1.cget("text")), "keysight_idn": str(self.idn_box2.cget("text"))}
+            for station in range(1, self.registry.stations):
+                for name, key in zip(self.registry.names(station), ("rp100_", "keysight_")):
+                    attrs[key + str(station + 1) + "_idn"] = str(self._station_boxes[name][1].cget("text"))
+            deadband = None
+            if self.deadband.get():
+                try:
+                    heartbeat = float(self.heartbeat.get())
+                except ValueError:
+                    heartbeat = 10.0
+                deadband = DeadbandFilter(self.registry.deadbands(DEADBAND_DEFAULTS), heartbeat, self.engine.labels)
+            self.deadbandcheck.configure(state="disabled")
+            self.heartbeatbox.configure(state="disabled")
+            self.engine.start_recording(self.formatcombo.get(), attrs, deadband=deadband, resume=self.resume_session)
+            self.resume_session = None
             
         """ Sequence to stop recording data, bound to Stop Recording button"""
-        def stoprecord(event):
+        def stoprecord(event=None):
             self.recording = False
+            path = self.engine.stop_recording()
             self.indcombo.configure(state="readonly")
             self.depcombo.configure(state="readonly")
+            self.formatcombo.configure(state="readonly")
+            self.capacitybox.configure(state="normal")
+            self.deadbandcheck.configure(state="normal")
+            self.heartbeatbox.configure(state="normal")
             recordbutton.configure(state="normal",background="firebrick1")
             stoprecbutton.configure(state="disabled",background="white")
-            savetime=time.strftime("%Y %m %d - %H_%M_%S")
-            os.rename(r'data_in_progress.csv',savetime+'.csv')
-            with open(savetime+'.csv','a',newline='') as file:
-                writer = csv.writer(file)
-                writer.writerows(self.data)
-            self.fig.savefig(savetime+'.png')
+            self.fig.savefig(os.path.splitext(path)[0]+'.png')
+            if self.align.get():
+                try:
+                    self.printer("Aligned copy saved to " + write_aligned(path))
+                except Exception as e:
+                    self.printer("Could not save the aligned copy: " + str(e))
 
         """ Facilitates serial port selection, links front-end (PortChooser) with back-end (connect())"""
         def choose_port_serial():
-            p = PortChooser(self.win)
+            p = PortChooser(self.win, self.engine.discovery)
             if p.result is not None:
-                self.serial_port.connect(p.result)
+                resp = self.engine.connect_rp100(p.result)
                 if self.serial_port.state == SerialStates.CONNECTED:
                     connect_button1.config(state="disabled")
                     disconnect_button1.config(state="normal")
                     self.status_box1.config(text=self.serial_port.state.name)
                     self.status_box1.config(background='lime')
-                    time.sleep(0.05)
-                    self.serial_port.write(b'*IDN?\n')
-                    resp = self.serial_port.read()
                     if resp is not None:
-                        self.idn_box1.config(text=resp.strip())
-                    for i in range(12):
-                        self._scpi_properties[i].enable()
+                        self.idn_box1.config(text=resp)
+                    for prop in self._rp100_properties:
+                        prop.enable()
                         try:
-                            self._scpi_properties[i].heldvalue.set(self._scpi_properties[i].value.get())
+                            prop.heldvalue.set(prop.value.get())
                         except: pass
         
         """ Facilitates USB selection, links front-end (PortChooser) with back-end (connect())"""
         def choose_port_usb():
-            p = PortChooser(self.win)
+            p = PortChooser(self.win, self.engine.discovery)
             if p.result is not None:
-                self.usb_port.connect(p.result)
+                resp = self.engine.connect_keysight(p.result)
                 if self.usb_port.state == USBStates.CONNECTED:
+                    if self.buffered.get():
+                        self.usb_port.start_capture()
                     connect_button2.config(state="disabled")
                     disconnect_button2.config(state="normal")
-                    time.sleep(0.05)
                     self.status_box2.config(text=self.usb_port.state.name)
                     self.status_box2.config(background='lime')
-                    self.idn_box2.config(text=rm.open_resource(p.result).query('*IDN?').strip())
-                    for i in range(len(self._scpi_properties)-12):
-                        self._scpi_properties[i+12].enable()
+                    if resp is not None:
+                        self.idn_box2.config(text=resp)
+                    for prop in self._keysight_properties:
+                        prop.enable()
 
         """ Front-end command for disconnecting the RP100 plus a safe disconnect sequences"""
-        def disconnect_serial():
+        def disconnect_serial(then=None):
             if self.recording:
                 MsgBox = messagebox.askquestion("Stop Recording?","You are currently recording. Quitting now will stop recording and save data collected up to this point. Are you sure you'd like to continue?",icon="warning")
                 if MsgBox == 'yes':
                     stoprecord()
                 else: return
-            waittime1 = int(np.ceil(float(self._scpi_properties[1].value.get())/float(self._scpi_properties[2].value.get())*1000))
-            waittime2 = int(np.ceil(float(self._scpi_properties[1+6].value.get())/float(self._scpi_properties[2+6].value.get())*1000))
-            waittime = max(waittime1,waittime2)
-            MsgBox = messagebox.askquestion("Turn Off Power?","Would you like to set the output voltages to 0V before disconnecting? It will take about " + str(int(np.floor(waittime/1000))) + " seconds.",icon="question")
-                # safe disconnect sequence, sets target voltage to 0, waits while ramping down, then sets output relay to disabled
+            waittime = self.engine.ramp_down_time()
+            MsgBox = messagebox.askquestion("Turn Off Power?","Would you like to set the output voltages to 0V before disconnecting? It will take about " + str(int(np.floor(waittime))) + " seconds.",icon="question")
+                # safe disconnect sequence, sets target voltage to 0, ramps down in the background (the GUI keeps
+                # running), then sets output relay to disabled and disconnects
             if MsgBox == 'yes':
-                self._scpi_properties[1].value.set(0.00)
-                self._scpi_properties[1+6].value.set(0.00)
-                self._scpi_properties[1].scpi_set()
-                self._scpi_properties[1+6].scpi_set()
-                self.win.after(waittime)
-                self._scpi_properties[0].value.set("0")
-                self._scpi_properties[0].scpi_set()
-                self._scpi_properties[0+6].value.set("0")
-                self._scpi_properties[0+6].scpi_set()
-            self.serial_port.disconnect()
+                disconnect_button1.config(state="disabled")
+                self.status_box1.config(text="RAMPING DOWN")
+                self.engine.start_ramp_down(on_done=lambda sequence: finish_disconnect_serial(then))
+                for channel in (b"1", b"2"):
+                    for command in (b"OUTP" + channel, b"SOUR" + channel + b":VOLT"):
+                        self._widgets[(self.registry.names(0)[0], command)].value.set(0)
+                        self._widgets[(self.registry.names(0)[0], command)].heldvalue.set(0)
+                return
+            finish_disconnect_serial(then)
+
+        def finish_disconnect_serial(then=None):
+            self.engine.disconnect_rp100()
             self.status_box1.configure(background='lightcoral')
             connect_button1.config(state="normal")
             disconnect_button1.config(state="disabled")
             self.status_box1.config(text=self.serial_port.state.name)
             self.idn_box1.config(text="None")
-            for i in range(12):
-                self._scpi_properties[i].disable()
+            for prop in self._rp100_properties:
+                prop.disable()
+            if then is not None:
+                then()
                 
-        """ Front-end command for disconnecting the Keysight"""
+        """ Front-end command for disconnecting the Keysight, taking it out of buffered capture first"""
         def disconnect_usb():
-            self.usb_port.disconnect()
+            if self.usb_port.capture is not None:
+                self.usb_port.stop_capture()
+            self.engine.disconnect_keysight()
             connect_button2.config(state="normal")
             disconnect_button2.config(state="disabled")
             self.status_box2.config(text=self.usb_port.state.name)
             self.status_box2.configure(background='lightcoral')
             self.idn_box2.config(text="None")
-            for i in range(len(self._scpi_properties)-12):
-                self._scpi_properties[i+12].disable()
+            for prop in self._keysight_properties:
+                prop.disable()
         
-        """front end unlock/lock"""
+        """front end unlock/lock of the settable RP100 properties"""
+        def settable_rp100():
+            rp100 = self.registry.names(0)[0]
+            return [self._widgets[(rp100, prop.command)] for prop in self.registry.of(rp100) if prop.settable]
         def unlocker():
             if self.serial_port.state == SerialStates.CONNECTED:
-                for i in [0,1,2,6,7,8]:
-                    self._scpi_properties[i].unlock()
+                for prop in settable_rp100():
+                    prop.unlock()
                 unlockbutton.config(state="disabled")
                 lockbutton.config(state="normal")
         def locker():
             if self.serial_port.state == SerialStates.CONNECTED:
-                for i in [0,1,2,6,7,8]:
-                    self._scpi_properties[i].lock()
+                for prop in settable_rp100():
+                    prop.lock()
                 unlockbutton.config(state="normal")
                 lockbutton.config(state="disabled")
         
@@ -777,6 +899,38 @@ class MainGui:
             plotButtonOn.config(state='normal', background='white')
             plotButtonOff.config(state='disabled')
         
+        """ Starts a sweep of the chosen RP100 channel with the settings in the Sweep Sequencer panel"""
+        def start_sweep():
+            if self.serial_port.state != SerialStates.CONNECTED:
+                self.printer("Sweep: connect the RP100 first")
+                return
+            try:
+                targets = parse_targets(self.sweep_targets.get())
+                if self.sweep_settle.get() == "Keysight stable":
+                    settle = KeysightStable(int(self.sweep_count.get()), float(self.sweep_tolerances["Keysight stable"].get()))
+                else:
+                    settle = TargetReached(float(self.sweep_tolerances["Target reached"].get()))
+                timeout = float(self.sweep_timeout.get()) if self.sweep_timeout.get().strip() else None
+                average = int(self.sweep_average.get())
+            except ValueError as e:
+                self.printer("Sweep: " + str(e))
+                return
+            channel = int(self.sweep_channel.get())
+            target_prop = self._widgets[(self.registry.names(0)[0], b"SOUR" + str(channel).encode() + b":VOLT")]
+            def show_step(sequence):
+                target_prop.value.set(sequence.target)
+                target_prop.heldvalue.set(sequence.target)
+            try:
+                self.engine.sweep(targets, channel, [settle], average=average, timeout=timeout, on_step=show_step,
+                                  on_finish=lambda sequence: self.printer("Sweep finished: " + str(len(sequence.steps)) + " steps"))
+            except RuntimeError as e:
+                self.printer("Sweep: " + str(e) + ", wait for it to finish")
+                return
+            self.printer("Sweep started: " + str(len(targets)) + " steps on channel " + str(channel))
+
+        def stop_sweep():
+            self.engine.stop_sequence()
+
         """ Command to quit the program and prompt to stop recording if recording is active"""
         def quitexe():
             MsgBox = messagebox.askquestion("Quit Application","You are about to quit the application. Would you like to proceeed?",icon="warning")
@@ -786,7 +940,8 @@ class MainGui:
                         MsgBox = messagebox.askquestion("Stop Recording?","You are currently recording. Quitting now will stop recording and save data collected up to this point. Are you sure you'd like to continue?",icon="warning")
                         if MsgBox == 'yes':
                             stoprecord()
-                            disconnect_serial()
+                            disconnect_serial(then=self.win.destroy)
+                            return
                         else: return
                 self.win.destroy()
             return
@@ -846,8 +1001,18 @@ class MainGui:
         self.idn_box1 = Label(frame, text="None", relief=SUNKEN)
         self.idn_box1.grid(row=2, column=3, sticky="WE")
         
+        """ Switches the connected E4980AL between one fetch per cycle and buffered capture (read in blocks) """
+        def toggle_buffered():
+            if self.usb_port.state != USBStates.CONNECTED:
+                return
+            if self.buffered.get():
+                self.usb_port.start_capture()
+            else:
+                self.usb_port.stop_capture()
+
         """ Generates the Keysight E4980AL USB Connection Box """
-        frame = Frame(tab1, width = 150, height = 90,  border=2, relief=GROOVE)
+        self.buffered = BooleanVar(value=False)
+        frame = Frame(tab1, width = 150, height = 115,  border=2, relief=GROOVE)
         frame.grid_propagate(False)
         frame.grid(row=1, column=2, sticky="NWE", padx=10, pady=5)
         frame.grid_columnconfigure(3, weight=2)
@@ -865,9 +1030,10 @@ class MainGui:
         self.status_box2.grid(row=1, column=3, sticky="WE")
         self.idn_box2 = Label(frame, text="None", relief=SUNKEN)
         self.idn_box2.grid(row=2, column=3, sticky="WE")
+        Checkbutton(frame, text="Buffered capture", variable=self.buffered, command=toggle_buffered).grid(row=3, column=1, columnspan=3, sticky="W")
 
-        """ Generates the RP100 control widgets for each channel """
-        
+        """ Generates the RP100 control widgets for each channel, from station 0's properties in the registry """
+        rp100, keysight = self.registry.names(0)
         for channel in (1, 2):
             frame = Frame(tab1, width=150, height = 205, border=2, relief=GROOVE)
             frame.grid_propagate(False)
@@ -875,19 +1041,14 @@ class MainGui:
             frame.columnconfigure(index=1,weight=1)
             frame.columnconfigure(index=2,weight=2)
             Label(frame, text="RP100 Channel " + str(channel)).grid(row=1, column=0, columnspan=5)
-            ch_bytes = bytes(str(channel), 'utf8')
-            prop = ScpiPropertyBool(frame, 2, self.serial_port, b"OUTP" + ch_bytes, "Output relay " + str(channel))
-            self._scpi_properties.append(prop)
-            prop = ScpiPropertyFloat(frame, 3, self.serial_port, b"SOUR" + ch_bytes + b":VOLT", "Target Voltage " + str(channel) + " (V)")
-            self._scpi_properties.append(prop)
-            prop = ScpiPropertyFloat(frame, 4, self.serial_port, b"SOUR" + ch_bytes + b":VOLT:SLEW", "Slew Rate " + str(channel) + " (V/s)")
-            self._scpi_properties.append(prop)
-            prop = ScpiPropertyFloat(frame, 5, self.serial_port, b"SOUR" + ch_bytes + b":VOLT:NOW", "Output Voltage " + str(channel) + " (V)", can_set=False)
-            self._scpi_properties.append(prop)
-            prop = ScpiPropertyFloat(frame, 6, self.serial_port, b"MEAS" + ch_bytes + b":VOLT", "Measured Voltage " + str(channel) + " (V)", can_set=False)
-            self._scpi_properties.append(prop)
-            prop = ScpiPropertyFloat(frame, 7, self.serial_port, b"MEAS" + ch_bytes + b":CURR", "Measured Current " + str(channel) + " (A)", can_set=False)
-            self._scpi_properties.append(prop)
+            for row, entry in enumerate(self.registry[(rp100, channel)], 2):
+                if entry.kind == "bool":
+                    prop = ScpiPropertyBool(frame, row, self.serial_port, entry.command, entry.description)
+                else:
+                    prop = ScpiPropertyFloat(frame, row, self.serial_port, entry.command, entry.description, can_set=entry.settable)
+                self._scpi_properties.append(prop)
+                self._rp100_properties.append(prop)
+                self._widgets[(rp100, entry.command)] = prop
         
         """ Generates the Keysight control widgets """
         frame = Frame(tab1, width=120, height=100, border=2, relief=GROOVE)
@@ -897,36 +1058,47 @@ class MainGui:
         frame.columnconfigure(index=1,weight=1)
         frame.columnconfigure(index=2,weight=1)
         #frame.grid_forget()
-        prop = ScpiPropertyFloat(frame, 2, self.usb_port, ":FETCh:IMPedance:FORMatted?", ["Capacitance (F)","Resistance (Ω)"], can_set=False)
+        entries = self.registry[(keysight, 1)]
+        prop = ScpiPropertyFloat(frame, 2, self.usb_port, entries[0].command, [entry.description for entry in entries], can_set=False)
         self._scpi_properties.append(prop)
+        self._keysight_properties.append(prop)
+        self._widgets[(keysight, entries[0].command)] = prop
         
         """ Generate the Live Plotting graph """
-        plotframe = Frame(tab1, border=2, relief=GROOVE)
-        plotframe.grid(row=3,column=2,columnspan=1,rowspan=2, padx=50, pady=5, sticky="NSEW")
-        self.fig = plt.Figure(tight_layout=True)
-        self.ax = self.fig.add_subplot(111)
-        self.ax.set_xlim([-20,120])
-        self.ax.set_ylim([-1,1])
-        self.xval=[0]
-        self.yval=[0]
-        self.scattery = self.ax.scatter(self.xval,self.yval,color='red')
-        self.ax.grid()
-        self.ax.axvline(x=0,color='black')
-        self.ax.axhline(y=0,color='black')
-        self.canvas = FigureCanvasTkAgg(self.fig, master=plotframe)
-        self.canvas.get_tk_widget().pack(fill=tkinter.BOTH, expand=1)
+        self.plot_capacity = IntVar(value=10000) # number of points kept on the live plot
+        self.plotframe = Frame(tab1, border=2, relief=GROOVE)
+        self.plotframe.grid(row=3,column=2,columnspan=1,rowspan=2, padx=50, pady=5, sticky="NSEW")
+        self.plot_buffer = RingBuffer(self.plot_capacity.get())
+        self.decimator = MinMaxDecimator()
+        self.decimate = BooleanVar(value=True) # draw a min/max decimated view of the whole run instead of the last points
+        self.align = BooleanVar(value=False) # also save a copy with the RP100 readings interpolated to each Keysight reading
+        self.deadband = BooleanVar(value=False) # only record rows where a channel moved past its deadband (DEADBAND_DEFAULTS)
+        self.heartbeat = StringVar(value="10") # s, with deadband: longest gap between recorded rows
+        
+        """ Generates the Statistics panel next to the plot: running mean and std (over the whole run and the last
+        `window` readings) and the Allan deviation of any column, updated as each reading comes in """
+        frame = Frame(tab1, border=2, relief=GROOVE)
+        frame.grid(row=3, column=3, rowspan=2, padx=10, pady=5, sticky="NS")
+        Label(frame, text="Statistics").grid(row=0, column=0, columnspan=2)
+        self.statscombo = ttk.Combobox(frame, width=32)
+        self.statscombo.grid(row=1, column=0, columnspan=2)
+        self.statscombo.configure(state="readonly", values=self.engine.labels)
+        self.statscombo.set(entries[0].label)
+        self.statscombo.bind("<<ComboboxSelected>>", lambda event: self.watch_column())
+        label = Label(frame, text="Window: ")
+        label.grid(row=2, column=0)
+        self.stats_window = StringVar(value="1000")
+        Entry(frame, textvariable=self.stats_window, width=10).grid(row=2, column=1)
+        Button(frame, text="Reset", command=self.watch_column).grid(row=3, column=0, columnspan=2, sticky="WE")
+        self.stats_text = Text(frame, height=26, width=34, borderwidth=3, relief="sunken")
+        self.stats_text.config(font=("consolas", 9), wrap='none', state="disabled")
+        self.stats_text.grid(row=4, column=0, columnspan=2, sticky="NS")
+        self.watch_column()
         
         """ Generates the Plotting/Recording Control panel (bottom right) """
         frame = Frame(tab1, border=2, relief=GROOVE)
         frame.grid(row=5,column=2)
-        values_list = []
-        for prop in self._scpi_properties:
-            if type(prop.description) == list: #keysight returns measurements in [x,y] list
-                for i in range(len(prop.description)):
-                    values_list.append(prop.description[i])
-            else:
-                values_list.append(prop.description)
-        values_list.append("Time")
+        values_list = [description for _, description, _ in self.plot_variables]
         
         """
         plotButtonOn = Button(frame, text="On", background='lime')
@@ -960,6 +1132,103 @@ class MainGui:
         stoprecbutton.grid(row=2,column=1,rowspan=2,padx=10)
         stoprecbutton.bind("<ButtonRelease-1>",stoprecord)
         stoprecbutton.configure(state="disabled")
+        label = Label(frame, text="Format: ")
+        label.grid(row=4,column=0)
+        self.formatcombo = ttk.Combobox(frame, width=8)
+        self.formatcombo.grid(row=4,column=1)
+        self.formatcombo.configure(state="readonly", values=[name for name in RECORD_FORMATS if name != "HDF5" or HDF5_AVAILABLE])
+        self.formatcombo.current(0)
+        label = Label(frame, text="Plot points: ")
+        label.grid(row=5,column=0)
+        self.capacitybox = Entry(frame, textvariable=self.plot_capacity, width=10)
+        self.capacitybox.grid(row=5,column=1)
+        Checkbutton(frame, text="Decimate", variable=self.decimate).grid(row=6,column=0,columnspan=2)
+        Checkbutton(frame, text="Save aligned copy", variable=self.align).grid(row=7,column=0,columnspan=2)
+        self.deadbandcheck = Checkbutton(frame, text="Deadband", variable=self.deadband)
+        self.deadbandcheck.grid(row=8,column=0,columnspan=2)
+        label = Label(frame, text="Heartbeat (s): ")
+        label.grid(row=9,column=0)
+        self.heartbeatbox = Entry(frame, textvariable=self.heartbeat, width=10)
+        self.heartbeatbox.grid(row=9,column=1)
+        
+        """ Generates the Sweep Sequencer panel: steps an RP100 channel through target voltages while the plot and
+        recording keep running, settling and averaging at each step """
+        frame = Frame(tab1, border=2, relief=GROOVE)
+        frame.grid(row=6, column=1, columnspan=2, padx=10, pady=5, sticky="WE")
+        Label(frame, text="Sweep Sequencer").grid(row=0, column=0, columnspan=2)
+        self.sweep_channel = StringVar(value="1")
+        self.sweep_targets = StringVar(value="0:10:1:back")
+        self.sweep_settle = StringVar(value="Target reached")
+        # each settle condition keeps its own tolerance, in its own unit
+        self.sweep_tolerances = {"Target reached": StringVar(value="0.01"), "Keysight stable": StringVar(value="1e-15")}
+        self.sweep_count = StringVar(value="10")
+        self.sweep_average = StringVar(value="10")
+        self.sweep_timeout = StringVar(value="")
+        Label(frame, text="Channel:").grid(row=1, column=0, sticky="E")
+        ttk.Combobox(frame, textvariable=self.sweep_channel, values=["1", "2"], width=3, state="readonly").grid(row=1, column=1, sticky="W")
+        Label(frame, text="Targets (V):").grid(row=1, column=2, sticky="E")
+        Entry(frame, textvariable=self.sweep_targets, width=20).grid(row=1, column=3, sticky="W")
+        Label(frame, text="Settle on:").grid(row=1, column=4, sticky="E")
+        settlecombo = ttk.Combobox(frame, textvariable=self.sweep_settle, values=["Target reached", "Keysight stable"], width=14, state="readonly")
+        settlecombo.grid(row=1, column=5, sticky="W")
+        tolerance_label = Label(frame, text="Tolerance (V):")
+        tolerance_label.grid(row=1, column=6, sticky="E")
+        tolerance_entry = Entry(frame, textvariable=self.sweep_tolerances["Target reached"], width=8)
+        tolerance_entry.grid(row=1, column=7, sticky="W")
+        def show_tolerance(event=None):
+            settle = self.sweep_settle.get()
+            tolerance_label.config(text="Tolerance (F):" if settle == "Keysight stable" else "Tolerance (V):")
+            tolerance_entry.config(textvariable=self.sweep_tolerances[settle])
+        settlecombo.bind("<<ComboboxSelected>>", show_tolerance)
+        Label(frame, text="Keysight readings:").grid(row=2, column=0, sticky="E")
+        Entry(frame, textvariable=self.sweep_count, width=5).grid(row=2, column=1, sticky="W")
+        Label(frame, text="Average samples:").grid(row=2, column=2, sticky="E")
+        Entry(frame, textvariable=self.sweep_average, width=5).grid(row=2, column=3, sticky="W")
+        Label(frame, text="Step timeout (s):").grid(row=2, column=4, sticky="E")
+        Entry(frame, textvariable=self.sweep_timeout, width=8).grid(row=2, column=5, sticky="W")
+        Button(frame, text="Start Sweep", command=start_sweep).grid(row=1, column=8, padx=5, sticky="WE")
+        Button(frame, text="Stop Sweep", command=stop_sweep).grid(row=2, column=8, padx=5, sticky="WE")
+        self.sweep_status = Label(frame, text="Idle", relief=SUNKEN, width=40)
+        self.sweep_status.grid(row=2, column=6, columnspan=2, sticky="WE")
+
+        """ Generates a connection row for each instrument of the further stations. Their readings are recorded and
+        can be plotted, their settings are left as they are """
+        def connect_station(station, name):
+            p = PortChooser(self.win, self.engine.discovery)
+            if p.result is None:
+                return
+            if name == self.registry.names(station)[0]:
+                resp = self.engine.connect_rp100(p.result, station)
+            else:
+                resp = self.engine.connect_keysight(p.result, station)
+            if resp is not None:
+                self._station_boxes[name][1].config(text=resp)
+
+        def disconnect_station(station, name):
+            if name == self.registry.names(station)[0]:
+                self.engine.disconnect_rp100(station)
+            else:
+                self.engine.disconnect_keysight(station)
+            self._station_boxes[name][0].config(text="DISCONNECTED", background='lightcoral')
+            self._station_boxes[name][1].config(text="None")
+
+        if self.registry.stations > 1:
+            frame = Frame(tab1, border=2, relief=GROOVE)
+            frame.grid(row=7, column=1, columnspan=2, padx=10, pady=5, sticky="WE")
+            frame.grid_columnconfigure(4, weight=2)
+            Label(frame, text="Further Stations").grid(row=0, column=0, columnspan=2)
+            row = 1
+            for station in range(1, self.registry.stations):
+                for name in self.registry.names(station):
+                    Label(frame, text=name).grid(row=row, column=0, sticky="W")
+                    Button(frame, text="Connect", command=lambda station=station, name=name: connect_station(station, name)).grid(row=row, column=1, sticky="WE")
+                    Button(frame, text="Disconnect", command=lambda station=station, name=name: disconnect_station(station, name)).grid(row=row, column=2, sticky="WE")
+                    status_box = Label(frame, text="UNCONFIGURED", relief=SUNKEN, background='lightcoral', width=16)
+                    status_box.grid(row=row, column=3, padx=5)
+                    idn_box = Label(frame, text="None", relief=SUNKEN)
+                    idn_box.grid(row=row, column=4, sticky="WE")
+                    self._station_boxes[name] = (status_box, idn_box)
+                    row += 1
         
         
         #############################################################
@@ -988,6 +1257,7 @@ class MainGui:
         frame.grid_columnconfigure(2, weight=2)
         prop = ScpiErrorReporter(frame, 1, self.serial_port)
         self._scpi_properties.append(prop)
+        self._keysight_properties.append(prop)
         frame = Frame(tab2)
         frame.grid(row=20, column=1, columnspan=2)
         self.log_text = Text(frame, borderwidth=3, relief="sunken")
@@ -997,6 +1267,39 @@ class MainGui:
         scroll.grid(row=0, column=1, sticky='nsew')
         self.log_text['yscrollcommand'] = scroll.set
         self.log_text.config(state="disabled")
+
+        """ Generate the Diagnostics panel: hot-path timers and counters, only collected while profiling is on """
+        def toggle_profiling():
+            if self.profiling.get():
+                profiler.enable()
+            else:
+                profiler.disable()
+                self.show_diagnostics()
+
+        def reset_profile():
+            profiler.reset()
+            self._diagnostics_shown = 0
+            self.show_diagnostics()
+
+        def dump_profile():
+            path = "KARP profile " + time.strftime("%Y %m %d - %H_%M_%S") + ".txt"
+            profiler.dump(path)
+            self.printer("Profile written to " + os.path.abspath(path))
+
+        frame = Frame(tab2, border=2, relief=GROOVE)
+        frame.grid(row=30, column=1, columnspan=2, padx=10, pady=5, sticky="WE")
+        label = Label(frame, text="Diagnostics:", justify='center', font='Helvetica 16')
+        label.grid(row=0, column=0, sticky="W")
+        self.profiling = BooleanVar(value=profiler.enabled)
+        check = Checkbutton(frame, text="Profile hot paths", variable=self.profiling, command=toggle_profiling)
+        check.grid(row=0, column=1, padx=5)
+        button = Button(frame, text="Reset", command=reset_profile)
+        button.grid(row=0, column=2, padx=5)
+        button = Button(frame, text="Dump to file", command=dump_profile)
+        button.grid(row=0, column=3, padx=5)
+        self.diagnostics_text = Text(frame, height=16, width=100, borderwidth=3, relief="sunken")
+        self.diagnostics_text.config(font=("consolas", 9), wrap='none', state="disabled")
+        self.diagnostics_text.grid(row=1, column=0, columnspan=4, sticky="nsew", padx=2, pady=2)
         
         """ Initialize all widgets as disabled """
         for prop in self._scpi_properties:
@@ -1004,49 +1307,81 @@ class MainGui:
         
         
 class PortChooser(tkinter.simpledialog.Dialog):
-    """ A popup dialog for selecting a serial port to connect to. """
+    """ A popup dialog for selecting a serial port or USB instrument to connect to. It opens with the discovery
+    service's cached list and swaps in the fresh one when the background refresh it starts comes back. """
+    def __init__(self, parent, discovery):
+        self.discovery = discovery
+        self.instruments = []
+        self._refresh = None
+        self._after = None
+        super().__init__(parent)
+
     def body(self, master):
-        self.usb_ports = []
-        for i in range(len(rm.list_resources())):
-            if str(rm.list_resources()[i])[0:3] == "USB":
-                self.usb_ports.append(rm.list_resources()[i])
         self.iconbitmap('LAQM.ico')
-        self.ports = list_ports.comports()
         self.choice = StringVar(master)
         self.choice.set("None")
         Label(master, text="Please choose a serial port to connect to.").grid(row=1, column=1, columnspan=2)
-        n = 10
-        if len(self.ports) > 0 or len(self.usb_ports) > 0:
-            for port in self.ports:
-                Radiobutton(master, text=port.description, variable=self.choice, value=port.device)\
-                    .grid(row=n, column=1, columnspan=2, sticky=W)
-                n += 1
-            for port in self.usb_ports:
-                openedport = rm.open_resource(port)
-                try:
-                    Radiobutton(master, text=openedport.resource_info.alias, variable=self.choice, value=port).grid(row=n, column=1, columnspan=2, sticky=W)
-                    n += 1
-                except:
-                    Radiobutton(master, text=openedport.resource_info.resource_name, variable=self.choice, value=port).grid(row=n, column=1, columnspan=2, sticky=W)
-                    n += 1
-        else:
-            Label(master, text="Error: Could not find a suitable serial or USB port.\n"
-                               "Make sure your devices are plugged in and turned on,\n"
-                               "and the E4980AL is properly configured (see guide). ").grid(row=n, column=1, columnspan=2)
+        self.status = Label(master, text="Looking for instruments...")
+        self.status.grid(row=2, column=1, columnspan=2)
+        self.list_frame = Frame(master)
+        self.list_frame.grid(row=10, column=1, columnspan=2, sticky=W)
+        self._refresh = self.discovery.refresh(force=True)
+        self.show(self.discovery.instruments())
+        self._after = self.after(100, self.check_refresh)
+
+    """ Shows the new list once the background refresh is done, keeping the selection """
+    def check_refresh(self):
+        if not self._refresh.done():
+            self._after = self.after(100, self.check_refresh)
+            return
+        self._after = None
+        try:
+            instruments = self._refresh.result()
+        except Exception as e:
+            self.status.config(text="Could not look for instruments: " + str(e))
+            return
+        self.status.config(text="")
+        self.show(instruments)
+
+    def show(self, instruments):
+        self.instruments = instruments
+        for widget in self.list_frame.winfo_children():
+            widget.destroy()
+        for n, instrument in enumerate(instruments):
+            text = instrument.description
+            if instrument.idn:
+                text += " (" + instrument.idn + ")"
+            Radiobutton(self.list_frame, text=text, variable=self.choice, value=instrument.name).grid(row=n, column=1, sticky=W)
+        if not instruments and self._refresh.done():
+            Label(self.list_frame, text="Error: Could not find a suitable serial or USB port.\n"
+                                        "Make sure your devices are plugged in and turned on,\n"
+                                        "and the E4980AL is properly configured (see guide). ").grid(row=0, column=1)
+
+    def destroy(self):
+        if self._after is not None:
+            self.after_cancel(self._after)
+            self._after = None
+        super().destroy()
 
     """ Find the device associated with the selection and return it as the selected port"""
     def apply(self):
         choice = self.choice.get()
-        for port in self.ports:
-            if choice == port.device:
-                self.result = port
-                return
-        for port in self.usb_ports:
-            if choice == port:
-                self.result = port
+        for instrument in self.instruments:
+            if choice == instrument.name:
+                self.result = instrument.port_info if instrument.kind == "serial" else instrument.name
                 return
         self.result = None
 
 
 if __name__ == "__main__":
-    MainGui()
\ No newline at end of file
+    """ --stations N adds RP100 / E4980AL pairs beyond the first, each polled on its own thread """
+    stations = int(sys.argv[sys.argv.index("--stations") + 1]) if "--stations" in sys.argv else 1
+    """ --log PATH also writes the log to a file, rotated at 1 MB """
+    log_path = sys.argv[sys.argv.index("--log") + 1] if "--log" in sys.argv else None
+    if "--simulate" in sys.argv:
+        """ Runs against the stand-in instruments from karp_sim.py, no hardware needed """
+        import karp_sim
+        karp_sim.install(stations=stations)
+    startup = StartupTimer(_started)
+    startup.mark("imports")
+    MainGui(stations, log_path, startup)
\ No newline at end of file
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark harness for KARP's acquisition loop.
+"""
+
+""" Runs KarpEngine against the simulated instruments from karp_sim.py (with fixed or recorded latencies) for a """
+""" while, recording and, if matplotlib is available, plotting exactly as the GUI does, and reports samples/s, """
+""" tick latency percentiles, inter-sample jitter and where the time went (from karp_engine.profiler's timers), """
+""" as JSON so runs can be compared: """
+""" python karp_bench.py --duration 20 --json before.json """
+
+import argparse
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import karp_engine
+import karp_sim
+
+GUI_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "KARP Final - June 2022.py")
+
+
+""" Which of karp_engine.profiler's timers make up each reported stage"""
+STAGES = {"port_scan": ("rp100.update", "e4980al.update"),
+          "serial_query": ("rp100.query_batch",),
+          "visa_fetch": ("e4980al.query", "e4980al.read_capture"),
+          "recording": ("recording.write_rows",),
+          "plotting": ("bench.plot",)}
+
+
+def _durations(names):
+    """ Every duration in the windows of the named profiler timers"""
+    durations = []
+    for name in names:
+        if name in karp_engine.profiler.timers:
+            durations.extend(karp_engine.profiler.timers[name].durations)
+    return durations
+
+
+def _summary(durations):
+    """ Count, total and percentiles (in ms) of a list of durations in seconds"""
+    if not durations:
+        return {"count": 0, "total_s": 0.0, "p50_ms": None, "p99_ms": None, "max_ms": None}
+    values = np.asarray(durations)
+    return {"count": len(values), "total_s": float(values.sum()), "p50_ms": float(np.percentile(values, 50) * 1e3),
+            "p99_ms": float(np.percentile(values, 99) * 1e3), "max_ms": float(values.max() * 1e3)}
+
+
+def _load_plotting():
+    """ The GUI's plot classes drawing on an off-screen Agg canvas, or None when matplotlib is not installed"""
+    cwd = os.getcwd()
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        spec = importlib.util.spec_from_file_location("karp_gui", GUI_FILE)
+        gui = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(gui)
+    except Exception:
+        return None
+    finally:
+        os.chdir(cwd)
+    fig = Figure()
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    ax.set_xlim([0, 10])
+    ax.set_ylim([-1, 1])
+    scatter = ax.scatter([0], [0], color='red')
+    renderer = gui.BlitRenderer(canvas, ax, [scatter])
+    return {"ax": ax, "scatter": scatter, "renderer": renderer, "decimator": gui.MinMaxDecimator()}
+
+
+def run(duration=10.0, period=0.01, display_interval=0.02, buffered=False, record_format="CSV",
+        rp100_options=None, keysight_options=None, plot=True, async_io=False):
+    """ Runs one benchmark and returns its results as a dict"""
+    rp100, keysight = karp_sim.install(rp100_options, keysight_options)
+    profiler = karp_engine.profiler
+    profiler.window = int(duration / period) + 1000
+    profiler.timers.clear()
+    profiler.counters.clear()
+    profiler.enable()
+    engine = karp_engine.KarpEngine(printer=lambda message: None, print_conn=False, period=period,
+                                    async_io=async_io)
+    plotting = _load_plotting() if plot else None
+    plot_timer = profiler.timer("bench.plot")
+    # station 0's channel 1 output voltage against time
+    time_column = engine.labels.index("Time (s)")
+    voltage_column = engine.labels.index(engine.registry.find(engine.registry.names(0)[0], b"SOUR1:VOLT:NOW").label)
+
+    engine.connect_rp100(rp100.name)
+    engine.connect_keysight(keysight.resource_info.resource_name)
+    if buffered:
+        engine.usb_port.start_capture()
+    workdir = tempfile.mkdtemp(prefix="karp_bench_")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    sample_times = []
+    try:
+        engine.start()
+        engine.start_recording(record_format)
+        started = time.perf_counter()
+        while time.perf_counter() - started < duration:
+            time.sleep(display_interval)
+            polled = engine.poll()
+            sample_times.extend(sample.time for sample in polled.samples)
+            rows = engine.record(polled.rows)
+            if plotting is not None and rows:
+                plot_started = time.perf_counter()
+                for row in rows:
+                    plotting["decimator"].append(row[time_column], row[voltage_column])
+                plotting["ax"].set_xlim([0, max(10.0, rows[-1][time_column] + 5)])
+                plotting["decimator"].set_view(plotting["ax"].get_xlim(), 800)
+                plotting["scatter"].set_offsets(plotting["decimator"].points())
+                plotting["renderer"].mark_dirty()
+                plotting["renderer"].frame()
+                plot_timer.add(time.perf_counter() - plot_started)
+        elapsed = time.perf_counter() - started
+        engine.stop_recording(os.path.join(workdir, "bench"))
+    finally:
+        engine.close()
+        profiler.disable()
+        os.chdir(cwd)
+
+    intervals = np.diff(sample_times) if len(sample_times) > 1 else np.array([])
+    return {
+        "config": {"duration_s": duration, "period_s": period, "display_interval_s": display_interval,
+                   "buffered": buffered, "format": record_format, "plotting": plotting is not None,
+                   "rp100_latency_s": rp100.latency, "keysight_latency_s": keysight.latency,
+                   "recorded_latencies": bool(rp100.latency_samples or keysight.latency_samples)},
+        "samples": len(sample_times),
+        "samples_per_s": len(sample_times) / elapsed,
+        "tick": _summary(_durations(("acquisition.tick",))),
+        "jitter": {"mean_interval_ms": float(intervals.mean() * 1e3) if len(intervals) else None,
+                   "std_interval_ms": float(intervals.std() * 1e3) if len(intervals) else None,
+                   "p99_interval_ms": float(np.percentile(intervals, 99) * 1e3) if len(intervals) else None},
+        "stages": {stage: _summary(_durations(names)) for stage, names in STAGES.items()},
+    }
+
+
+def startup():
+    """ Cold start cost, measured in a fresh interpreter: importing karp_engine, building a KarpEngine, and creating
+    the VISA ResourceManager on first USB use. Returns the three times in seconds"""
+    code = ("import time; started = time.perf_counter(); import karp_engine; imported = time.perf_counter(); "
+            "engine = karp_engine.KarpEngine(printer=lambda message: None, print_conn=False); built = time.perf_counter(); "
+            "karp_engine.visa_pool.refresh(force=True); visa = time.perf_counter(); engine.close(); "
+            "print(imported - started, built - imported, visa - built)")
+    output = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True).stdout
+    import_s, engine_s, visa_s = (float(value) for value in output.split()[-3:])
+    return {"import_s": import_s, "engine_s": engine_s, "first_visa_use_s": visa_s}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark KARP's acquisition loop against simulated instruments.")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to run")
+    parser.add_argument("--period", type=float, default=0.01, help="acquisition period (s)")
+    parser.add_argument("--buffered", action="store_true", help="use the E4980AL data buffer")
+    parser.add_argument("--format", choices=sorted(karp_engine.RECORD_FORMATS), default="CSV")
+    parser.add_argument("--rp100-latency", type=float, default=0.002, help="simulated RP100 reply latency (s)")
+    parser.add_argument("--keysight-latency", type=float, default=0.003, help="simulated E4980AL call latency (s)")
+    parser.add_argument("--measurement-time", type=float, default=0.005, help="simulated E4980AL integration time (s)")
+    parser.add_argument("--latency-profile", metavar="JSON", help='recorded latencies to replay: {"rp100": [...], "keysight": [...]} in seconds')
+    parser.add_argument("--async-io", action="store_true", help="use the asyncio acquisition engine")
+    parser.add_argument("--startup", action="store_true", help="also time a cold start in a fresh interpreter")
+    parser.add_argument("--no-plot", action="store_true", help="leave the plotting stage out")
+    parser.add_argument("--json", metavar="PATH", help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    rp100_options = {"latency": args.rp100_latency}
+    keysight_options = {"latency": args.keysight_latency, "measurement_time": args.measurement_time}
+    if args.latency_profile:
+        with open(args.latency_profile) as file:
+            profile = json.load(file)
+        rp100_options["latency_samples"] = profile.get("rp100")
+        keysight_options["latency_samples"] = profile.get("keysight")
+    results = run(args.duration, args.period, buffered=args.buffered, record_format=args.format,
+                  rp100_options=rp100_options, keysight_options=keysight_options, plot=not args.no_plot,
+                  async_io=args.async_io)
+    if args.startup:
+        results["startup"] = startup()
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.json:
+        with open(args.json, "w") as file:
+            file.write(text + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
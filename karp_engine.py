@@ -0,0 +1,3016 @@
+# -*- coding: utf-8 -*-
+"""
+Instrument, acquisition and recording back end of KARP.
+"""
+
+""" Everything needed to talk to the RP100 and the E4980AL, sample them and record the data, without tkinter or """
+""" matplotlib. KARP Final - June 2022.py (the GUI) is one client of KarpEngine; running this file directly is """
+""" another, for headless cryostat PCs, SSH sessions and batch scripts: python karp_engine.py --help """
+
+import time
+_import_started = time.perf_counter()
+import serial.tools.list_ports as list_ports
+import serial
+from enum import Enum
+import argparse
+import sys
+import datetime
+import os
+import shutil
+import threading
+import queue
+import asyncio
+import concurrent.futures
+import functools
+import importlib.util
+import io
+import json
+import logging
+import logging.handlers
+from collections import deque, namedtuple
+import numpy as np
+import csv
+
+""" pyvisa and h5py are slow to import (pyvisa loads the VISA library and scans its backends when the
+ResourceManager is created), so neither is touched until a USB instrument is looked for or an HDF5 file is used.
+h5py is optional."""
+HDF5_AVAILABLE = importlib.util.find_spec("h5py") is not None
+_resource_manager = None
+_resource_manager_lock = threading.Lock()
+
+
+def resource_manager():
+    """ The pyvisa ResourceManager, created on first use. How long that took is kept in the profiler's
+    startup.visa timer"""
+    global _resource_manager
+    with _resource_manager_lock:
+        if _resource_manager is None:
+            started = time.perf_counter()
+            import pyvisa
+            _resource_manager = pyvisa.ResourceManager()
+            profiler.timer("startup.visa").add(time.perf_counter() - started)
+        return _resource_manager
+
+""" Stand-in instruments (see karp_sim.py), by serial device name and by VISA resource name. Everything below treats
+these exactly like real hardware, so the whole acquisition path can run on a machine with nothing plugged in."""
+simulated_serial = {}
+simulated_visa = {}
+
+
+def comports():
+    """ list_ports.comports() plus any simulated serial devices"""
+    return list(list_ports.comports()) + [device.port_info for device in simulated_serial.values()]
+
+
+def open_serial(device, timeout=0.1):
+    """ Opens a serial port by device name, or hands back the simulated device registered under that name"""
+    if device in simulated_serial:
+        port = simulated_serial[device]
+        port.timeout = timeout
+        port.open()
+        return port
+    return serial.Serial(device, timeout=timeout)
+
+
+def synchronized(method):
+    """ Runs a method while holding the instance's lock, for port objects shared with the acquisition thread"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def parse_float(resp):
+    """ Turns an instrument reply (bytes or str) into a float, or NaN if it is empty or garbled"""
+    if resp is None:
+        return float("nan")
+    try:
+        resp = resp.decode()
+    except AttributeError:
+        pass
+    try:
+        return float(resp)
+    except ValueError:
+        return float("nan")
+
+
+class SerialStates(Enum):
+    UNCONFIGURED = 1
+    CONNECTED = 2
+    DROPPED = 3
+    
+class USBStates(Enum):
+    UNCONFIGURED = 1
+    CONNECTED = 2
+    DROPPED = 3
+
+class PortEvents(Enum):
+    APPEARED = 1
+    VANISHED = 2
+
+
+""" Bin edges (s) of the profiler's duration histograms: 1 us to 10 s, three bins per decade"""
+HISTOGRAM_EDGES = np.logspace(-6, 1, 22)
+
+
+class TimerStats:
+    """ Call count, total time and a rolling window of the latest durations (s) of one named timer"""
+    def __init__(self, window=4096):
+        self.calls = 0
+        self.total = 0.0
+        self.durations = deque(maxlen=window)
+
+    def add(self, duration):
+        self.calls += 1
+        self.total += duration
+        self.durations.append(duration)
+
+    """ Histogram of the durations in the window over HISTOGRAM_EDGES. Returns (counts, edges)"""
+    def histogram(self):
+        return np.histogram(np.array(list(self.durations)), HISTOGRAM_EDGES)
+
+    """ Calls, total and the mean, p50, p99 and max of the window, times in ms"""
+    def summary(self):
+        window = np.array(list(self.durations))
+        if not len(window):
+            return {"calls": self.calls, "total_s": self.total, "mean_ms": None, "p50_ms": None, "p99_ms": None, "max_ms": None}
+        p50, p99 = np.percentile(window, (50, 99))
+        return {"calls": self.calls, "total_s": self.total, "mean_ms": float(window.mean() * 1e3),
+                "p50_ms": float(p50 * 1e3), "p99_ms": float(p99 * 1e3), "max_ms": float(window.max() * 1e3)}
+
+
+class Profiler:
+    """
+    Named timers and counters for the hot paths (port updates, instrument I/O, acquisition ticks, recording, the
+    GUI's plot updates). attach() only notes which method of which object to time; nothing is wrapped until
+    enable(), which swaps a timing wrapper onto each of those instances, and disable() takes them off again, so a
+    disabled profiler costs nothing. Each timer keeps a rolling window of durations for its histogram. A counter
+    can ride along with a timer, adding measure(args, result) per call (rows written, bytes read...).
+    """
+    def __init__(self, window=4096):
+        self.window = window
+        self.enabled = False
+        self.timers = {}
+        self.counters = {}
+        self._attached = {}
+        self._lock = threading.Lock()
+
+    """ Times obj.method under name once enabled. counter and measure optionally count what each call handled"""
+    def attach(self, obj, method, name, counter=None, measure=None):
+        with self._lock:
+            key = (id(obj), method)
+            if key in self._attached and self.enabled:
+                self._unwrap(*self._attached[key][:2], self._attached[key][-1])
+            entry = [obj, method, name, counter, measure, None]
+            self._attached[key] = entry
+            if self.enabled:
+                entry[-1] = self._wrap(*entry[:5])
+
+    def detach(self, obj, method):
+        with self._lock:
+            entry = self._attached.pop((id(obj), method), None)
+            if entry is not None and self.enabled:
+                self._unwrap(obj, method, entry[-1])
+
+    """ Detaches every method of obj"""
+    def detach_all(self, obj):
+        for entry in [entry for entry in self._attached.values() if entry[0] is obj]:
+            self.detach(obj, entry[1])
+
+    def enable(self):
+        with self._lock:
+            if not self.enabled:
+                self.enabled = True
+                for entry in self._attached.values():
+                    entry[-1] = self._wrap(*entry[:5])
+
+    def disable(self):
+        with self._lock:
+            if self.enabled:
+                self.enabled = False
+                for entry in self._attached.values():
+                    self._unwrap(entry[0], entry[1], entry[-1])
+
+    def reset(self):
+        for stats in list(self.timers.values()):
+            stats.calls = 0
+            stats.total = 0.0
+            stats.durations.clear()
+        self.counters.clear()
+
+    """ The TimerStats called name, created on first use, for timing code that is not a method"""
+    def timer(self, name):
+        if name not in self.timers:
+            self.timers[name] = TimerStats(self.window)
+        return self.timers[name]
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    """ Puts a timing wrapper on the instance, returning what has to be put back (None: the class attribute)"""
+    def _wrap(self, obj, method, name, counter, measure):
+        original = obj.__dict__.get(method)
+        function = getattr(obj, method)
+        stats = self.timer(name)
+        count = self.count
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                result = function(*args, **kwargs)
+            finally:
+                stats.add(time.perf_counter() - started)
+            if counter is not None:
+                count(counter, measure(args, result) if measure is not None else 1)
+            return result
+        setattr(obj, method, timed)
+        return original
+
+    def _unwrap(self, obj, method, original):
+        if original is None:
+            obj.__dict__.pop(method, None)
+        else:
+            setattr(obj, method, original)
+
+    """ Human-readable table of every timer and counter. With histograms, each timer also gets a bar of its
+    rolling histogram, one character per bin from 1 us (left) to 10 s (right)"""
+    def report(self, histograms=True):
+        lines = ["%-24s %9s %9s %9s %9s %9s" % ("timer", "calls", "mean ms", "p50 ms", "p99 ms", "max ms")]
+        for name in sorted(self.timers):
+            summary = self.timers[name].summary()
+            if summary["mean_ms"] is None:
+                lines.append("%-24s %9d" % (name, summary["calls"]))
+                continue
+            lines.append("%-24s %9d %9.3f %9.3f %9.3f %9.3f" % (name, summary["calls"], summary["mean_ms"],
+                                                               summary["p50_ms"], summary["p99_ms"], summary["max_ms"]))
+            if histograms:
+                counts = self.timers[name].histogram()[0]
+                shades = " .:-=+*#%@"
+                top = max(1, counts.max())
+                bar = "".join(shades[int(np.ceil(c / top * (len(shades) - 1)))] for c in counts)
+                lines.append("    1us |" + bar + "| 10s")
+        if self.counters:
+            lines.append("")
+            lines.append("%-24s %9s" % ("counter", "total"))
+            for name in sorted(self.counters):
+                lines.append("%-24s %9d" % (name, self.counters[name]))
+        return "\n".join(lines)
+
+    """ Writes the report and every timer's histogram counts to path"""
+    def dump(self, path):
+        with open(path, "w") as file:
+            file.write("KARP profile, " + datetime.datetime.now().isoformat() + "\n\n")
+            file.write(self.report(histograms=False) + "\n\n")
+            file.write("histogram bin edges (s): " + " ".join("%.3g" % edge for edge in HISTOGRAM_EDGES) + "\n")
+            for name in sorted(self.timers):
+                counts = self.timers[name].histogram()[0]
+                file.write("%-24s " % name + " ".join(str(c) for c in counts) + "\n")
+
+
+""" The profiler shared by the engine and its clients, disabled until someone calls profiler.enable()"""
+profiler = Profiler()
+
+
+class LogBuffer:
+    """
+    The log the ports, the acquisition threads and the front ends print to. Call it with a message from any
+    thread; nothing here touches Tk. The latest `capacity` lines are kept in a ring (self.lines). A message that
+    repeats within `repeat_interval` s is only counted: the first one goes through, and once the interval is over a
+    single "<message> (×N)" line stands for the N repeats, so an unplugged instrument or a run of read timeouts
+    does not add a line per tick. Lines go to echo(line) as they are emitted (print, on the command line) and, given
+    a path, to a rotating log file of at most max_bytes with `backups` old files kept. The GUI collects the new
+    lines in batches with drain().
+    """
+    def __init__(self, capacity=2000, repeat_interval=5.0, echo=None, path=None, max_bytes=1000000, backups=3):
+        self.capacity = capacity
+        self.repeat_interval = repeat_interval
+        self.echo = echo
+        self.lines = deque(maxlen=capacity)
+        self._new = deque(maxlen=capacity)
+        self._repeats = {}
+        self._lock = threading.Lock()
+        self._file = None
+        if path is not None:
+            self._file = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+            self._file.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+
+    def __call__(self, message):
+        message = str(message)
+        now = time.monotonic()
+        with self._lock:
+            repeat = self._repeats.get(message)
+            if repeat is not None and now - repeat[1] < self.repeat_interval:
+                repeat[0] += 1
+                return
+            if repeat is not None and repeat[0]:
+                self._emit(message + " (×" + str(repeat[0] + 1) + ")")
+            else:
+                self._emit(message)
+            self._repeats[message] = [0, now]
+
+    """ Emits the repeat counts whose interval is over, and forgets messages that have gone quiet"""
+    def flush(self):
+        now = time.monotonic()
+        with self._lock:
+            for message, repeat in list(self._repeats.items()):
+                if now - repeat[1] < self.repeat_interval:
+                    continue
+                if repeat[0]:
+                    self._emit(message + " (×" + str(repeat[0]) + ")")
+                    self._repeats[message] = [0, now]
+                else:
+                    del self._repeats[message]
+
+    """ The lines emitted since the last call, oldest first (at most capacity of them)"""
+    def drain(self):
+        self.flush()
+        with self._lock:
+            lines = list(self._new)
+            self._new.clear()
+        return lines
+
+    def close(self):
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+
+    def _emit(self, line):
+        self.lines.append(line)
+        self._new.append(line)
+        if self.echo is not None:
+            self.echo(line)
+        if self._file is not None:
+            self._file.handle(logging.makeLogRecord({"msg": line}))
+
+
+class StartupTimer:
+    """
+    How long each stage of starting up took (imports, engine, window, plot...), for the startup report that goes
+    to the log, so a slow import or backend shows up as soon as it creeps in. mark(stage) closes the stage that
+    has been running since the previous mark (or since `started`, a time.perf_counter() value).
+    """
+    def __init__(self, started=None):
+        self.started = time.perf_counter() if started is None else started
+        self.stages = []
+        self._last = self.started
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.stages.append((stage, now - self._last))
+        self._last = now
+
+    @property
+    def total(self):
+        return self._last - self.started
+
+    def report(self):
+        return ("Startup: " + ", ".join(stage + " " + "%.3f s" % duration for stage, duration in self.stages) +
+                " (total %.3f s)" % self.total)
+
+
+class PortWatcher(threading.Thread):
+    """
+    A background thread which enumerates the serial ports so that the main loop never has to. The port list is
+    cached in self.ports / self.devices, and a change is only accepted once it has been seen on `debounce`
+    consecutive scans, so a flaky USB hub does not make the RP100 bounce. Accepted changes are pushed onto
+    self.events as (PortEvents, port_info) pairs for the GUI to drain.
+    """
+    def __init__(self, interval=0.25, debounce=2):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.debounce = debounce
+        self.ports = []
+        self.devices = frozenset()
+        self.events = queue.Queue()
+        self._candidate = None
+        self._candidate_count = 0
+        self._stop_event = threading.Event()
+
+    """ Does one scan straight away so the cache is valid before the first update(), then starts the thread"""
+    def start(self):
+        self._accept(comports(), announce=False)
+        super().start()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.scan()
+
+    def stop(self):
+        self._stop_event.set()
+
+    """ Enumerates the ports once and accepts the result if it has been stable for long enough"""
+    def scan(self):
+        try:
+            ports = comports()
+        except Exception:
+            return
+        devices = frozenset(port.device for port in ports)
+        if devices == self.devices:
+            self._candidate = None
+            self._candidate_count = 0
+            return
+        if devices != self._candidate:
+            self._candidate = devices
+            self._candidate_count = 0
+        self._candidate_count += 1
+        if self._candidate_count >= self.debounce:
+            self._accept(ports)
+
+    def _accept(self, ports, announce=True):
+        devices = frozenset(port.device for port in ports)
+        if announce:
+            for port in ports:
+                if port.device not in self.devices:
+                    self.events.put((PortEvents.APPEARED, port))
+            for port in self.ports:
+                if port.device not in devices:
+                    self.events.put((PortEvents.VANISHED, port))
+        # Assign fresh objects rather than mutating, so readers on other threads never see a half-built list
+        self.ports = list(ports)
+        self.devices = devices
+        self._candidate = None
+        self._candidate_count = 0
+
+    """ Returns the next pending event, or None if there is nothing new"""
+    def poll_event(self):
+        try:
+            return self.events.get_nowait()
+        except queue.Empty:
+            return None
+
+
+class VisaSessionPool:
+    """
+    Keeps one open VISA session per USB instrument, keyed by the serial number in its resource name, so that nothing
+    has to reopen a resource just to find out which instrument it is. refresh() relists the resources at most once
+    every list_interval seconds, and probe() checks an instrument's liveness at most once every probe_interval seconds.
+    A MonitoredUSB claim()s the instrument it connects to; anything else talking to an instrument holds its
+    io_lock() and leaves claimed ones alone, so two conversations never interleave on one session.
+    Without a manager the shared resource_manager() is used, created the first time the pool needs it.
+    """
+    def __init__(self, manager=None, list_interval=1.0, probe_interval=0.5):
+        self._manager = manager
+        self.list_interval = list_interval
+        self.probe_interval = probe_interval
+        self.resources = []
+        self._sessions = {}
+        self._alive = {}
+        self._last_list = None
+        self._last_probe = {}
+        self._claimed = set()
+        self._io_locks = {}
+        self._lock = threading.RLock()
+
+    @property
+    def _rm(self):
+        if self._manager is None:
+            self._manager = resource_manager()
+        return self._manager
+
+    """ Pulls the serial number out of a resource name like USB0::0x2A8D::0x2F01::MY12345678::0::INSTR"""
+    @staticmethod
+    def serial_of(resource_name):
+        parts = str(resource_name).split("::")
+        if len(parts) > 3:
+            return parts[3]
+        return None
+
+    """ Relists the USB resources if the cached list is stale, closing sessions whose instrument has gone"""
+    def refresh(self, force=False):
+        with self._lock:
+            now = time.monotonic()
+            if not force and self._last_list is not None and now - self._last_list < self.list_interval:
+                return self.resources
+            self._last_list = now
+            try:
+                resources = self._rm.list_resources()
+            except Exception:
+                resources = ()
+            resources = tuple(resources) + tuple(simulated_visa)
+            self.resources = [r for r in resources if str(r)[0:3] == "USB"]
+            present = set(self.serial_of(r) for r in self.resources)
+            for serial_number in list(self._sessions):
+                if serial_number not in present:
+                    self.discard(serial_number)
+            return self.resources
+
+    def serials(self):
+        return [self.serial_of(r) for r in self.resources]
+
+    """ The lock to hold while querying an instrument that is not claimed"""
+    def io_lock(self, serial_number):
+        with self._lock:
+            return self._io_locks.setdefault(serial_number, threading.Lock())
+
+    """ Marks an instrument as taken, waiting for any query made under its io_lock to finish first"""
+    def claim(self, serial_number):
+        with self.io_lock(serial_number):
+            self._claimed.add(serial_number)
+
+    def release(self, serial_number):
+        with self.io_lock(serial_number):
+            self._claimed.discard(serial_number)
+
+    def claimed(self, serial_number):
+        return serial_number in self._claimed
+
+    """ Returns the pooled session for an instrument, opening it the first time it is asked for"""
+    def session(self, serial_number):
+        with self._lock:
+            if serial_number in self._sessions:
+                return self._sessions[serial_number]
+            for resource in self.resources:
+                if self.serial_of(resource) == serial_number:
+                    return self.open(resource)
+            return None
+
+    """ Opens a resource by name (or returns the existing session for that instrument). The pool is not locked while
+    the resource opens, so a slow or hung instrument does not hold up the others"""
+    def open(self, resource_name):
+        serial_number = self.serial_of(resource_name)
+        with self._lock:
+            if serial_number in self._sessions:
+                return self._sessions[serial_number]
+        if resource_name in simulated_visa:
+            session = simulated_visa[resource_name]
+        else:
+            session = self._rm.open_resource(resource_name)
+        with self._lock:
+            serial_number = self.serial_of(session.resource_info.resource_name) or serial_number
+            if serial_number in self._sessions:
+                # opened twice at once, keep the first
+                if session is not self._sessions[serial_number]:
+                    try:
+                        session.close()
+                    except Exception:
+                        pass
+                return self._sessions[serial_number]
+            self._sessions[serial_number] = session
+            self._alive[serial_number] = True
+            self._last_probe[serial_number] = time.monotonic()
+            return session
+
+    """ Closes and forgets an instrument's session, e.g. once it has been unplugged"""
+    def discard(self, serial_number):
+        with self._lock:
+            session = self._sessions.pop(serial_number, None)
+            self._alive.pop(serial_number, None)
+            self._last_probe.pop(serial_number, None)
+            if session is not None:
+                try:
+                    session.close()
+                except Exception:
+                    pass
+
+    """ Cheap liveness check. Reads the status byte (a USBTMC control request, so it does not disturb any pending
+    query) at most once per probe_interval and returns the cached answer in between. The read happens under the
+    instrument's io_lock only, so a hung instrument does not hold up the pool"""
+    def probe(self, serial_number):
+        with self._lock:
+            session = self._sessions.get(serial_number)
+            if session is None:
+                return False
+            now = time.monotonic()
+            if now - self._last_probe.get(serial_number, 0) < self.probe_interval:
+                return self._alive[serial_number]
+            self._last_probe[serial_number] = now
+        with self.io_lock(serial_number):
+            try:
+                session.read_stb()
+                alive = True
+            except Exception:
+                alive = False
+        with self._lock:
+            # the session may have been discarded while it was being read
+            if self._sessions.get(serial_number) is session:
+                self._alive[serial_number] = alive
+        return alive
+
+visa_pool = VisaSessionPool()
+
+
+DiscoveredInstrument = namedtuple("DiscoveredInstrument", ["kind", "name", "description", "idn", "port_info"])
+
+
+class InstrumentDiscovery:
+    """
+    Finds the instruments that could be connected, for the port chooser and --list. The serial ports come from the
+    PortWatcher's list (no serial I/O: unknown devices are not sent *IDN?), the USB resources are relisted and each
+    one is opened through the VisaSessionPool and asked for its alias and *IDN?, all at once on a thread pool; an
+    instrument which has not answered within `timeout` seconds is listed without an answer. Listing the resources
+    is not held to that timeout, as the first listing also loads the VISA library. The answers are cached for `ttl`
+    seconds and instruments() returns the last list straight away, refresh() makes a new one in the background.
+    Instruments claimed in the pool are being polled and are not asked.
+    """
+    def __init__(self, watcher=None, pool=None, ttl=30.0, timeout=2.0, workers=8):
+        self.watcher = watcher
+        self.pool = pool if pool is not None else visa_pool
+        self.ttl = ttl
+        self.timeout = timeout
+        self._workers = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="discovery")
+        self._runner = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="discovery-run")
+        self._lock = threading.Lock()
+        self._instruments = []
+        self._answers = {}
+        self._refreshed = None
+        self._refresh = None
+
+    """ The last discovered list (empty before the first refresh), without any I/O"""
+    def instruments(self):
+        return list(self._instruments)
+
+    @property
+    def stale(self):
+        return self._refreshed is None or time.monotonic() - self._refreshed > self.ttl
+
+    """ Starts a discovery in the background, unless one is already running or (without force) the list is still
+    fresh. Returns a concurrent.futures.Future of the list"""
+    def refresh(self, force=False):
+        with self._lock:
+            if self._refresh is not None and not self._refresh.done():
+                return self._refresh
+            if not force and not self.stale:
+                future = concurrent.futures.Future()
+                future.set_result(self.instruments())
+                return future
+            self._refresh = self._runner.submit(self._discover)
+            return self._refresh
+
+    def close(self):
+        self._runner.shutdown(wait=False)
+        self._workers.shutdown(wait=False)
+
+    def _serial_ports(self):
+        if self.watcher is not None:
+            return list(self.watcher.ports)
+        return comports()
+
+    """ Opens a resource and asks for its alias and *IDN?, with the session's timeout cut down to ours. Holds the
+    instrument's io_lock throughout, and returns None for a claimed instrument"""
+    def _ask(self, resource):
+        serial_number = self.pool.serial_of(resource)
+        with self.pool.io_lock(serial_number):
+            if self.pool.claimed(serial_number):
+                return None
+            session = self.pool.open(resource)
+            description = session.resource_info.alias or session.resource_info.resource_name
+            timeout = session.timeout
+            session.timeout = self.timeout * 1000
+            try:
+                idn = session.query("*IDN?").strip()
+            finally:
+                session.timeout = timeout
+        return description, idn
+
+    def _discover(self):
+        serial_future = self._workers.submit(self._serial_ports)
+        visa_future = self._workers.submit(self.pool.refresh, True)
+        try:
+            resources = list(visa_future.result())
+        except Exception:
+            resources = list(self.pool.resources)
+        now = time.monotonic()
+        asked = {}
+        for resource in resources:
+            answer = self._answers.get(resource)
+            if self.pool.claimed(self.pool.serial_of(resource)) or (answer is not None and now - answer[2] < self.ttl):
+                continue
+            asked[resource] = self._workers.submit(self._ask, resource)
+        deadline = now + self.timeout
+        for resource, future in asked.items():
+            try:
+                answer = future.result(max(0.0, deadline - time.monotonic()))
+            except Exception:
+                continue
+            if answer is not None:
+                self._answers[resource] = answer + (time.monotonic(),)
+        try:
+            ports = serial_future.result(self.timeout)
+        except Exception:
+            ports = []
+        instruments = [DiscoveredInstrument("serial", port.device, str(port.description), None, port) for port in ports]
+        for resource in resources:
+            description, idn, _ = self._answers.get(resource, (resource, None, None))
+            instruments.append(DiscoveredInstrument("usb", resource, description, idn, None))
+        self._instruments = instruments
+        self._refreshed = time.monotonic()
+        return instruments
+
+
+class MonitoredSerial:
+    """ 
+    A class for serial connections, with some extra wrappers to release the port if the device is unplugged
+    or dropped, and grab it again when it reappears. Call update() about once every millisecond. 
+    Port presence comes from a PortWatcher, so update() itself never enumerates the ports.
+    """
+    def __init__(self, printer=None, print_io=False, print_conn=False, watcher=None):
+        if watcher is None:
+            watcher = PortWatcher()
+            watcher.start()
+        self._watcher = watcher
+        self.lock = threading.RLock()
+        self._pid = None
+        self._vid = None
+        self._serial_number = None
+        self._port = None
+        self._printer = printer
+        self._print_io = print_io
+        self._print_conn = print_conn
+        self.state = SerialStates.UNCONFIGURED
+        self.needs_reset = False
+
+    """ Used in choose_serial_port, takes the result of PortChooser as port_info, and attempts to open a serial connection"""
+    @synchronized
+    def connect(self, port_info):
+        try:
+            self._port = open_serial(port_info.device)
+        except Exception as e:
+            if self._printer is not None:
+                self._printer("Failed to open serial port: " + str(e))
+        else:
+            if not self._port.is_open:
+                self._port.open()
+            if self._print_conn:
+                self._printer("Opened serial port: " + port_info.description)
+            self._serial_number = port_info.serial_number
+            self._pid = port_info.pid
+            self._vid = port_info.vid
+            self.state = SerialStates.CONNECTED
+
+    """ Checks if the RP100 is still there"""
+    @synchronized
+    def update(self):
+        if self._port is not None:
+            if (self._port.name in self._watcher.devices) and not self.needs_reset:
+                # All is OK, the port is still there
+                self.state = SerialStates.CONNECTED
+                return False
+            else:
+                # Our port has vanished, or needs_reset has been set by something else
+                self._port.close()
+                self._port = None
+                if self._print_conn:
+                    self._printer("Lost connection to serial port")
+                self.state = SerialStates.DROPPED
+                time.sleep(0.05)
+                return True
+        else:
+            if self._serial_number is not None:
+                # Our port is missing. Look for it in the watcher's cached list
+                for port in self._watcher.ports:
+                    if port.serial_number == self._serial_number and port.vid == self._vid and port.pid == self._pid:
+                        try:
+                            self._port = open_serial(port.device)
+                            if not self._port.is_open:
+                                self._port.open()
+                            if self._print_conn:
+                                self._printer("Reopened serial port " + port.device)
+                            self.state = SerialStates.CONNECTED
+                            return True
+                        except:
+                            if self._printer is not None:
+                                self._printer("Failed to reopen serial port")
+                                time.sleep(0.1)
+            else:
+                # Not configured, so no change.
+                return False
+
+    """ Back-end command for disconnecting the RP100"""
+    @synchronized
+    def disconnect(self):
+        if self._print_conn:
+            self._printer("Manually disconnected RP100 from serial port")
+        self._port.close()
+        self._pid = None
+        self._vid = None
+        self._serial_number = None
+        self._port = None
+        self.state = SerialStates.UNCONFIGURED
+
+    """ Reads from the RP100 using readline(), otherwise prints errors to the printer"""
+    @synchronized
+    def read(self):
+        if self.state != SerialStates.CONNECTED:
+            return None
+        else:
+            try:
+                resp = self._port.readline()
+                if self._print_io:
+                    if resp.decode().strip() == "":
+                        self._printer("Timeout or empty line on serial read")
+            except Exception as e:
+                resp = b""
+                if self._print_io:
+                    self._printer("IO Error on Serial Read: " + str(e))
+                self.needs_reset = True
+            return resp
+
+    """ Writes to the RP100 using write(), otherwise prints errors to the printer"""
+    @synchronized
+    def write(self, message):
+        if self.state != SerialStates.CONNECTED:
+            pass
+        else:
+            try:
+                self._port.write(message)
+            except Exception as e:
+                if self._print_io:
+                    self._printer("IO Error on Serial Write: " + str(e))
+                self.needs_reset = True
+
+    """ Writes a query and reads its reply without letting another thread get a command in between"""
+    @synchronized
+    def query(self, message):
+        self.write(message)
+        return self.read()
+
+    """ Pipelined queries. Writes every message in one go, then reads the replies back in order, so a group of
+    readbacks costs roughly one round trip instead of one each. A reply without its newline means readline() timed
+    out and the framing can no longer be trusted, so the remaining replies come back as None and anything still in
+    flight is flushed before the next command"""
+    @synchronized
+    def query_batch(self, messages):
+        replies = []
+        if self.state != SerialStates.CONNECTED:
+            return [None] * len(messages)
+        self.write(b"".join(messages))
+        for i in range(len(messages)):
+            resp = self.read()
+            if resp is None or not resp.endswith(b"\n"):
+                self.resync()
+                break
+            replies.append(resp)
+        return replies + [None] * (len(messages) - len(replies))
+
+    """ Waits out any late replies and discards them, so the next reply read belongs to the next query"""
+    @synchronized
+    def resync(self):
+        if self._port is None:
+            return
+        try:
+            time.sleep(self._port.timeout or 0)
+            self._port.reset_input_buffer()
+        except Exception as e:
+            if self._print_io:
+                self._printer("IO Error on Serial Resync: " + str(e))
+            self.needs_reset = True
+
+class MonitoredUSB:
+    """ 
+    A class for USB connections, with some extra wrappers to release the port if the device is unplugged
+    or dropped, and grab it again when it reappears. Call update() about once every millisecond. 
+    Sessions come from a VisaSessionPool, so each instrument is only ever opened once, and the instrument is
+    claimed there while connected.
+    """
+    def __init__(self, printer=None, print_io=False, print_conn=False, pool=None):
+        self._pool = pool if pool is not None else visa_pool
+        self.lock = threading.RLock()
+        self.capture = None
+        self.capture_report_interval = 10.0
+        self._capture_totals = [0, 0.0]
+        self._last_capture_report = None
+        self._alias = None
+        self._name = None
+        self._serial_number = None
+        self._port = None
+        self._printer = printer
+        self._print_io = print_io
+        self._print_conn = print_conn
+        self.state = USBStates.UNCONFIGURED
+        self.needs_reset = False
+
+    @property
+    def serial_number(self):
+        return self._serial_number
+
+    """ Used in choose_usb_port, takes the result of PortChooser as port_info, and attempts to open a USB connection"""
+    @synchronized
+    def connect(self, port_info):
+        try:
+            self._port = self._pool.open(port_info)
+        except Exception as e:
+            if self._printer is not None:
+                self._printer("Failed to open serial port: " + str(e))
+        else:
+            if self._serial_number is not None:
+                self._pool.release(self._serial_number)
+            self._alias = self._port.resource_info.alias
+            self._name = self._port.resource_info.resource_name
+            self._serial_number = self._pool.serial_of(self._name)
+            self._pool.claim(self._serial_number)
+            if self._print_conn:
+                self._printer("Opened port: " + str(self._alias or self._name))
+            self.needs_reset = False
+            self.state = USBStates.CONNECTED
+            
+
+    """ Checks if the Keysight is still there """
+    @synchronized
+    def update(self):
+        if self._port is not None:
+            if self._pool.probe(self._serial_number) and not self.needs_reset:
+                # All is OK, the port is still there
+                self.state = USBStates.CONNECTED
+                return False
+            else:
+                # Our port has vanished, or needs_reset has been set by something else
+                self._pool.discard(self._serial_number)
+                self._port = None
+                if self._print_conn:
+                    self._printer("Lost connection to USB port")
+                self.state = USBStates.DROPPED
+                time.sleep(0.05)
+                return True
+        else:
+            if self._serial_number is not None:
+                # Our port is missing. Look for it in the (rate limited) resource listing
+                self._pool.refresh()
+                if self._serial_number in self._pool.serials():
+                    try:
+                        self._port = self._pool.session(self._serial_number)
+                    except Exception:
+                        self._port = None
+                    if self._port is not None:
+                        if self._print_conn:
+                            self._printer("Reopened port " + str(self._name))
+                        self.needs_reset = False
+                        self.state = USBStates.CONNECTED
+                        return True
+                if self._printer is not None:
+                    self._printer("Failed to find USB port")
+                    time.sleep(0.1)
+            else:
+                # Not configured, so no change.
+                return False
+
+    """ Back-end command for disconnecting the Keysight"""
+    @synchronized
+    def disconnect(self):
+        if self._print_conn:
+            self._printer("Manually disconnected Keysight from USB port")
+        if self._serial_number is not None:
+            self._pool.release(self._serial_number)
+        self._serial_number = None
+        self._port = None
+        self._alias = None
+        self._name = None
+        self.state = USBStates.UNCONFIGURED
+        
+    
+    """ Reads from the Keysight using read(), otherwise prints errors to the printer"""
+    @synchronized
+    def read(self):
+        if self.state != USBStates.CONNECTED:
+            return None
+        else:
+            try:
+                resp = self._port.read()
+                if self._print_io:
+                    if resp == "":
+                        self._printer("Timeout or empty line on read")
+            except Exception as e:
+                resp = ""
+                if self._print_io:
+                    self._printer("IO Error on USB Read: " + str(e))
+                self.needs_reset = True
+            return resp
+    
+    """ Writes to the Keysight using write(), otherwise prints errors to the printer"""
+    @synchronized
+    def write(self, message):
+        if self.state != USBStates.CONNECTED:
+            pass
+        else:
+            try:
+                
+                self._port.write(message)
+            except Exception as e:
+                if self._print_io:
+                    self._printer("IO Error on USB Write: " + str(e))
+                self.needs_reset = True
+
+    """ Writes a query and reads its reply without letting another thread get a command in between"""
+    @synchronized
+    def query(self, message):
+        self.write(message)
+        return self.read()
+
+    """ Puts the E4980AL into buffered capture. It triggers itself (INT) or on *TRG (BUS), stores each reading in
+    its data buffer memory (up to 201 readings) and read_capture() then pulls the whole buffer in one transfer,
+    as big-endian float64 when binary is set"""
+    @synchronized
+    def start_capture(self, size=201, trigger="INT", binary=True):
+        if binary:
+            self.write(":FORM:DATA REAL,64")
+            self.write(":FORM:BORD NORM")
+        else:
+            self.write(":FORM:DATA ASC")
+        self.write(":TRIG:SOUR " + trigger)
+        self.write(":MEM:DIM DBUF," + str(int(size)))
+        self.write(":MEM:CLE DBUF")
+        self.write(":MEM:FILL DBUF")
+        self.write(":INIT:CONT ON")
+        self.capture = {"size": int(size), "trigger": trigger, "binary": binary}
+        self._capture_totals = [0, 0.0]
+        self._last_capture_report = time.perf_counter()
+
+    """ Leaves buffered capture and goes back to the ASCII, internally triggered setup :FETCh expects"""
+    @synchronized
+    def stop_capture(self):
+        self.write(":MEM:CLE DBUF")
+        self.write(":FORM:DATA ASC")
+        self.write(":TRIG:SOUR INT")
+        self.capture = None
+
+    """ Sends a bus trigger, only needed when capturing with trigger="BUS" """
+    @synchronized
+    def trigger(self):
+        self.write("*TRG")
+
+    """ Reads the data buffer in one go and restarts it. Returns an (n, 3) array of data A, data B and status, with
+    the empty slots (status -1) dropped. A transfer that fails or does not come back as whole readings is dropped,
+    and the port is reset"""
+    @synchronized
+    def read_capture(self):
+        empty = np.empty((0, 3))
+        if self.state != USBStates.CONNECTED or self.capture is None:
+            return empty
+        started = time.perf_counter()
+        try:
+            if self.capture["binary"]:
+                data = self._port.query_binary_values(":MEM:READ? DBUF", datatype="d", is_big_endian=True, container=np.array)
+            else:
+                data = self._port.query_ascii_values(":MEM:READ? DBUF", container=np.array)
+            self._port.write(":MEM:CLE DBUF")
+            self._port.write(":MEM:FILL DBUF")
+            block = np.asarray(data, dtype=float).reshape(-1, 4)
+        except Exception as e:
+            if self._print_io:
+                self._printer("IO Error on USB Buffer Read: " + str(e))
+            self.needs_reset = True
+            return empty
+        block = block[block[:, 2] != -1, :3]
+        if len(block) >= self.capture["size"] and self._printer is not None:
+            self._printer("E4980AL buffer filled up between reads, later readings were lost")
+        self._report_capture(len(block), time.perf_counter() - started)
+        return block
+
+    """ Periodic timing summary of the buffered transfers, in place of a print per reading"""
+    def _report_capture(self, readings, elapsed):
+        self._capture_totals[0] += readings
+        self._capture_totals[1] += elapsed
+        now = time.perf_counter()
+        if self._printer is None or now - self._last_capture_report < self.capture_report_interval:
+            return
+        readings, transfer_time = self._capture_totals
+        span = now - self._last_capture_report
+        self._printer("E4980AL buffer: " + str(readings) + " readings in " + str(round(span, 1)) + " s (" +
+                      str(round(readings / span, 1)) + " readings/s), " + str(round(transfer_time * 1000, 1)) +
+                      " ms spent transferring")
+        self._capture_totals = [0, 0.0]
+        self._last_capture_report = now
+
+
+""" Typed messages published by the AcquisitionEngine. rp100 holds the six RP100 readbacks in the order of
+AcquisitionEngine.RP100_READBACK and keysight the three values of :FETCh:IMPedance:FORMatted?; either is None when
+that instrument is not connected. station is the index of the AcquisitionEngine (and so of the RP100 / E4980AL
+pair) that read it, see PropertyRegistry."""
+""" time is wall-clock (time.time()); rp100_ns / keysight_ns are time.perf_counter_ns() stamps of the moment each
+instrument answered (the midpoint of its request/response), None when that instrument was not read. step is the
+index of the sweep step the sample was averaged into (see Sequence), None outside a step's averaging window"""
+Sample = namedtuple("Sample", ["time", "rp100", "keysight", "rp100_ns", "keysight_ns", "step", "station"], defaults=(None, None, None, 0))
+ConnectionEvent = namedtuple("ConnectionEvent", ["instrument", "state"])
+
+
+class AcquisitionEngine(threading.Thread):
+    """
+    Owns the instrument I/O. Runs on its own thread, checks the connections and reads the instruments once every
+    `period` seconds, and appends Sample / ConnectionEvent tuples to self.samples / self.events. Those are plain
+    deques: append() and popleft() are atomic, so the GUI can drain them at its own pace without taking a lock.
+    With several stations (see PropertyRegistry) each has its own AcquisitionEngine, so the pairs poll concurrently;
+    names are the instrument names used in ConnectionEvents and readback the RP100 commands polled each tick.
+    """
+    RP100_READBACK = [b"SOUR1:VOLT:NOW", b"MEAS1:VOLT", b"MEAS1:CURR", b"SOUR2:VOLT:NOW", b"MEAS2:VOLT", b"MEAS2:CURR"]
+    KEYSIGHT_FETCH = ":FETCh:IMPedance:FORMatted?"
+    FIRST_BLOCK_INTERVAL = 0.1 # s, the first read of a capture, which times the readings
+
+    def __init__(self, serial_port, usb_port, period=0.01, block_interval=1.0, station=0, names=("RP100", "E4980AL"),
+                 readback=None):
+        super().__init__(daemon=True)
+        self.serial_port = serial_port
+        self.usb_port = usb_port
+        self.station = station
+        self.names = names
+        if readback is not None:
+            self.RP100_READBACK = list(readback)
+        self.period = period
+        self.block_interval = block_interval
+        self.overflows = 0 # capture buffers that filled up between reads
+        self._capture = None
+        self._last_block = None
+        self._reading_time = None
+        self._block_wait = block_interval
+        self._last_rp100 = (None, None)
+        self._rp100_history = []
+        self.samples = deque()
+        self.events = deque()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        next_tick = time.perf_counter()
+        while not self._stop_event.is_set():
+            self.tick()
+            next_tick += self.period
+            delay = next_tick - time.perf_counter()
+            if delay > 0:
+                self._stop_event.wait(delay)
+            else:
+                # Fell behind (slow instrument or a reconnect), start a fresh schedule rather than bursting
+                next_tick = time.perf_counter()
+
+    def stop(self):
+        self._stop_event.set()
+
+    """ One acquisition cycle: connection checks, then one reading from each connected instrument. Returns the number
+    of Samples published (a whole block of them in buffered mode)"""
+    def tick(self):
+        if self.serial_port.update():
+            self.events.append(ConnectionEvent(self.names[0], self.serial_port.state))
+        if self.usb_port.update():
+            self.events.append(ConnectionEvent(self.names[1], self.usb_port.state))
+        rp100 = rp100_ns = None
+        keysight = keysight_ns = None
+        if self.serial_port.state == SerialStates.CONNECTED:
+            rp100, rp100_ns = self.read_rp100()
+        self._last_rp100 = (rp100, rp100_ns)
+        if self.usb_port.state == USBStates.CONNECTED:
+            if self.usb_port.capture is not None:
+                if rp100 is not None:
+                    self._rp100_history.append(self._last_rp100)
+                return self.read_keysight_block()
+            keysight, keysight_ns = self.read_keysight()
+        if rp100 is not None or keysight is not None:
+            self.samples.append(Sample(time.time(), rp100, keysight, rp100_ns, keysight_ns, station=self.station))
+            return 1
+        return 0
+
+    """ Reads the RP100 readback. Returns (readings, perf_counter_ns stamp at the middle of the exchange)"""
+    def read_rp100(self):
+        started = time.perf_counter_ns()
+        replies = self.serial_port.query_batch([command + b"?\n" for command in self.RP100_READBACK])
+        stamp = (started + time.perf_counter_ns()) // 2
+        return tuple(parse_float(resp) for resp in replies), stamp
+
+    """ Fetches one E4980AL reading. Returns (reading or None, perf_counter_ns stamp at the middle of the exchange)"""
+    def read_keysight(self):
+        started = time.perf_counter_ns()
+        resp = self.usb_port.query(self.KEYSIGHT_FETCH)
+        stamp = (started + time.perf_counter_ns()) // 2
+        if not resp:
+            return None, stamp
+        return tuple(parse_float(value) for value in resp.strip().split(",")), stamp
+
+    """ Buffered Keysight mode. The E4980AL's buffer is read in one transfer and each reading becomes a Sample,
+    spread evenly over the time since the last block (wall clock and perf_counter_ns alike) and paired with the last
+    RP100 readback taken before it (and that readback's own stamp). The time per reading is measured from each
+    block, the first being read after FIRST_BLOCK_INTERVAL, and the next read comes once half the buffer should be
+    full, or after block_interval if that is sooner. A buffer found full has stopped taking readings somewhere in
+    the interval, so it is counted in overflows and its readings are spaced by the time per reading instead.
+    Returns the number of Samples published"""
+    def read_keysight_block(self):
+        capture = self.usb_port.capture
+        if capture is None:
+            return 0
+        if capture["trigger"] == "BUS":
+            self.usb_port.trigger()
+        now = time.time()
+        now_ns = time.perf_counter_ns()
+        if self._last_block is None or capture is not self._capture:
+            self._capture = capture
+            self._last_block = (now, now_ns)
+            self._reading_time = None
+            self._block_wait = min(self.block_interval, self.FIRST_BLOCK_INTERVAL)
+        elapsed = now - self._last_block[0]
+        if elapsed < self._block_wait:
+            return 0
+        block = self.usb_port.read_capture()
+        covered = 1.0
+        if len(block) >= capture["size"]:
+            self.overflows += 1
+            # at least len(block) readings were taken, so a reading takes elapsed / len(block) at most
+            self._reading_time = min(self._reading_time or elapsed, elapsed / len(block))
+            covered = self._reading_time * len(block) / elapsed
+        elif len(block):
+            self._reading_time = elapsed / len(block)
+        if self._reading_time is not None:
+            self._block_wait = min(self.block_interval, self._reading_time * capture["size"] / 2)
+        steps = np.arange(1, len(block) + 1) * (covered / max(len(block), 1))
+        times = self._last_block[0] + elapsed * steps
+        stamps = self._last_block[1] + ((now_ns - self._last_block[1]) * steps).astype(np.int64)
+        self._last_block = (now, now_ns)
+        history = self._rp100_history or [self._last_rp100]
+        history_ns = np.array([-1 if rp100_ns is None else rp100_ns for _, rp100_ns in history], dtype=np.int64)
+        picks = np.maximum(np.searchsorted(history_ns, stamps, side="right") - 1, 0)
+        for t, stamp, reading, pick in zip(times, stamps, block, picks):
+            rp100, rp100_ns = history[pick]
+            self.samples.append(Sample(t, rp100, tuple(reading), rp100_ns, int(stamp), station=self.station))
+        self._rp100_history = history[-1:]
+        return len(block)
+
+    """ Pops everything published so far. Only ever called from one consumer thread"""
+    def drain_samples(self):
+        drained = []
+        while self.samples:
+            drained.append(self.samples.popleft())
+        return drained
+
+    def drain_events(self):
+        drained = []
+        while self.events:
+            drained.append(self.events.popleft())
+        return drained
+
+
+
+class AsyncTransport:
+    """
+    Awaitable front end to a MonitoredSerial or MonitoredUSB. pyserial and pyvisa only block, so every call runs on
+    the transport's own worker thread and is awaited from the event loop; two transports therefore overlap, and one
+    instrument's timeout no longer holds up the other. Each request has a timeout (default_timeout unless given):
+    when it runs out the awaiting caller gets asyncio.TimeoutError straight away, a request that had not started
+    yet is cancelled, and one already on the wire is left to finish on the worker (so the instrument's framing
+    stays intact) with `busy` set until it does. Cancelling the awaiting task behaves the same way.
+    """
+    def __init__(self, port, name, default_timeout=1.0):
+        self.port = port
+        self.name = name
+        self.default_timeout = default_timeout
+        self.timeouts = 0
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+        self._in_flight = None
+
+    """ True while an earlier request (e.g. one that timed out) is still running on the worker"""
+    @property
+    def busy(self):
+        return self._in_flight is not None and not self._in_flight.done()
+
+    async def call(self, function, *args, timeout=None):
+        future = self._executor.submit(function, *args)
+        self._in_flight = future
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.default_timeout if timeout is None else timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+
+    async def query(self, message, timeout=None):
+        return await self.call(self.port.query, message, timeout=timeout)
+
+    async def write(self, message, timeout=None):
+        return await self.call(self.port.write, message, timeout=timeout)
+
+    async def read(self, timeout=None):
+        return await self.call(self.port.read, timeout=timeout)
+
+    """ The reconnect check, see MonitoredSerial.update / MonitoredUSB.update"""
+    async def update(self, timeout=None):
+        return await self.call(self.port.update, timeout=timeout)
+
+    """ Cancels whatever has not started and lets the worker thread go"""
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class AsyncAcquisitionEngine(AcquisitionEngine):
+    """
+    AcquisitionEngine on asyncio. Same schedule, same Samples and ConnectionEvents, but each tick runs on an event
+    loop owned by this thread: both reconnect checks run at once, then the RP100 readback and the Keysight fetch
+    run at once, each through its AsyncTransport with its own timeout. An instrument that timed out (or is still
+    busy with a request that did) is simply left out of that tick's Sample. The transports are self.rp100 and
+    self.keysight, for awaiting extra queries from the loop (see call_soon()). The loop runs for as long as the
+    thread does, the ticks being one task on it, so whatever call_soon() queues runs alongside them. An I/O error
+    that gets past the port wrappers is passed to printer and that instrument left out of the tick.
+    """
+    def __init__(self, serial_port, usb_port, period=0.01, block_interval=1.0, rp100_timeout=0.5, keysight_timeout=1.0,
+                 printer=None, **options):
+        super().__init__(serial_port, usb_port, period=period, block_interval=block_interval, **options)
+        self.rp100 = AsyncTransport(serial_port, self.names[0], rp100_timeout)
+        self.keysight = AsyncTransport(usb_port, self.names[1], keysight_timeout)
+        self.printer = printer
+        self.loop = asyncio.new_event_loop()
+        self._accepting = True
+        self._accepting_lock = threading.Lock()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._run())
+        finally:
+            with self._accepting_lock:
+                self._accepting = False
+            # let anything call_soon() queued start, then cancel it, so no caller is left waiting on its future
+            self.loop.run_until_complete(asyncio.sleep(0))
+            pending = asyncio.all_tasks(self.loop)
+            for task in pending:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            self.rp100.close()
+            self.keysight.close()
+            self.loop.close()
+
+    """ The schedule of AcquisitionEngine.run, awaiting between ticks so the loop stays free for call_soon()"""
+    async def _run(self):
+        next_tick = time.perf_counter()
+        while not self._stop_event.is_set():
+            if profiler.enabled:
+                started = time.perf_counter()
+                published = await self._tick()
+                profiler.timer("acquisition.tick").add(time.perf_counter() - started)
+                profiler.count("samples acquired", published)
+            else:
+                await self._tick()
+            next_tick += self.period
+            delay = next_tick - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                next_tick = time.perf_counter()
+                await asyncio.sleep(0)
+
+    """ Runs a coroutine on the acquisition loop, from any thread. Returns a concurrent.futures.Future, e.g.
+    engine.acquisition.call_soon(engine.acquisition.rp100.query(b"SYST:ERR?\n")).result(); the future is cancelled
+    if the engine stops first, and once it has stopped call_soon() raises RuntimeError"""
+    def call_soon(self, coroutine):
+        with self._accepting_lock:
+            if not self._accepting or self._stop_event.is_set():
+                coroutine.close()
+                raise RuntimeError("The acquisition engine has stopped")
+            return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    """ One tick, for use while the thread is not running. Returns the number of Samples published"""
+    def tick(self):
+        return self.loop.run_until_complete(self._tick())
+
+    """ Awaits one transport call, turning a timeout or I/O failure into None"""
+    async def _guarded(self, transport, function, *args):
+        if transport.busy:
+            return None
+        try:
+            return await transport.call(function, *args)
+        except asyncio.TimeoutError:
+            return None
+        except Exception as e:
+            if self.printer is not None:
+                self.printer(transport.name + ": " + str(e))
+            return None
+
+    async def _tick(self):
+        serial_changed, usb_changed = await asyncio.gather(self._guarded(self.rp100, self.serial_port.update),
+                                                           self._guarded(self.keysight, self.usb_port.update))
+        if serial_changed:
+            self.events.append(ConnectionEvent(self.names[0], self.serial_port.state))
+        if usb_changed:
+            self.events.append(ConnectionEvent(self.names[1], self.usb_port.state))
+        rp100_ready = self.serial_port.state == SerialStates.CONNECTED
+        keysight_ready = self.usb_port.state == USBStates.CONNECTED
+        if keysight_ready and self.usb_port.capture is not None:
+            # buffered mode: the readback goes into the history the block is paired against, so it comes first
+            rp100 = await self._guarded(self.rp100, self.read_rp100) if rp100_ready else None
+            self._last_rp100 = rp100 if rp100 is not None else (None, None)
+            if rp100 is not None and rp100[0] is not None:
+                self._rp100_history.append(self._last_rp100)
+            return await self._guarded(self.keysight, self.read_keysight_block) or 0
+        rp100, keysight = await asyncio.gather(
+            self._guarded(self.rp100, self.read_rp100) if rp100_ready else self._nothing(),
+            self._guarded(self.keysight, self.read_keysight) if keysight_ready else self._nothing())
+        rp100, rp100_ns = rp100 if rp100 is not None else (None, None)
+        keysight, keysight_ns = keysight if keysight is not None else (None, None)
+        self._last_rp100 = (rp100, rp100_ns)
+        if rp100 is not None or keysight is not None:
+            self.samples.append(Sample(time.time(), rp100, keysight, rp100_ns, keysight_ns, station=self.station))
+            return 1
+        return 0
+
+    async def _nothing(self):
+        return None
+
+
+class CsvSink:
+    """ Record sink writing a header row and then plain CSV rows. Attributes have nowhere to go in a CSV, so they are dropped"""
+    extension = ".csv"
+
+    def __init__(self, path, labels, attrs=None):
+        self.path = path
+        self.labels = labels
+        self._file = None
+
+    def open(self):
+        self._file = open(self.path, 'w', newline='')
+        csv.writer(self._file).writerow(self.labels)
+        self._file.flush()
+
+    """ Formats the whole block first and hands it to the file in one write, so the file only ever holds whole rows"""
+    def write_rows(self, rows):
+        chunk = io.StringIO()
+        csv.writer(chunk).writerows(rows)
+        self._file.write(chunk.getvalue())
+
+    def flush(self):
+        self._file.flush()
+
+    def fsync(self):
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+    """ Reads a file written by a CsvSink back in blocks of rows, leaving out a last row cut short by a crash"""
+    @staticmethod
+    def read_blocks(path, chunk_rows=65536):
+        with open(path, newline='') as file:
+            file.readline()
+            block = []
+            for line in file:
+                if not line.endswith("\n"):
+                    break
+                block.append([float(value) for value in line.rstrip("\r\n").split(",")])
+                if len(block) >= chunk_rows:
+                    yield block
+                    block = []
+            if block:
+                yield block
+
+    """ Cuts off a last row left half-written by a crash, so the file can be used as it is"""
+    @staticmethod
+    def repair(path):
+        with open(path, 'rb+') as file:
+            end = file.seek(0, os.SEEK_END)
+            position = end
+            while position > 0:
+                start = max(0, position - 65536)
+                file.seek(start)
+                newline = file.read(position - start).rfind(b"\n")
+                if newline >= 0:
+                    if start + newline + 1 < end:
+                        file.truncate(start + newline + 1)
+                    return
+                position = start
+
+
+class Hdf5Sink:
+    """
+    Record sink writing an HDF5 file with a fixed schema: one appendable (n, len(labels)) float64 dataset called
+    "data", chunked by chunk_rows and optionally compressed ("gzip", "lzf"...), with the column labels in its
+    "columns" attribute and per-session metadata (*IDN? strings, start time...) as file attributes.
+    Read it back with load_recording().
+    """
+    extension = ".h5"
+
+    def __init__(self, path, labels, attrs=None, compression=None, chunk_rows=1024):
+        if not HDF5_AVAILABLE:
+            raise RuntimeError("HDF5 recording needs the h5py package")
+        self.path = path
+        self.labels = labels
+        self.attrs = attrs or {}
+        self.compression = compression
+        self.chunk_rows = chunk_rows
+        self._file = None
+        self._dataset = None
+
+    def open(self):
+        import h5py
+        self._file = h5py.File(self.path, 'w')
+        self._dataset = self._file.create_dataset("data", shape=(0, len(self.labels)), maxshape=(None, len(self.labels)),
+                                                  dtype="f8", chunks=(self.chunk_rows, len(self.labels)),
+                                                  compression=self.compression)
+        self._dataset.attrs["columns"] = np.array([str(label) for label in self.labels], dtype=h5py.string_dtype())
+        for key, value in self.attrs.items():
+            self._file.attrs[key] = value
+        self._file.flush()
+
+    def write_rows(self, rows):
+        rows = np.asarray(rows, dtype="f8")
+        n = self._dataset.shape[0]
+        self._dataset.resize(n + len(rows), axis=0)
+        self._dataset[n:] = rows
+
+    def flush(self):
+        self._file.flush()
+
+    def fsync(self):
+        self._file.flush()
+        os.fsync(self._file.id.get_vfd_handle())
+
+    def close(self):
+        self._file.close()
+
+
+
+""" Record sinks by the name shown in the GUI's format box"""
+RECORD_FORMATS = {"CSV": CsvSink, "HDF5": Hdf5Sink}
+
+
+def _column_labels(dataset):
+    return [label.decode() if isinstance(label, bytes) else str(label) for label in dataset.attrs["columns"]]
+
+
+def load_recording(path):
+    """
+    Loads a recording and returns (data, columns, attrs). An HDF5 recording takes a single NumPy read: an
+    uncompressed contiguous dataset is memory-mapped straight from the file; chunked ones (everything written by
+    Hdf5Sink, since appending needs chunks) are read in one call. A CSV recording has no attributes.
+    """
+    if path.endswith(CsvSink.extension):
+        with open(path, newline='') as file:
+            columns = next(csv.reader(file))
+        data = np.loadtxt(path, delimiter=",", skiprows=1, ndmin=2)
+        return data, columns, {}
+    import h5py
+    with h5py.File(path, 'r') as file:
+        dataset = file["data"]
+        columns = _column_labels(dataset)
+        attrs = dict(file.attrs)
+        offset = dataset.id.get_offset()
+        if dataset.chunks is None and dataset.compression is None and offset is not None:
+            data = np.memmap(path, dtype=dataset.dtype, mode='r', offset=offset, shape=dataset.shape)
+        else:
+            data = dataset[()]
+    return data, columns, attrs
+
+
+def export_csv(path, csv_path=None, chunk_rows=65536):
+    """ Converts an HDF5 recording to CSV, a block at a time so it works on files bigger than memory. Without
+    csv_path the CSV goes next to it under the same name ("name (2).csv" and so on if that is taken). Returns the
+    CSV's path"""
+    import h5py
+    if csv_path is None:
+        csv_path = _unique_path(os.path.splitext(path)[0] + CsvSink.extension)
+    with h5py.File(path, 'r') as file, open(csv_path, 'w', newline='') as out:
+        dataset = file["data"]
+        writer = csv.writer(out)
+        writer.writerow(_column_labels(dataset))
+        for start in range(0, dataset.shape[0], chunk_rows):
+            writer.writerows(dataset[start:start + chunk_rows])
+    return csv_path
+
+
+def save_recording(path, data, columns, attrs=None):
+    """ Writes a whole array as a recording, in the format given by the extension of path"""
+    for sink_class in RECORD_FORMATS.values():
+        if path.endswith(sink_class.extension):
+            break
+    else:
+        raise ValueError("Unknown recording format: " + path)
+    sink = sink_class(path, columns, attrs)
+    sink.open()
+    try:
+        if len(data):
+            sink.write_rows(data)
+    finally:
+        sink.close()
+
+
+def align_recording(data, columns, period=None):
+    """
+    Puts both instruments of a recording on a common time base, using the per-instrument stamps in
+    "RP100 Time (s)" and "Keysight Time (s)". With period None the time base is the Keysight stamps and the RP100
+    columns are linearly interpolated to the moment of each Keysight reading (the C-vs-V view); with a period in
+    s both instruments are resampled onto a uniform grid over the span where both were read. The stamp and
+    "Time (s)" columns of the result all hold the common time base. Returns the new array.
+    """
+    data = np.asarray(data, dtype=float)
+    index = {label: i for i, label in enumerate(columns)}
+    if "RP100 Time (s)" not in index or "Keysight Time (s)" not in index:
+        raise ValueError("The recording has no per-instrument timestamps to align on")
+    groups = [(index["RP100 Time (s)"], [index[label] for label in RP100_COLUMNS if label in index]),
+              (index["Keysight Time (s)"], [index[label] for label in KEYSIGHT_COLUMNS if label in index])]
+    sources = []
+    for stamp_column, value_columns in groups:
+        stamps = data[:, stamp_column]
+        keep = ~np.isnan(stamps)
+        # buffered readings all share the last RP100 stamp, interpolation needs each stamp once
+        stamps, first = np.unique(stamps[keep], return_index=True)
+        sources.append((stamps, data[keep][first], value_columns))
+    if period is None:
+        base = sources[1][0]
+    else:
+        start = max((stamps[0] for stamps, _, _ in sources if len(stamps)), default=0.0)
+        stop = min((stamps[-1] for stamps, _, _ in sources if len(stamps)), default=0.0)
+        base = np.arange(start, stop, period) if stop > start else np.empty(0)
+    aligned = np.full((len(base), data.shape[1]), np.nan)
+    for stamps, values, value_columns in sources:
+        for column in value_columns:
+            if len(stamps):
+                aligned[:, column] = np.interp(base, stamps, values[:, column], left=np.nan, right=np.nan)
+    for label in ("Time (s)", "RP100 Time (s)", "Keysight Time (s)"):
+        aligned[:, index[label]] = base
+    return aligned
+
+
+def write_aligned(path, period=None):
+    """ Saves an aligned copy of the recording at path (see align_recording) next to it. Returns the copy's path"""
+    data, columns, attrs = load_recording(path)
+    base, extension = os.path.splitext(path)
+    aligned_path = base + " aligned" + extension
+    attrs = dict(attrs)
+    attrs["aligned_on"] = "Keysight readings" if period is None else "uniform grid, %g s" % period
+    save_recording(aligned_path, align_recording(data, columns, period), columns, attrs)
+    return aligned_path
+
+
+
+
+class RecordWriter(threading.Thread):
+    """
+    Streams recorded rows to a record sink (CsvSink, Hdf5Sink) from its own thread, so memory use stays flat
+    however long the run is. Rows queued with write() are handed to the sink in blocks of up to chunk_size, so the
+    file always holds whole rows. The sink is flushed every flush_interval seconds and fsync'd every fsync_interval
+    seconds (None to leave syncing to the OS); after each fsync on_sync is called, from the writer thread, with the
+    number of rows now safely on disk.
+    """
+    def __init__(self, sink, chunk_size=256, flush_interval=1.0, fsync_interval=10.0, on_sync=None):
+        super().__init__(daemon=True)
+        self.sink = sink
+        self.path = sink.path
+        self.chunk_size = chunk_size
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.on_sync = on_sync
+        self.rows_written = 0
+        self._rows = deque()
+        self._stop_event = threading.Event()
+
+    """ Queues one row. Never blocks, safe to call from the GUI thread"""
+    def write(self, row):
+        self._rows.append(row)
+
+    def run(self):
+        self.sink.open()
+        try:
+            last_fsync = time.monotonic()
+            while True:
+                stopping = self._stop_event.wait(self.flush_interval)
+                while self._rows:
+                    self._write_chunk()
+                self.sink.flush()
+                if self.fsync_interval is not None and (stopping or time.monotonic() - last_fsync >= self.fsync_interval):
+                    self.sink.fsync()
+                    last_fsync = time.monotonic()
+                    if self.on_sync is not None:
+                        self.on_sync(self.rows_written)
+                if stopping:
+                    break
+        finally:
+            self.sink.close()
+
+    def _write_chunk(self):
+        chunk = []
+        while self._rows and len(chunk) < self.chunk_size:
+            chunk.append(self._rows.popleft())
+        self.sink.write_rows(chunk)
+        self.rows_written += len(chunk)
+
+    """ Writes out whatever is still queued, syncs and closes the file"""
+    def close(self):
+        self._stop_event.set()
+        self.join()
+
+
+def _unique_path(path):
+    """ path, or "<path> (2)", "<path> (3)"... (before the extension) if it is taken"""
+    base, extension = os.path.splitext(path)
+    n = 1
+    while os.path.exists(path):
+        n += 1
+        path = base + " (" + str(n) + ")" + extension
+    return path
+
+
+def _lock_file(file):
+    """ Takes an exclusive lock on an open file without waiting. False if another open file holds it. The OS lets go
+    of it when the process ends, however it ends"""
+    try:
+        if os.name == "nt":
+            import msvcrt
+            file.seek(0)
+            msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return False
+    return True
+
+
+class RecordingSession:
+    """
+    A recording while it is being made, kept in a directory of its own under `root` so that a crash leaves
+    something to recover, and nothing is overwritten by the next recording. The rows go to segment
+    files (a new one each time the session is resumed), written as they come by a RecordWriter, and session.json
+    checkpoints what is on disk: the format, columns and attributes, the start time and the rows fsync'd in each
+    segment. Segments are always CSV, whatever the format: a CSV file cut short by a crash loses at most its last
+    row, where an HDF5 file that was never closed may not open at all. The chosen format is written when the
+    session is finalized. The checkpoint is rewritten from the writer thread after each fsync, to a temporary file which then
+    replaces the old one, so it is always whole. finalize() joins the segments into the finished file and removes
+    the directory; interrupted() finds the sessions a crashed run left behind. A process holds the lock on
+    session.lock for as long as it has the session (writing it, or holding on to it after interrupted() found it),
+    so another KARP started in the same folder leaves it alone.
+    """
+    manifest = "session.json"
+    lockfile = "session.lock"
+    _held = {} # path: the session, for every session this process holds the lock of
+
+    def __init__(self, path, record_format, labels, attrs, init_time, segments=None, finalized_as=None,
+                 sink_options=None):
+        self.path = path
+        self.record_format = record_format
+        self.sink_options = dict(sink_options or {})
+        self.labels = list(labels)
+        self.attrs = dict(attrs)
+        self.init_time = init_time
+        self.segments = segments if segments is not None else []
+        self.finalized_as = finalized_as
+        self._lock = threading.Lock()
+        self._lock_handle = None
+
+    """ Takes the session's lock. False if another process has it"""
+    def acquire(self):
+        if self._lock_handle is not None:
+            return True
+        handle = open(os.path.join(self.path, self.lockfile), 'a+')
+        if not _lock_file(handle):
+            handle.close()
+            return False
+        self._lock_handle = handle
+        RecordingSession._held[self.path] = self
+        return True
+
+    def release(self):
+        RecordingSession._held.pop(self.path, None)
+        if self._lock_handle is not None:
+            self._lock_handle.close()
+            self._lock_handle = None
+
+    """ Makes the directory of a new session, named after its start time. sink_options go to the record sink of
+    the finished file"""
+    @classmethod
+    def create(cls, root, record_format, labels, attrs, init_time, **sink_options):
+        # a format that cannot be written (HDF5 without h5py, a wrong option) fails here, not once the run is over
+        RECORD_FORMATS[record_format](None, labels, attrs, **sink_options)
+        name = "session " + time.strftime("%Y %m %d - %H_%M_%S", time.localtime(init_time))
+        os.makedirs(root, exist_ok=True)
+        path = _unique_path(os.path.abspath(os.path.join(root, name)))
+        os.makedirs(path)
+        session = cls(path, record_format, labels, attrs, init_time, sink_options=sink_options)
+        session.acquire()
+        session.checkpoint()
+        return session
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, cls.manifest)) as file:
+            manifest = json.load(file)
+        return cls(path, manifest["format"], manifest["labels"], manifest["attrs"], manifest["init_time"],
+                   manifest["segments"], manifest.get("finalized_as"), manifest.get("sink_options"))
+
+    """ The sessions under root that were never finalized and that no other process holds, oldest first. They are
+    locked for this process until finalized (or release()d); sessions it already holds are returned as they are"""
+    @classmethod
+    def interrupted(cls, root):
+        sessions = []
+        if not os.path.isdir(root):
+            return sessions
+        for entry in os.listdir(root):
+            path = os.path.abspath(os.path.join(root, entry))
+            if path in cls._held:
+                sessions.append(cls._held[path])
+                continue
+            if not os.path.isfile(os.path.join(path, cls.manifest)):
+                continue
+            try:
+                session = cls.load(path)
+            except (OSError, ValueError, KeyError):
+                continue
+            if session.acquire():
+                sessions.append(session)
+        return sorted(sessions, key=lambda session: session.init_time)
+
+    """ Rows checkpointed so far, over all segments"""
+    @property
+    def rows(self):
+        return sum(segment["rows"] for segment in self.segments)
+
+    """ Adds a segment and returns the CsvSink for it, to be handed to a RecordWriter with on_sync=checkpoint"""
+    def new_segment(self):
+        with self._lock:
+            self.segments.append({"file": "segment " + str(len(self.segments) + 1) + CsvSink.extension, "rows": 0})
+        self.checkpoint()
+        return CsvSink(os.path.join(self.path, self.segments[-1]["file"]), self.labels, self.attrs)
+
+    """ Writes session.json atomically, first noting the rows the current segment has on disk if given"""
+    def checkpoint(self, rows=None):
+        with self._lock:
+            if rows is not None:
+                self.segments[-1]["rows"] = rows
+            manifest = {"format": self.record_format, "labels": self.labels, "attrs": self.attrs,
+                        "init_time": self.init_time, "segments": self.segments, "finalized_as": self.finalized_as,
+                        "sink_options": self.sink_options}
+            temporary = os.path.join(self.path, self.manifest + ".tmp")
+            with open(temporary, 'w') as file:
+                json.dump(manifest, file, indent=1, default=str)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary, os.path.join(self.path, self.manifest))
+
+    """ Saves the recording as name + extension ("name (2)" and so on if that is taken) and removes the session.
+    A single CSV segment of a CSV recording is just moved there; otherwise the segments are written, in the
+    session's format, to a temporary file first, which then takes the name, so the finished file is never seen
+    half-written. The name is checkpointed before anything moves, so a
+    crash in here is finished off by the next recovery. Returns the path"""
+    def finalize(self, name, printer=None):
+        sink_class = RECORD_FORMATS[self.record_format]
+        if self.finalized_as is None:
+            self.finalized_as = _unique_path(os.path.abspath(name + sink_class.extension))
+            self.checkpoint()
+        target = self.finalized_as
+        if not os.path.exists(target):
+            segments = [os.path.join(self.path, segment["file"]) for segment in self.segments]
+            segments = [segment for segment in segments if os.path.exists(segment)]
+            if len(segments) == 1 and sink_class is CsvSink:
+                CsvSink.repair(segments[0])
+                os.replace(segments[0], target)
+            else:
+                temporary = target + ".part"
+                sink = sink_class(temporary, self.labels, self.attrs, **self.sink_options)
+                sink.open()
+                try:
+                    for segment in segments:
+                        try:
+                            for block in CsvSink.read_blocks(segment):
+                                sink.write_rows(block)
+                        except Exception as e:
+                            if printer is not None:
+                                printer("Could not read all of " + segment + ": " + str(e))
+                finally:
+                    sink.close()
+                os.replace(temporary, target)
+        self.release()
+        shutil.rmtree(self.path, ignore_errors=True)
+        return target
+
+
+""" One SCPI property of one instrument channel. kind is "bool" or "float"; settable ones get an entry in the GUI.
+index is the property's position in the instrument's polled reading (Sample.rp100 / Sample.keysight), None for the
+settings that are only read when the instrument connects. lims are the default plot axis limits"""
+Property = namedtuple("Property", ["instrument", "channel", "command", "label", "description", "kind", "settable", "index", "lims"])
+
+""" Where one station's readings go in a recorded row: the columns of its RP100 and E4980AL readings (in reading
+order), of their timestamps, and every column it owns"""
+StationLayout = namedtuple("StationLayout", ["rp100", "keysight", "rp100_time", "keysight_time", "columns"])
+
+
+class PropertyRegistry:
+    """
+    The SCPI properties of every instrument in the setup, keyed by (instrument name, channel). Instruments come in
+    stations, station k pairing the k-th RP100 with the k-th E4980AL on one AcquisitionEngine thread. From the
+    registry come the RP100 readback each station polls, the columns of a recorded row and the variables (with
+    their axis limits) that can be plotted. Station 0 keeps the names of the original single-pair setup ("RP100",
+    "E4980AL", "Output Voltage 1 (V)"...); later stations are "RP100 #2", "E4980AL #2"... and prefix their labels
+    with that name.
+    """
+    def __init__(self, stations=1):
+        self.instruments = []
+        self.properties = {}
+        for _ in range(stations):
+            self.add_station()
+
+    def __getitem__(self, key):
+        return self.properties[key]
+
+    @property
+    def stations(self):
+        return len(self.instruments) // 2
+
+    """ Adds an RP100 and an E4980AL as the next station. Returns its index"""
+    def add_station(self):
+        station = self.stations
+        suffix = "" if station == 0 else " #" + str(station + 1)
+        prefix = "" if station == 0 else "RP100" + suffix + " "
+        rp100 = "RP100" + suffix
+        for channel in (1, 2):
+            c = str(channel)
+            ch = c.encode()
+            first = 3 * (channel - 1)
+            self.properties[(rp100, channel)] = [
+                Property(rp100, channel, b"OUTP" + ch, prefix + "Output Relay " + c, prefix + "Output relay " + c, "bool", True, None, [-1, 2]),
+                Property(rp100, channel, b"SOUR" + ch + b":VOLT", prefix + "Target Voltage " + c + " (V)", prefix + "Target Voltage " + c + " (V)", "float", True, None, [-20, 120]),
+                Property(rp100, channel, b"SOUR" + ch + b":VOLT:SLEW", prefix + "Slew Rate " + c + " (V/s)", prefix + "Slew Rate " + c + " (V/s)", "float", True, None, [0, 100]),
+                Property(rp100, channel, b"SOUR" + ch + b":VOLT:NOW", prefix + "Output Voltage " + c + " (V)", prefix + "Output Voltage " + c + " (V)", "float", False, first, [-20, 120]),
+                Property(rp100, channel, b"MEAS" + ch + b":VOLT", prefix + "Measured Voltage " + c + " (V)", prefix + "Measured Voltage " + c + " (V)", "float", False, first + 1, [-20, 120]),
+                Property(rp100, channel, b"MEAS" + ch + b":CURR", prefix + "Measured Current " + c + " (A)", prefix + "Measured Current " + c + " (A)", "float", False, first + 2, [-20, 100])]
+        keysight = "E4980AL" + suffix
+        prefix = "" if station == 0 else keysight + " "
+        fetch = AcquisitionEngine.KEYSIGHT_FETCH
+        self.properties[(keysight, 1)] = [
+            Property(keysight, 1, fetch, prefix + "Primary Keysight Measurement", prefix + "Capacitance (F)", "float", False, 0, [-20e-12, 10e-12]),
+            Property(keysight, 1, fetch, prefix + "Secondary Keysight Measurement", prefix + "Resistance (Ω)", "float", False, 1, [-200e3, 100e3])]
+        self.instruments += [(rp100, "RP100", station), (keysight, "E4980AL", station)]
+        return station
+
+    """ The (RP100, E4980AL) instrument names of a station"""
+    def names(self, station):
+        return self.instruments[2 * station][0], self.instruments[2 * station + 1][0]
+
+    """ Every property of an instrument, channel by channel"""
+    def of(self, instrument):
+        return [prop for (name, channel), props in self.properties.items() if name == instrument for prop in props]
+
+    """ The properties read on every tick, in reading order"""
+    def polled(self, instrument):
+        return sorted((prop for prop in self.of(instrument) if prop.index is not None), key=lambda prop: prop.index)
+
+    """ The RP100 commands an AcquisitionEngine polls, see AcquisitionEngine.RP100_READBACK"""
+    def readback(self, instrument):
+        return [prop.command for prop in self.polled(instrument)]
+
+    """ An instrument's (first) property with the given SCPI command; for the E4980AL's fetch, the primary reading"""
+    def find(self, instrument, command):
+        for prop in self.of(instrument):
+            if prop.command == command:
+                return prop
+        raise KeyError(instrument + " has no property " + repr(command))
+
+    """ The readings a Sequence on the station averages at each step, see Sequence.averaged"""
+    def averaged(self, station):
+        rp100, keysight = self.names(station)
+        return ([(prop.label, "rp100", prop.index) for prop in self.polled(rp100)] +
+                [(prop.label, "keysight", prop.index) for prop in self.polled(keysight)])
+
+    """ The labels of station 0's property `label` in every station, station 0's first"""
+    def counterparts(self, label):
+        for position, name in enumerate(self.names(0)):
+            for i, prop in enumerate(self.of(name)):
+                if prop.label == label:
+                    return [self.of(self.names(station)[position])[i].label for station in range(self.stations)]
+        return [label]
+
+    """ Deadbands keyed by station 0's labels (like DEADBAND_DEFAULTS) for the same columns of every station"""
+    def deadbands(self, deadbands):
+        return {counterpart: value for label, value in deadbands.items() for counterpart in self.counterparts(label)}
+
+    def time_label(self, instrument):
+        if instrument == "RP100":
+            return "RP100 Time (s)"
+        if instrument == "E4980AL":
+            return "Keysight Time (s)"
+        return instrument + " Time (s)"
+
+    """ The columns of a recorded row: every property, the time, each instrument's own timestamp, then the sweep step
+    and the deadband's count of suppressed samples"""
+    def labels(self):
+        return ([prop.label for props in self.properties.values() for prop in props] + ["Time (s)"] +
+                [self.time_label(name) for name, _, _ in self.instruments] + ["Sweep Step", "Suppressed Samples"])
+
+    """ What can go on a plot axis: (column label, description, default limits), properties first, then the time"""
+    def plot_variables(self):
+        return ([(prop.label, prop.description, prop.lims) for props in self.properties.values() for prop in props] +
+                [("Time (s)", "Time", [0, 10])])
+
+    def layout(self, station):
+        labels = self.labels()
+        rp100, keysight = self.names(station)
+        columns = [labels.index(prop.label) for name in (rp100, keysight) for prop in self.of(name)]
+        time_columns = [labels.index(self.time_label(name)) for name in (rp100, keysight)]
+        return StationLayout(np.array([labels.index(prop.label) for prop in self.polled(rp100)], dtype=int),
+                             np.array([labels.index(prop.label) for prop in self.polled(keysight)], dtype=int),
+                             time_columns[0], time_columns[1], np.array(columns + time_columns, dtype=int))
+
+
+""" Column labels of a recorded row with one station, in the order produced by KarpEngine.sample_row"""
+DATALABELS = PropertyRegistry().labels()
+
+""" The columns each instrument's timestamp column applies to, for align_recording"""
+RP100_COLUMNS = DATALABELS[:12]
+KEYSIGHT_COLUMNS = DATALABELS[12:14]
+
+
+class ValueStore:
+    """
+    The latest raw reading of every column of a recorded row, as float64 in one preallocated row (NaN until the
+    column has been read; timestamp columns hold perf_counter_ns). generation goes up with every update, so a
+    reader such as the GUI can tell with one comparison whether anything changed since it last looked, and rows
+    for recording and plotting are copied straight out of it. Written by whichever thread calls KarpEngine.poll()
+    """
+    def __init__(self, labels):
+        self.labels = list(labels)
+        self.values = np.full(len(self.labels), np.nan)
+        self.generation = 0
+
+    def update(self, columns, values):
+        self.values[columns] = values
+        self.generation += 1
+
+    def get(self, label):
+        return float(self.values[self.labels.index(label)])
+
+    """ A copy of the current values"""
+    def row(self):
+        return self.values.copy()
+
+
+""" Default deadbands of DeadbandFilter, label: (absolute, relative). A change counts when it is bigger than
+absolute + relative * |last recorded value|. They are station 0's, PropertyRegistry.deadbands() extends them to
+every station"""
+DEADBAND_DEFAULTS = {"Output Voltage 1 (V)": (1e-3, 0.0), "Measured Voltage 1 (V)": (1e-3, 0.0), "Measured Current 1 (A)": (1e-9, 0.0),
+                     "Output Voltage 2 (V)": (1e-3, 0.0), "Measured Voltage 2 (V)": (1e-3, 0.0), "Measured Current 2 (A)": (1e-9, 0.0),
+                     "Primary Keysight Measurement": (0.0, 1e-5), "Secondary Keysight Measurement": (0.0, 1e-4)}
+
+
+class DeadbandFilter:
+    """
+    Change-driven recording. A row is kept only when a monitored column has moved past its deadband since the last
+    kept row (or turned NaN / stopped being NaN), when max_interval s have passed since the last kept row (a
+    heartbeat, so a quiet stretch still shows up in the file), or when it was averaged into a sweep step. Every
+    other row is suppressed and counted; the count since the last kept row goes into that row's
+    "Suppressed Samples" column, and self.suppressed is the total. Comparing with the last kept row rather than the
+    previous sample means a slow drift is still recorded once it adds up.
+    """
+    def __init__(self, deadbands=None, max_interval=10.0, labels=DATALABELS):
+        if deadbands is None:
+            deadbands = DEADBAND_DEFAULTS
+        index = {label: i for i, label in enumerate(labels)}
+        for label in deadbands:
+            if label not in index:
+                raise ValueError("No column called " + label)
+        self.deadbands = dict(deadbands)
+        self.max_interval = max_interval
+        self._columns = np.array([index[label] for label in deadbands], dtype=int)
+        self._absolute = np.array([deadbands[label][0] for label in deadbands], dtype=float)
+        self._relative = np.array([deadbands[label][1] for label in deadbands], dtype=float)
+        self._time = index["Time (s)"]
+        self._step = index["Sweep Step"]
+        self._count = index["Suppressed Samples"]
+        self._last = None
+        self._latest = None
+        self._pending = 0
+        self.kept = 0
+        self.suppressed = 0
+
+    """ The last row seen, if it was suppressed, so the recording ends on the final state. Call when recording stops"""
+    def flush(self):
+        if not self._pending:
+            return None
+        self.suppressed -= 1
+        self._pending -= 1
+        row = self._latest
+        row[self._count] = self._pending
+        self._pending = 0
+        self._last = row
+        self.kept += 1
+        return row
+
+    """ True if row should be recorded, in which case its Suppressed Samples column is filled in"""
+    def accept(self, row):
+        self._latest = row
+        if self._last is not None and row[self._step] != row[self._step] and \
+                row[self._time] - self._last[self._time] < self.max_interval:
+            values = row[self._columns]
+            last = self._last[self._columns]
+            nan = np.isnan(values)
+            moved = (np.abs(values - last) > self._absolute + self._relative * np.abs(last)) | (nan != np.isnan(last))
+            if not moved.any():
+                self._pending += 1
+                self.suppressed += 1
+                return False
+        row[self._count] = self._pending
+        self._pending = 0
+        self._last = row
+        self.kept += 1
+        return True
+
+
+class RunningStats:
+    """
+    Mean and standard deviation of a stream of values, each updated in O(1) per value: over everything seen, with
+    Welford's algorithm, and over the last `window` values, where each new value replaces the oldest in the same
+    update. So that rounding does not pile up over a long run, the window's sums are recomputed from its values
+    every `window` values, which is still O(1) per value on average. NaN values are skipped.
+    """
+    def __init__(self, window=1000):
+        self.window = max(2, int(window))
+        self._recent = np.empty(self.window)
+        self.clear()
+
+    def clear(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.window_count = 0
+        self.window_mean = 0.0
+        self._window_m2 = 0.0
+        self._next = 0
+
+    def add(self, value):
+        value = float(value)
+        if value != value:
+            return
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        if self.window_count < self.window:
+            self.window_count += 1
+            delta = value - self.window_mean
+            self.window_mean += delta / self.window_count
+            self._window_m2 += delta * (value - self.window_mean)
+        else:
+            old = self._recent[self._next]
+            mean = self.window_mean
+            self.window_mean += (value - old) / self.window
+            self._window_m2 += (value - old) * (value - self.window_mean + old - mean)
+        self._recent[self._next] = value
+        self._next = (self._next + 1) % self.window
+        if self._next == 0 and self.window_count == self.window:
+            self.window_mean = float(self._recent.mean())
+            self._window_m2 = float(((self._recent - self.window_mean) ** 2).sum())
+
+    @property
+    def std(self):
+        return np.sqrt(max(self._m2, 0.0) / (self.count - 1)) if self.count > 1 else np.nan
+
+    @property
+    def window_std(self):
+        return np.sqrt(max(self._window_m2, 0.0) / (self.window_count - 1)) if self.window_count > 1 else np.nan
+
+
+class AllanDeviation:
+    """
+    Overlapping Allan deviation of a stream of values at log-spaced averaging times tau = m x tau0, m = 1, 2, 4...
+    up to max_m values, with tau0 the mean time between values. It keeps the running sum x of the values (offset
+    by the first one, to keep the precision) for the last 2 max_m + 1 values, and as each value comes in adds the
+    squared second difference x[n] - 2 x[n - m] + x[n - 2m] to a sum for every m, so a value costs the same
+    whether the run is a minute or a week old; sigma^2(m tau0) = sum / (2 m^2 count). NaN values are skipped.
+    """
+    def __init__(self, max_m=2 ** 16):
+        self.m = 2 ** np.arange(int(np.log2(max(1, max_m))) + 1, dtype=np.int64)
+        self._phase = np.zeros(2 * int(self.m[-1]) + 1)
+        self.clear()
+
+    def clear(self):
+        self.count = 0
+        self._offset = None
+        self._x = 0.0
+        self._phase[0] = 0.0
+        self._sums = np.zeros(len(self.m))
+        self._counts = np.zeros(len(self.m), dtype=np.int64)
+        self._first_time = None
+        self._last_time = None
+
+    def add(self, value, t=None):
+        value = float(value)
+        if value != value:
+            return
+        if self._offset is None:
+            self._offset = value
+        if t is not None:
+            if self._first_time is None:
+                self._first_time = t
+            self._last_time = t
+        self.count += 1
+        self._x += value - self._offset
+        size = len(self._phase)
+        n = self.count
+        self._phase[n % size] = self._x
+        ready = int(np.searchsorted(self.m, n // 2, side="right"))
+        if ready:
+            m = self.m[:ready]
+            d = self._x - 2 * self._phase[(n - m) % size] + self._phase[(n - 2 * m) % size]
+            self._sums[:ready] += d * d
+            self._counts[:ready] += 1
+
+    """ Mean time between values, from the times given to add() (NaN without them)"""
+    @property
+    def tau0(self):
+        if self._first_time is None or self.count < 2:
+            return np.nan
+        return (self._last_time - self._first_time) / (self.count - 1)
+
+    """ (tau, deviation) arrays for the averaging times with at least one term so far"""
+    def deviations(self):
+        done = self._counts > 0
+        m = self.m[done]
+        return m * self.tau0, np.sqrt(self._sums[done] / (2.0 * m * m * self._counts[done]))
+
+
+class ColumnStatistics:
+    """
+    RunningStats and AllanDeviation of one column of the rows KarpEngine.poll() lays out (see KarpEngine.watch).
+    A reading column is only fed from the samples that read its instrument, not from the rows that merely carry
+    it over, so the statistics are of the instrument's readings.
+    """
+    def __init__(self, label, column, source=None, window=1000, max_m=2 ** 16):
+        self.label = label
+        self.column = column
+        self.source = source
+        self.stats = RunningStats(window)
+        self.allan = AllanDeviation(max_m)
+
+    def clear(self):
+        self.stats.clear()
+        self.allan.clear()
+
+    def add(self, sample, row):
+        if self.source is not None:
+            station, instrument = self.source
+            if sample.station != station or getattr(sample, instrument) is None:
+                return
+        value = row[self.column]
+        self.stats.add(value)
+        self.allan.add(value, sample.time)
+
+    def report(self):
+        stats = self.stats
+        lines = [self.label,
+                 "N          %d" % stats.count,
+                 "mean       %.6g" % stats.mean,
+                 "std        %.6g" % stats.std,
+                 "last %-6d mean %.6g" % (stats.window, stats.window_mean),
+                 "%-11s std  %.6g" % ("", stats.window_std),
+                 "",
+                 "tau (s)    Allan deviation"]
+        for tau, deviation in zip(*self.allan.deviations()):
+            lines.append("%-10.4g %.6g" % (tau, deviation))
+        return "\n".join(lines)
+
+
+class SequenceStates(Enum):
+    SETTLING = 1
+    AVERAGING = 2
+    DONE = 3
+    ABORTED = 4
+
+
+class TargetReached:
+    """ Settle condition: the output voltage readback (SOURn:VOLT:NOW) of every swept channel is within tolerance (V)
+    of the target. Where that sits in the readback comes from bind(), which KarpEngine.run_sequence() calls with the
+    swept station; until then it is station 0's"""
+    def __init__(self, tolerance=0.01):
+        self.tolerance = tolerance
+        self.bind(PropertyRegistry(), 0)
+
+    def bind(self, registry, station):
+        rp100 = registry.names(station)[0]
+        self._indices = {channel: registry.find(rp100, b"SOUR" + str(channel).encode() + b":VOLT:NOW").index
+                         for channel in (1, 2)}
+
+    def reset(self):
+        pass
+
+    def update(self, sample, target, channels):
+        if sample.rp100 is None:
+            return False
+        return all(abs(sample.rp100[self._indices[channel]] - target) <= self.tolerance for channel in channels)
+
+
+class KeysightStable:
+    """ Settle condition: the last `count` primary Keysight readings lie within tolerance of each other (in F, or as
+    a fraction of their mean with relative=True)"""
+    def __init__(self, count=10, tolerance=1e-15, relative=False):
+        self.count = count
+        self.tolerance = tolerance
+        self.relative = relative
+        self._readings = deque(maxlen=count)
+        self.bind(PropertyRegistry(), 0)
+
+    """ Finds the primary reading in the station's E4980AL readings, see TargetReached.bind"""
+    def bind(self, registry, station):
+        self._index = registry.find(registry.names(station)[1], AcquisitionEngine.KEYSIGHT_FETCH).index
+
+    def reset(self):
+        self._readings.clear()
+
+    def update(self, sample, target, channels):
+        if sample.keysight is not None:
+            self._readings.append(sample.keysight[self._index])
+        if len(self._readings) < self.count:
+            return False
+        spread = max(self._readings) - min(self._readings)
+        limit = self.tolerance * abs(np.mean(self._readings)) if self.relative else self.tolerance
+        return spread <= limit
+
+
+def ramp_targets(start, stop, step, back=False):
+    """ Target voltages from start to stop (inclusive) in steps of step, and back down to start with back=True"""
+    count = int(round(abs(stop - start) / abs(step))) if step else 0
+    targets = list(np.linspace(start, stop, count + 1)) if count else [start, stop]
+    if back:
+        targets += targets[-2::-1]
+    return [float(target) for target in targets]
+
+
+def parse_targets(text):
+    """ Target voltages from a comma separated list ("0, 5, 10") or a ramp "start:stop:step", with a trailing
+    ":back" for the return sweep ("0:50:5:back")"""
+    text = text.strip()
+    if ":" in text:
+        parts = [part.strip() for part in text.split(":")]
+        back = parts[-1].lower() == "back"
+        if back:
+            parts = parts[:-1]
+        if len(parts) != 3:
+            raise ValueError("A ramp is start:stop:step")
+        return ramp_targets(float(parts[0]), float(parts[1]), float(parts[2]), back)
+    return [float(part) for part in text.replace(";", ",").split(",") if part.strip()]
+
+
+class Sequence:
+    """
+    Steps the RP100 through a list of target voltages without blocking anyone. It is driven by the samples the
+    acquisition thread publishes (KarpEngine.poll() feeds it), so it advances exactly as fast as readings come in
+    and never sleeps. Each step writes SOURn:VOLT on every channel in `channels`, waits until all `settle`
+    conditions hold on the same sample (and at least `dwell` s have passed; at most `timeout` s, after which the
+    step is marked timed out), then averages the next `average` samples. Per-step results (times, means and standard
+    deviations of the readings, whether it timed out) are kept in self.steps; on_step(sequence) is called as each
+    step starts and on_finish(sequence) once the last one is done. Only samples of `station` drive it, those of
+    other stations pass through untouched. The timeout also runs on the wall clock (check(), called by
+    KarpEngine.poll()), so a step still ends if the samples stop coming, e.g. the RP100 dropped out; a step that
+    has settled then gets at most another `timeout` s to average. A ramp_down sequence is the safe ramp to 0 V
+    before the relays open, which KarpEngine will not let another sequence abort. averaged lists the
+    (column label, "rp100" or "keysight", index in that reading) whose means go into the step results, by default
+    station 0's; KarpEngine passes the swept station's.
+    """
+    AVERAGED = PropertyRegistry().averaged(0)
+
+    def __init__(self, serial_port, targets, channels=(1,), settle=(), average=10, timeout=None, dwell=0.0,
+                 on_step=None, on_finish=None, station=0, ramp_down=False, averaged=None):
+        self.serial_port = serial_port
+        self.station = station
+        self.ramp_down = ramp_down
+        self.averaged = self.AVERAGED if averaged is None else list(averaged)
+        self.targets = list(targets)
+        self.channels = tuple(channels)
+        self.settle = list(settle)
+        self.average = average
+        self.timeout = timeout
+        self.dwell = dwell
+        self.on_step = on_step
+        self.on_finish = on_finish
+        self.steps = []
+        self.index = -1
+        self.state = None
+        self._step_started = None
+        self._settled = None
+        self._timed_out = False
+        self._averaged = []
+        self._written_ns = None
+        self._written_at = None
+
+    @property
+    def running(self):
+        return self.state in (SequenceStates.SETTLING, SequenceStates.AVERAGING)
+
+    @property
+    def target(self):
+        return self.targets[self.index] if 0 <= self.index < len(self.targets) else None
+
+    def start(self):
+        self.steps = []
+        self.index = -1
+        self._next_step()
+
+    def stop(self):
+        if self.running:
+            self.state = SequenceStates.ABORTED
+
+    """ One line for a status bar"""
+    def status(self):
+        if self.state is None:
+            return "Idle"
+        if not self.running:
+            return self.state.name.capitalize() + " after " + str(len(self.steps)) + " of " + str(len(self.targets)) + " steps"
+        return ("Step " + str(self.index + 1) + "/" + str(len(self.targets)) + ": " + str(round(self.target, 6)) + " V, "
+                + self.state.name.lower())
+
+    def _next_step(self):
+        self.index += 1
+        if self.index >= len(self.targets):
+            self.state = SequenceStates.DONE
+            if self.on_finish is not None:
+                self.on_finish(self)
+            return
+        for channel in self.channels:
+            self.serial_port.write(b"SOUR" + str(channel).encode() + b":VOLT " + str(self.target).encode() + b"\n")
+        self._written_ns = time.perf_counter_ns()
+        self._written_at = time.time()
+        for condition in self.settle:
+            condition.reset()
+        self.state = SequenceStates.SETTLING
+        self._step_started = None
+        self._settled = None
+        self._timed_out = False
+        self._averaged = []
+        if self.on_step is not None:
+            self.on_step(self)
+
+    """ Advances on a batch of samples. Returns them, with step set on those averaged into a step"""
+    def feed(self, samples):
+        if not self.running:
+            return samples
+        fed = []
+        for sample in samples:
+            if sample.station != self.station:
+                pass
+            elif self.state == SequenceStates.SETTLING:
+                # readings taken before the new target was written say nothing about this step
+                stamps = [stamp for stamp in (sample.rp100_ns, sample.keysight_ns) if stamp is not None]
+                if stamps and max(stamps) > self._written_ns:
+                    self._settle(sample)
+            elif self.state == SequenceStates.AVERAGING:
+                sample = sample._replace(step=self.index)
+                self._averaged.append(sample)
+                if len(self._averaged) >= self.average:
+                    self._finish_step(sample.time)
+            fed.append(sample)
+        return fed
+
+    def _settle(self, sample):
+        if self._step_started is None:
+            self._step_started = sample.time
+        elapsed = sample.time - self._step_started
+        # every condition sees every sample, so windowed ones (KeysightStable) stay filled
+        settled = [condition.update(sample, self.target, self.channels) for condition in self.settle]
+        if all(settled) and elapsed >= self.dwell:
+            self._settled = sample.time
+        elif self.timeout is not None and elapsed >= self.timeout:
+            self._settled = sample.time
+            self._timed_out = True
+        else:
+            return
+        self.state = SequenceStates.AVERAGING
+        if self.average <= 0:
+            self._finish_step(sample.time)
+
+    """ Ends a step that has run past the timeout on the wall clock (time.time(), like Sample.time) without the
+    samples to end it"""
+    def check(self, now):
+        if not self.running or self.timeout is None:
+            return
+        if self.state == SequenceStates.SETTLING:
+            if self._step_started is None:
+                if now - self._written_at < self.timeout:
+                    return
+                self._step_started = self._written_at
+            elif now - self._step_started < self.timeout:
+                return
+            self._settled = now
+            self._timed_out = True
+            self.state = SequenceStates.AVERAGING
+            if self.average <= 0:
+                self._finish_step(now)
+        elif now - self._settled >= self.timeout:
+            self._timed_out = True
+            self._finish_step(now)
+
+    def _finish_step(self, finished):
+        step = {"step": self.index, "target (V)": self.target, "channels": " ".join(str(c) for c in self.channels),
+                "started": self._step_started, "settled": self._settled, "finished": finished,
+                "timed out": self._timed_out, "samples": len(self._averaged)}
+        for label, instrument, i in self.averaged:
+            values = [getattr(sample, instrument)[i] for sample in self._averaged
+                      if getattr(sample, instrument) is not None and len(getattr(sample, instrument)) > i]
+            step["mean " + label] = float(np.mean(values)) if values else float("nan")
+            step["std " + label] = float(np.std(values)) if values else float("nan")
+        self.steps.append(step)
+        self._next_step()
+
+
+def save_steps(path, steps):
+    """ Writes per-step results of one or more Sequences as CSV, one row per step"""
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        if steps:
+            writer.writerow(list(steps[0]))
+            writer.writerows([list(step.values()) for step in steps])
+
+
+""" What KarpEngine.poll() returns: the new samples (in time order) and the row each was laid out as, to be handed
+to record()"""
+Polled = namedtuple("Polled", ["samples", "rows"])
+
+
+class KarpEngine:
+    """
+    Headless front end to KARP. Owns the ports, the AcquisitionEngine thread and the recording, and knows the safe
+    ramp-down sequence; imports neither tkinter nor matplotlib. A client calls start(), connects the instruments,
+    and then regularly calls poll() (and record() while recording) to collect what the acquisition thread has read.
+    With stations > 1 there is one RP100 / E4980AL pair, and one acquisition thread, per station (see
+    PropertyRegistry); the methods taking a station default to 0, and serial_port, usb_port and acquisition are
+    station 0's.
+    """
+    def __init__(self, printer=print, print_io=False, print_conn=True, period=0.01, async_io=False, stations=1):
+        self._printer = printer
+        self.port_watcher = PortWatcher()
+        self.port_watcher.start()
+        self.discovery = InstrumentDiscovery(self.port_watcher)
+        self.registry = PropertyRegistry(stations)
+        self.labels = self.registry.labels()
+        self.serial_ports = []
+        self.usb_ports = []
+        self.acquisitions = []
+        for station in range(stations):
+            names = self.registry.names(station)
+            serial_port = MonitoredSerial(printer=printer, print_conn=print_conn, print_io=print_io, watcher=self.port_watcher)
+            usb_port = MonitoredUSB(printer=printer, print_conn=print_conn, print_io=print_io)
+            engine_class = AsyncAcquisitionEngine if async_io else AcquisitionEngine
+            engine_options = {"printer": printer} if async_io else {}
+            self.acquisitions.append(engine_class(serial_port, usb_port, period=period, station=station, names=names,
+                                                  readback=self.registry.readback(names[0]), **engine_options))
+            self.serial_ports.append(serial_port)
+            self.usb_ports.append(usb_port)
+        self.serial_port = self.serial_ports[0]
+        self.usb_port = self.usb_ports[0]
+        self.acquisition = self.acquisitions[0]
+        self._layouts = [self.registry.layout(station) for station in range(stations)]
+        self.values = ValueStore(self.labels)
+        # settings are only read on connect and recorded as 0, as they always were
+        self.values.update([self.labels.index(prop.label) for props in self.registry.properties.values()
+                            for prop in props if prop.index is None], 0)
+        self._stamps = np.array([self.labels.index(self.registry.time_label(name)) for name, _, _ in self.registry.instruments], dtype=int)
+        self.statistics = {}
+        self._time = self.labels.index("Time (s)")
+        self._step = self.labels.index("Sweep Step")
+        self._suppressed = self.labels.index("Suppressed Samples")
+        self.record_writer = None
+        self.session = None
+        self.session_root = "sessions" # recordings in progress, see RecordingSession
+        self.checkpoint_interval = 5.0 # s between fsyncs (and checkpoints) of the recording
+        self.stop_timeout = 5.0 # s close() waits for the acquisition threads to finish their tick and close down
+        self.init_time = None
+        self.init_ns = None
+        self.sequences = [None] * stations # each station's latest Sequence
+        self._sequences = []
+        self.deadband = None
+        self.profiler = profiler
+        for serial_port, usb_port, acquisition in zip(self.serial_ports, self.usb_ports, self.acquisitions):
+            for port, prefix in ((serial_port, "rp100."), (usb_port, "e4980al.")):
+                for method in ("update", "write", "read", "query"):
+                    profiler.attach(port, method, prefix + method)
+            profiler.attach(serial_port, "query_batch", "rp100.query_batch")
+            profiler.attach(usb_port, "read_capture", "e4980al.read_capture", "e4980al readings", lambda args, result: len(result))
+            profiler.attach(acquisition, "tick", "acquisition.tick", "samples acquired", lambda args, result: result)
+        profiler.attach(self, "record", "recording.record")
+
+    def start(self):
+        for acquisition in self.acquisitions:
+            acquisition.start()
+
+    """ Stops the threads. Does not touch the instruments, call ramp_down() first if the outputs should go to 0 V"""
+    def close(self):
+        if self.recording:
+            self.stop_recording()
+        for acquisition in self.acquisitions:
+            acquisition.stop()
+        # the threads still close their transports, which needs the ports and the worker pools, so wait for them
+        deadline = time.monotonic() + self.stop_timeout
+        for acquisition in self.acquisitions:
+            if acquisition.is_alive():
+                acquisition.join(max(0.0, deadline - time.monotonic()))
+            if acquisition.is_alive():
+                self._printer("Acquisition thread " + acquisition.name + " did not stop within " +
+                              str(self.stop_timeout) + " s")
+        self.port_watcher.stop()
+        self.discovery.close()
+        for obj in self.serial_ports + self.usb_ports + self.acquisitions + [self]:
+            profiler.detach_all(obj)
+
+    """ Connects a station's RP100, given a port from list_ports or a device name / USB serial number. Returns its *IDN?"""
+    def connect_rp100(self, port, station=0):
+        if isinstance(port, str):
+            for info in self.port_watcher.ports:
+                if port in (info.device, info.serial_number):
+                    port = info
+                    break
+            else:
+                raise ValueError("No serial port called " + port)
+        serial_port = self.serial_ports[station]
+        serial_port.connect(port)
+        if serial_port.state != SerialStates.CONNECTED:
+            return None
+        time.sleep(0.05)
+        resp = serial_port.query(b'*IDN?\n')
+        if resp is None:
+            return None
+        return resp.decode(errors="replace").strip()
+
+    """ Connects a station's E4980AL, given a VISA resource name. Returns its *IDN?"""
+    def connect_keysight(self, resource, station=0):
+        usb_port = self.usb_ports[station]
+        usb_port.connect(resource)
+        if usb_port.state != USBStates.CONNECTED:
+            return None
+        time.sleep(0.05)
+        resp = usb_port.query('*IDN?')
+        if resp is None:
+            return None
+        return resp.strip()
+
+    def disconnect_rp100(self, station=0):
+        self.serial_ports[station].disconnect()
+
+    def disconnect_keysight(self, station=0):
+        self.usb_ports[station].disconnect()
+
+    """ Seconds the RP100 needs to slew both outputs from where they are now down to 0 V"""
+    def ramp_down_time(self, station=0):
+        serial_port = self.serial_ports[station]
+        waits = [0.0]
+        for channel in (b"1", b"2"):
+            now = parse_float(serial_port.query(b"SOUR" + channel + b":VOLT:NOW?\n"))
+            slew = parse_float(serial_port.query(b"SOUR" + channel + b":VOLT:SLEW?\n"))
+            if slew > 0 and now == now:
+                waits.append(abs(now) / slew)
+        return max(waits)
+
+    """ Safe disconnect sequence: sets both target voltages to 0, waits while the outputs ramp down, then opens the
+    output relays"""
+    def ramp_down(self, station=0):
+        serial_port = self.serial_ports[station]
+        waittime = self.ramp_down_time(station)
+        for channel in (b"1", b"2"):
+            serial_port.write(b"SOUR" + channel + b":VOLT 0\n")
+        time.sleep(waittime)
+        for channel in (b"1", b"2"):
+            serial_port.write(b"OUTP" + channel + b" 0\n")
+
+    """ Starts the RP100's non-blocking ramp to 0 V on both channels (see Sequence). Once the readbacks reach 0 V (or
+    twice the expected ramp time has passed) the output relays are opened and on_done(sequence) is called, from
+    whichever thread calls poll(). A sweep on the station is aborted; if the station is already ramping down,
+    on_done is called when that ramp is done"""
+    def start_ramp_down(self, on_done=None, station=0):
+        running = self.sequences[station]
+        if running is not None and running.running and running.ramp_down:
+            if on_done is not None:
+                previous = running.on_finish
+                def chained(sequence):
+                    previous(sequence)
+                    on_done(sequence)
+                running.on_finish = chained
+            return running
+        serial_port = self.serial_ports[station]
+        def finish(sequence):
+            for channel in (b"1", b"2"):
+                serial_port.write(b"OUTP" + channel + b" 0\n")
+            if on_done is not None:
+                on_done(sequence)
+        timeout = 2 * self.ramp_down_time(station) + 5
+        return self.run_sequence(Sequence(serial_port, [0.0], channels=(1, 2), settle=[TargetReached()],
+                                          average=0, timeout=timeout, on_finish=finish, station=station,
+                                          ramp_down=True, averaged=self.averaged(station)))
+
+    """ Starts a sweep of one RP100 channel through targets, see Sequence for the other options. Returns the Sequence"""
+    def sweep(self, targets, channel=1, settle=None, station=0, **options):
+        if settle is None:
+            settle = [TargetReached()]
+        return self.run_sequence(Sequence(self.serial_ports[station], targets, channels=(channel,), settle=settle,
+                                          station=station, averaged=self.averaged(station), **options))
+
+    """ The readings a Sequence on the station averages at each step, see Sequence.averaged"""
+    def averaged(self, station=0):
+        return self.registry.averaged(station)
+
+    """ Station 0's latest Sequence"""
+    @property
+    def sequence(self):
+        return self.sequences[0]
+
+    """ Aborts the sequence running on the same station and starts this one. poll() drives it from then on. Raises
+    RuntimeError while the station is ramping down, which must finish to leave the outputs safe"""
+    def run_sequence(self, sequence):
+        running = self.sequences[sequence.station]
+        if running is not None and running.running and running.ramp_down:
+            raise RuntimeError(self.registry.names(sequence.station)[0] + " is ramping down to 0 V")
+        self.stop_sequence(sequence.station)
+        for condition in sequence.settle:
+            condition.bind(self.registry, sequence.station)
+        self.sequences[sequence.station] = sequence
+        self._sequences.append(sequence)
+        sequence.start()
+        return sequence
+
+    """ Aborts the station's sweep. A ramp-down is left to finish"""
+    def stop_sequence(self, station=0):
+        running = self.sequences[station]
+        if running is not None and not running.ramp_down:
+            running.stop()
+
+    """ Samples the acquisition threads have published since the last call (in time order), after driving the running
+    sequence, and their rows, as Polled. Each sample goes into self.values as it is laid out"""
+    def poll(self):
+        samples = [sample for acquisition in self.acquisitions for sample in acquisition.drain_samples()]
+        if len(self.acquisitions) > 1:
+            samples.sort(key=lambda sample: sample.time)
+        now = time.time()
+        for sequence in self.sequences:
+            if sequence is not None and sequence.running:
+                samples = sequence.feed(samples)
+                sequence.check(now)
+        rows = [self.sample_row(sample) for sample in samples]
+        for statistics in self.statistics.values():
+            for sample, row in zip(samples, rows):
+                statistics.add(sample, row)
+        return Polled(samples, rows)
+
+    """ Starts keeping running statistics (ColumnStatistics) of a column of the rows, from the next poll() on,
+    whether or not it is being recorded. Returns them; they are also in self.statistics by label"""
+    def watch(self, label, window=1000, max_m=2 ** 16):
+        column = self.labels.index(label)
+        source = None
+        for station, layout in enumerate(self._layouts):
+            if column in layout.rp100 or column == layout.rp100_time:
+                source = (station, "rp100")
+            elif column in layout.keysight or column == layout.keysight_time:
+                source = (station, "keysight")
+        self.statistics[label] = ColumnStatistics(label, column, source, window, max_m)
+        return self.statistics[label]
+
+    def unwatch(self, label):
+        self.statistics.pop(label, None)
+
+    """ ConnectionEvents the acquisition threads have published since the last call"""
+    def poll_events(self):
+        return [event for acquisition in self.acquisitions for event in acquisition.drain_events()]
+
+    @property
+    def recording(self):
+        return self.record_writer is not None
+
+    """ Starts streaming rows, in the given format (a key of RECORD_FORMATS), to a new RecordingSession under
+    session_root, or to a new segment of `resume` (one of interrupted_sessions()), whose format, attributes and
+    time origin are kept so its Time (s) carries on. With a DeadbandFilter only the rows it accepts are written"""
+    def start_recording(self, record_format="CSV", attrs=None, deadband=None, resume=None, **sink_options):
+        if resume is None:
+            self.init_time = time.time()
+            self.init_ns = time.perf_counter_ns()
+            session_attrs = {"start_time": datetime.datetime.fromtimestamp(self.init_time).isoformat(),
+                             "time_origin_perf_counter_ns": self.init_ns}
+            if deadband is not None:
+                session_attrs["deadband_max_interval_s"] = deadband.max_interval
+                session_attrs["deadbands"] = "; ".join(label + ": " + str(absolute) + " + " + str(relative) + " x |value|"
+                                                      for label, (absolute, relative) in deadband.deadbands.items())
+            session_attrs.update(attrs or {})
+            self.session = RecordingSession.create(self.session_root, record_format, self.labels, session_attrs,
+                                                   self.init_time, **sink_options)
+        else:
+            if resume.labels != self.labels:
+                raise ValueError("The session was recorded with other columns (another number of stations?)")
+            self.session = resume
+            self.init_time = resume.init_time
+            # perf_counter has no fixed origin, so the stamps get the one matching the session's start time
+            self.init_ns = time.perf_counter_ns() - int((time.time() - self.init_time) * 1e9)
+        self.deadband = deadband
+        sink = self.session.new_segment()
+        self._sequences = [sequence for sequence in self.sequences if sequence is not None and sequence.running]
+        profiler.attach(sink, "write_rows", "recording.write_rows", "rows written", lambda args, result: len(args[0]))
+        self.record_writer = RecordWriter(sink, fsync_interval=self.checkpoint_interval, on_sync=self.session.checkpoint)
+        self.record_writer.start()
+
+    """ Sessions left in session_root by a run that stopped without finalizing them (a crash, a power cut), oldest
+    first. Each can be resumed with start_recording(resume=session)"""
+    def interrupted_sessions(self):
+        return [session for session in RecordingSession.interrupted(self.session_root)
+                if self.session is None or session.path != self.session.path]
+
+    """ Finalizes the interrupted sessions, all but `keep` (which is left to be resumed), as "<start date and
+    time> recovered". Returns the paths"""
+    def recover_sessions(self, keep=None):
+        paths = []
+        for session in self.interrupted_sessions():
+            if keep is not None and session.path == keep.path:
+                continue
+            name = time.strftime("%Y %m %d - %H_%M_%S", time.localtime(session.init_time)) + " recovered"
+            try:
+                path = session.finalize(name, self._printer)
+            except Exception as e:
+                self._printer("Could not recover the recording in " + session.path + ": " + str(e))
+                continue
+            self._printer("Recovered an interrupted recording to " + path)
+            paths.append(path)
+        return paths
+
+    """ Puts one Sample's readings into self.values and lays the store out as a row of self.labels. The columns of
+    other stations hold their last readings (NaN until they have one), so every row carries the whole setup"""
+    def sample_row(self, sample):
+        layout = self._layouts[sample.station]
+        if sample.rp100 is not None:
+            n = min(len(layout.rp100), len(sample.rp100))
+            self.values.update(layout.rp100[:n], sample.rp100[:n])
+            self.values.update(layout.rp100_time, np.nan if sample.rp100_ns is None else sample.rp100_ns)
+        if sample.keysight is not None:
+            n = min(len(layout.keysight), len(sample.keysight))
+            self.values.update(layout.keysight[:n], sample.keysight[:n])
+            self.values.update(layout.keysight_time, np.nan if sample.keysight_ns is None else sample.keysight_ns)
+        timestepvalues = self.values.row()
+        # an instrument of this station that was not read in this sample is recorded as 0, without a time
+        if sample.rp100 is None:
+            timestepvalues[layout.rp100] = 0
+            timestepvalues[layout.rp100_time] = np.nan
+        if sample.keysight is None:
+            timestepvalues[layout.keysight] = 0
+            timestepvalues[layout.keysight_time] = np.nan
+        #timestepvalues[12] = timestepvalues[12]*(10**12) #from F to pF
+        #timestepvalues[13] = timestepvalues[13]/(10**3) #changes from Ohm to kOhm
+        if self.init_time is None:
+            timestepvalues[self._time] = np.nan
+            timestepvalues[self._stamps] = np.nan
+        else:
+            timestepvalues[self._time] = (sample.time - self.init_time)
+            # each instrument's own stamp, on the perf_counter clock, in s since the recording started
+            timestepvalues[self._stamps] = (timestepvalues[self._stamps] - self.init_ns) / 1e9
+        timestepvalues[self._step] = sample.step if sample.step is not None else np.nan
+        timestepvalues[self._suppressed] = 0
+        return timestepvalues
+
+    """ Records rows, as laid out by poll() (or sample_row()), when recording. Returns the rows, including any the
+    deadband kept out of the file, or an empty list when not recording"""
+    def record(self, rows):
+        if not self.recording:
+            return []
+        for row in rows:
+            if self.deadband is None or self.deadband.accept(row):
+                self.record_writer.write(row)
+        return rows
+
+    """ Closes the recording and finalizes its session as name (default: the current date and time; "name (2)" if
+    the file exists). The results of any sweep steps taken while recording go next to it, in "<name> steps.csv".
+    Returns the new path"""
+    def stop_recording(self, name=None):
+        if self.deadband is not None:
+            row = self.deadband.flush()
+            if row is not None:
+                self.record_writer.write(row)
+            self._printer("Deadband kept " + str(self.deadband.kept) + " rows, suppressed " + str(self.deadband.suppressed))
+            self.deadband = None
+        self.record_writer.close()
+        profiler.detach(self.record_writer.sink, "write_rows")
+        self.record_writer = None
+        session, self.session = self.session, None
+        if name is None:
+            name = time.strftime("%Y %m %d - %H_%M_%S")
+        path = session.finalize(name, self._printer)
+        steps = [step for sequence in self._sequences for step in sequence.steps if step["started"] >= self.init_time]
+        if steps:
+            save_steps(os.path.splitext(path)[0] + " steps.csv", steps)
+        return path
+
+
+def main(argv=None):
+    """ Command line entry point: connect, record for a while (or until Ctrl+C), save"""
+    parser = argparse.ArgumentParser(description="Record a Razorbill RP100 and/or a Keysight E4980AL without the GUI.")
+    parser.add_argument("--rp100", metavar="PORT", action="append", help="serial device (e.g. COM3, /dev/ttyACM0) or USB serial number of the RP100 (repeat for the RP100 of each further station)")
+    parser.add_argument("--keysight", metavar="RESOURCE", action="append", help="VISA resource name of the E4980AL (repeat for the E4980AL of each further station)")
+    parser.add_argument("--stations", type=int, default=None, help="number of RP100 / E4980AL stations, each polled on its own thread (default: as many as --rp100 / --keysight give, with --simulate 1)")
+    parser.add_argument("--list", action="store_true", help="list the serial ports and USB instruments, then exit")
+    parser.add_argument("--export-csv", metavar="FILE.h5", help="convert an HDF5 recording to a CSV next to it, then exit")
+    parser.add_argument("--duration", type=float, default=None, help="seconds to record (default: until Ctrl+C)")
+    parser.add_argument("--format", choices=sorted(RECORD_FORMATS), default="CSV", help="recording format")
+    parser.add_argument("--output", metavar="NAME", default=None, help="file name without extension (default: date and time)")
+    parser.add_argument("--resume", action="store_true", help="carry on recording into the latest session a crashed run left behind, instead of starting a new file")
+    parser.add_argument("--period", type=float, default=0.01, help="seconds between acquisition cycles")
+    parser.add_argument("--buffered", action="store_true", help="use the E4980AL's data buffer instead of one fetch per cycle")
+    parser.add_argument("--ramp-down", action="store_true", help="ramp the RP100 outputs to 0 V and open the relays when done")
+    parser.add_argument("--verbose", action="store_true", help="log every I/O error and timeout")
+    parser.add_argument("--simulate", action="store_true", help="use the simulated instruments from karp_sim.py (the default --rp100/--keysight)")
+    parser.add_argument("--sweep", metavar="TARGETS", help='step the RP100 through target voltages, "0, 5, 10" or a ramp "0:50:5" ("0:50:5:back" to come back down); without --duration, recording stops when the sweep is done')
+    parser.add_argument("--channel", type=int, choices=(1, 2), default=1, help="RP100 channel to sweep")
+    parser.add_argument("--settle", choices=("target", "keysight"), default="target", help="settle each step until the output readback reaches the target, or until the Keysight readings are stable")
+    parser.add_argument("--tolerance", type=float, default=None, help="settle tolerance, V for target (default 0.01) or F for keysight (default 1e-15)")
+    parser.add_argument("--settle-count", type=int, default=10, help="Keysight readings that must agree, with --settle keysight")
+    parser.add_argument("--average", type=int, default=10, help="samples averaged at each sweep step")
+    parser.add_argument("--step-timeout", type=float, default=None, help="stop waiting for a step to settle after this many seconds")
+    parser.add_argument("--deadband", action="store_true", help="only record rows where a monitored channel changed past its deadband (see DEADBAND_DEFAULTS)")
+    parser.add_argument("--deadband-channel", action="append", default=[], metavar="LABEL=ABS[,REL]", help='deadband for one column, e.g. "Measured Voltage 1 (V)=0.005" (repeatable, implies --deadband)')
+    parser.add_argument("--heartbeat", type=float, default=10.0, metavar="SECONDS", help="with --deadband, record a row at least this often")
+    parser.add_argument("--stats", action="append", default=[], metavar="LABEL", help='keep running statistics and the Allan deviation of a column, e.g. "Primary Keysight Measurement", and print them when done (repeatable)')
+    parser.add_argument("--align", action="store_true", help="also save a copy with both instruments on a common time base")
+    parser.add_argument("--align-period", type=float, default=None, metavar="SECONDS", help="with --align, resample onto a uniform grid instead of the Keysight readings")
+    parser.add_argument("--profile", metavar="PATH", help="time the hot paths and write the profile to PATH when done")
+    parser.add_argument("--log", metavar="PATH", help="also write the log to PATH, rotated at 1 MB")
+    parser.add_argument("--async-io", action="store_true", help="talk to both instruments at once from an asyncio loop, each request with its own timeout")
+    args = parser.parse_args(argv)
+    if args.export_csv:
+        print("Exported " + args.export_csv + " to " + export_csv(args.export_csv))
+        return 0
+
+    stations = args.stations or max(len(args.rp100 or ()), len(args.keysight or ()), 1)
+    if args.simulate:
+        import karp_sim
+        karp_sim.install(engine=sys.modules[__name__], stations=stations)
+        if args.rp100 is None and args.keysight is None:
+            args.rp100 = [karp_sim.station_names(station)[0] for station in range(stations)]
+            args.keysight = [karp_sim.station_names(station)[1] for station in range(stations)]
+    if max(len(args.rp100 or ()), len(args.keysight or ())) > stations:
+        parser.error("more instruments than --stations")
+    startup = StartupTimer(_import_started)
+    startup.mark("imports")
+    log = LogBuffer(echo=print, path=args.log)
+    engine = KarpEngine(printer=log, print_io=args.verbose, period=args.period, async_io=args.async_io, stations=stations)
+    startup.mark("engine")
+    if args.profile:
+        profiler.enable()
+    if args.list:
+        for instrument in engine.discovery.refresh(force=True).result():
+            print("\t".join(str(field) for field in (instrument.name, instrument.description, instrument.idn or "")))
+        engine.close()
+        log.close()
+        return 0
+    if args.rp100 is None and args.keysight is None:
+        parser.error("nothing to record, give --rp100 and/or --keysight")
+    if args.sweep is not None and args.rp100 is None:
+        parser.error("--sweep needs the RP100, give --rp100")
+    resume = None
+    if args.resume:
+        sessions = engine.interrupted_sessions()
+        if not sessions:
+            parser.error("no interrupted recording in " + engine.session_root + " to resume")
+        resume = sessions[-1]
+        if resume.labels != engine.labels:
+            parser.error("the interrupted recording has other columns, give the --stations it was made with")
+    engine.recover_sessions(keep=resume)
+
+    attrs = {}
+    for station, port in enumerate(args.rp100 or ()):
+        attrs["rp100" + ("" if station == 0 else "_" + str(station + 1)) + "_idn"] = str(engine.connect_rp100(port, station))
+    for station, resource in enumerate(args.keysight or ()):
+        attrs["keysight" + ("" if station == 0 else "_" + str(station + 1)) + "_idn"] = str(engine.connect_keysight(resource, station))
+        if args.buffered:
+            engine.usb_ports[station].start_capture()
+    startup.mark("connect")
+    log(startup.report())
+    deadband = None
+    if args.deadband or args.deadband_channel:
+        deadbands = engine.registry.deadbands(DEADBAND_DEFAULTS)
+        for option in args.deadband_channel:
+            label, _, values = option.rpartition("=")
+            values = [float(value) for value in values.split(",")]
+            deadbands[label] = (values[0], values[1] if len(values) > 1 else 0.0)
+        try:
+            deadband = DeadbandFilter(deadbands, args.heartbeat, engine.labels)
+        except ValueError as e:
+            parser.error(str(e))
+    for label in args.stats:
+        if label not in engine.labels:
+            parser.error("no column called " + label)
+        engine.watch(label)
+    engine.start()
+    engine.start_recording(args.format, attrs, deadband=deadband, resume=resume)
+    if resume is not None:
+        log("Resuming the recording started " + resume.attrs.get("start_time", "earlier"))
+    sweep = None
+    if args.sweep is not None:
+        if args.settle == "target":
+            settle = TargetReached(0.01 if args.tolerance is None else args.tolerance)
+        else:
+            settle = KeysightStable(args.settle_count, 1e-15 if args.tolerance is None else args.tolerance)
+        sweep = engine.sweep(parse_targets(args.sweep), args.channel, [settle], average=args.average,
+                             timeout=args.step_timeout, on_step=lambda sequence: print(sequence.status()))
+    started = time.time()
+    last_report = started
+    rows = 0
+    try:
+        while (time.time() - started < args.duration) if args.duration is not None else (sweep is None or sweep.running):
+            time.sleep(0.1)
+            rows += len(engine.record(engine.poll().rows))
+            log.flush()
+            if time.time() - last_report >= 10:
+                last_report = time.time()
+                print(str(rows) + " rows recorded in " + str(round(last_report - started)) + " s")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        rows += len(engine.record(engine.poll().rows))
+        path = engine.stop_recording(args.output)
+        if deadband is not None:
+            print("Saved " + str(deadband.kept) + " of " + str(rows) + " rows to " + path)
+        else:
+            print("Saved " + str(rows) + " rows to " + path)
+        if args.align:
+            print("Saved the aligned copy to " + write_aligned(path, args.align_period))
+        for statistics in engine.statistics.values():
+            print(statistics.report())
+        if args.buffered:
+            for station in range(len(args.keysight or ())):
+                engine.usb_ports[station].stop_capture()
+        if args.ramp_down:
+            for station in range(len(args.rp100 or ())):
+                print("Ramping " + engine.registry.names(station)[0] + " down to 0 V")
+                engine.ramp_down(station)
+        engine.close()
+        log.close()
+        if args.profile:
+            profiler.dump(args.profile)
+            print("Profile written to " + args.profile)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
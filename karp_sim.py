@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""
+Simulated RP100 and E4980AL for KARP.
+"""
+
+""" In-process stand-ins for the Razorbill RP100 and the Keysight E4980AL, for testing and benchmarking KARP without """
+""" the hardware. install() registers them with karp_engine, after which they show up in the port lists and """
+""" MonitoredSerial / MonitoredUSB connect to them like to the real thing. Only the SCPI subset KARP uses is """
+""" implemented. Latency, noise and the RP100 slew-limited ramps are configurable. """
+
+import math
+import random
+import threading
+import time
+from collections import deque, namedtuple
+import numpy as np
+from serial.tools.list_ports_common import ListPortInfo
+import karp_engine
+
+SIM_RP100_DEVICE = "sim://rp100"
+SIM_E4980AL_RESOURCE = "USB0::0x2A8D::0x2F01::SIM00001::0::INSTR"
+
+
+def _draw_latency(device):
+    """ One round-trip latency for a simulated device: drawn from its recorded samples if it has any"""
+    if device.latency_samples:
+        return random.choice(device.latency_samples)
+    return device.latency + random.uniform(0, device.jitter)
+
+
+class _SimChannel:
+    """ One RP100 output: the voltage slews from where it was towards the target at the slew rate"""
+    def __init__(self):
+        self.relay = 0
+        self.target = 0.0
+        self.slew = 10.0
+        self._start_voltage = 0.0
+        self._start_time = time.monotonic()
+
+    def voltage(self, t=None):
+        if t is None:
+            t = time.monotonic()
+        distance = self.target - self._start_voltage
+        travelled = self.slew * max(0.0, t - self._start_time)
+        if abs(distance) <= travelled:
+            return self.target
+        return self._start_voltage + math.copysign(travelled, distance)
+
+    """ Re-anchors the ramp at the present voltage, call before changing target or slew"""
+    def _anchor(self):
+        now = time.monotonic()
+        self._start_voltage = self.voltage(now)
+        self._start_time = now
+
+    def set_target(self, value):
+        self._anchor()
+        self.target = value
+
+    def set_slew(self, value):
+        self._anchor()
+        self.slew = max(value, 1e-6)
+
+
+class SimulatedRP100:
+    """
+    A stand-in for the RP100 on its USB serial port, with the pyserial calls KARP uses (write, readline,
+    reset_input_buffer...). Each reply becomes readable `latency` seconds (plus up to `jitter`) after the command
+    that caused it was written, or after a latency drawn from `latency_samples` (e.g. recorded on real hardware)
+    when that is given; readline() gives up after `timeout` like the real port. Measured voltages get Gaussian
+    noise of `noise` volts, currents the charging current of `load_capacitance` plus `current_noise`.
+    """
+    def __init__(self, device=SIM_RP100_DEVICE, serial_number="SIMRP100", latency=0.002, jitter=0.0005, noise=0.001,
+                 load_capacitance=1e-6, current_noise=1e-9, latency_samples=None):
+        self.name = device
+        self.port = device
+        self.timeout = 0.1
+        self.is_open = False
+        self.latency = latency
+        self.jitter = jitter
+        self.latency_samples = latency_samples
+        self.noise = noise
+        self.load_capacitance = load_capacitance
+        self.current_noise = current_noise
+        self.channels = {1: _SimChannel(), 2: _SimChannel()}
+        self.errors = deque()
+        self._replies = deque()
+        self._lock = threading.Lock()
+        self.port_info = ListPortInfo(device)
+        self.port_info.description = "Simulated RP100"
+        self.port_info.serial_number = serial_number
+        self.port_info.vid = 0x1209
+        self.port_info.pid = 0x0100
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+        self.reset_input_buffer()
+
+    def reset_input_buffer(self):
+        with self._lock:
+            self._replies.clear()
+
+    def write(self, data):
+        if not self.is_open:
+            raise IOError("Simulated RP100 port is closed")
+        for line in data.decode().split("\n"):
+            if line.strip():
+                reply = self.execute(line.strip())
+                if reply is not None:
+                    self._queue_reply(reply)
+        return len(data)
+
+    def _queue_reply(self, reply):
+        with self._lock:
+            ready = time.monotonic() + _draw_latency(self)
+            if self._replies:
+                ready = max(ready, self._replies[-1][0])
+            self._replies.append((ready, (reply + "\n").encode()))
+
+    def readline(self):
+        deadline = time.monotonic() + (self.timeout or 0)
+        with self._lock:
+            ready = self._replies[0][0] if self._replies else None
+        if ready is None or ready > deadline:
+            time.sleep(max(0.0, deadline - time.monotonic()))
+            return b""
+        time.sleep(max(0.0, ready - time.monotonic()))
+        with self._lock:
+            return self._replies.popleft()[1]
+
+    """ Runs one SCPI command and returns the reply text, or None if it does not reply"""
+    def execute(self, command):
+        header, _, argument = command.partition(" ")
+        header = header.upper()
+        query = header.endswith("?")
+        header = header.rstrip("?")
+        if header == "*IDN":
+            return "Razorbill Instruments,RP100,SIM0001,1.0"
+        if header == "SYST:ERR":
+            return self.errors.popleft() if self.errors else '0,"No error"'
+        for prefix in ("OUTP", "SOUR", "MEAS"):
+            if header.startswith(prefix) and header[len(prefix):len(prefix) + 1] in ("1", "2"):
+                channel = self.channels[int(header[len(prefix)])]
+                field = prefix + header[len(prefix) + 1:]
+                return self._channel_command(channel, field, query, argument)
+        self.errors.append('-113,"Undefined header"')
+        return None
+
+    def _channel_command(self, channel, field, query, argument):
+        if query:
+            if field == "OUTP":
+                return str(channel.relay)
+            if field == "SOUR:VOLT":
+                return "%.6f" % channel.target
+            if field == "SOUR:VOLT:SLEW":
+                return "%.6f" % channel.slew
+            if field == "SOUR:VOLT:NOW":
+                return "%.6f" % channel.voltage()
+            if field == "MEAS:VOLT":
+                voltage = channel.voltage() if channel.relay else 0.0
+                return "%.6f" % (voltage + random.gauss(0, self.noise))
+            if field == "MEAS:CURR":
+                ramping = channel.relay and abs(channel.voltage() - channel.target) > 1e-9
+                current = math.copysign(channel.slew * self.load_capacitance, channel.target - channel.voltage()) if ramping else 0.0
+                return "%.6E" % (current + random.gauss(0, self.current_noise))
+        else:
+            try:
+                value = float(argument)
+            except ValueError:
+                self.errors.append('-104,"Data type error"')
+                return None
+            if field == "OUTP":
+                channel.relay = int(value)
+                return None
+            if field == "SOUR:VOLT":
+                channel.set_target(value)
+                return None
+            if field == "SOUR:VOLT:SLEW":
+                channel.set_slew(value)
+                return None
+        self.errors.append('-113,"Undefined header"')
+        return None
+
+
+SimResourceInfo = namedtuple("SimResourceInfo", ["alias", "resource_name"])
+
+
+class SimulatedE4980AL:
+    """
+    A stand-in for a pyvisa session to the E4980AL, with the calls KARP uses (write, read, query,
+    query_binary_values, read_stb...). Every call takes `latency` seconds (plus up to `jitter`), or a latency drawn
+    from `latency_samples` when that is given. Readings are taken every
+    `measurement_time` seconds; the capacitance follows the channel 1 output of `rp100` (if given) as
+    capacitance + dc_dv * V, with Gaussian noise, to mimic a strain cell. The data buffer (:MEM:...) fills in the
+    background under internal triggering, or one reading per *TRG under bus triggering.
+    """
+    def __init__(self, resource_name=SIM_E4980AL_RESOURCE, rp100=None, latency=0.003, jitter=0.0, measurement_time=0.005,
+                 capacitance=1e-12, dc_dv=1e-15, resistance=50e3, noise=1e-15, latency_samples=None):
+        self.resource_info = SimResourceInfo(None, resource_name)
+        self.timeout = 2000
+        self.rp100 = rp100
+        self.latency = latency
+        self.jitter = jitter
+        self.latency_samples = latency_samples
+        self.measurement_time = measurement_time
+        self.capacitance = capacitance
+        self.dc_dv = dc_dv
+        self.resistance = resistance
+        self.noise = noise
+        self.trigger_source = "INT"
+        self.buffer_size = 0
+        self.buffer = []
+        self._filling = False
+        self._fill_start = None
+        self._output = deque()
+
+    def close(self):
+        pass
+
+    def read_stb(self):
+        return 0
+
+    def _reading(self, t=None):
+        voltage = 0.0
+        if self.rp100 is not None:
+            voltage = self.rp100.channels[1].voltage(t)
+        capacitance = self.capacitance + self.dc_dv * voltage + random.gauss(0, self.noise)
+        resistance = self.resistance * (1 + random.gauss(0, 1e-4))
+        return (capacitance, resistance, 0.0)
+
+    """ Under internal triggering, adds the readings taken since the buffer started filling"""
+    def _fill(self):
+        if not self._filling or self.trigger_source != "INT":
+            return
+        now = time.monotonic()
+        taken = int((now - self._fill_start) / self.measurement_time)
+        while len(self.buffer) < min(taken, self.buffer_size):
+            t = self._fill_start + (len(self.buffer) + 1) * self.measurement_time
+            self.buffer.append(self._reading(t) + (0.0,))
+
+    def _buffer_values(self):
+        self._fill()
+        values = []
+        for i in range(self.buffer_size):
+            if i < len(self.buffer):
+                values.extend(self.buffer[i])
+            else:
+                values.extend((9.9e37, 9.9e37, -1.0, 0.0))
+        return values
+
+    def write(self, message):
+        time.sleep(_draw_latency(self))
+        header, _, argument = message.strip().partition(" ")
+        header = header.upper()
+        if header == "*IDN?":
+            self._output.append("Keysight Technologies,E4980AL,SIM00001,A.01.00")
+        elif header in (":FETCH:IMPEDANCE:FORMATTED?", ":FETC:IMP:FORM?", ":FETCH?", ":FETC?"):
+            time.sleep(self.measurement_time)
+            reading = self._reading()
+            self._output.append("%+.6E,%+.6E,%+d" % (reading[0], reading[1], 0))
+        elif header in (":TRIG:SOUR", ":TRIGGER:SOURCE"):
+            self.trigger_source = argument.strip().upper()[:3]
+        elif header in (":MEM:DIM", ":MEMORY:DIMENSION"):
+            self.buffer_size = min(201, int(argument.split(",")[-1]))
+        elif header in (":MEM:CLE", ":MEMORY:CLEAR"):
+            self.buffer = []
+            self._filling = False
+        elif header in (":MEM:FILL", ":MEMORY:FILL"):
+            self._filling = True
+            self._fill_start = time.monotonic()
+        elif header in ("*TRG", ":TRIG", ":TRIGGER"):
+            if self._filling and self.trigger_source == "BUS" and len(self.buffer) < self.buffer_size:
+                self.buffer.append(self._reading() + (0.0,))
+        elif header in (":MEM:READ?", ":MEMORY:READ?"):
+            self._output.append(",".join("%+.6E" % value for value in self._buffer_values()))
+        return len(message)
+
+    def read(self):
+        time.sleep(_draw_latency(self))
+        if not self._output:
+            raise IOError("VI_ERROR_TMO (-1073807339): Timeout expired before operation completed.")
+        return self._output.popleft() + "\n"
+
+    def query(self, message):
+        self.write(message)
+        return self.read()
+
+    def query_ascii_values(self, message, container=list):
+        return container([float(value) for value in self.query(message).strip().split(",")])
+
+    def query_binary_values(self, message, datatype="d", is_big_endian=False, container=list):
+        self.write(message)
+        time.sleep(_draw_latency(self))
+        return container(np.array([float(value) for value in self._output.popleft().split(",")]))
+
+
+def station_names(station):
+    """ (RP100 device, E4980AL resource) of the simulated pair of a station; station 0's are SIM_RP100_DEVICE and
+    SIM_E4980AL_RESOURCE"""
+    if station == 0:
+        return SIM_RP100_DEVICE, SIM_E4980AL_RESOURCE
+    return SIM_RP100_DEVICE + "-" + str(station + 1), SIM_E4980AL_RESOURCE.replace("SIM00001", "SIM%05d" % (station + 1))
+
+
+def install(rp100_options=None, keysight_options=None, engine=None, stations=1):
+    """
+    Creates a simulated RP100 and E4980AL and registers them with karp_engine (or with `engine`, e.g. when
+    karp_engine is running as __main__), under SIM_RP100_DEVICE and SIM_E4980AL_RESOURCE. The E4980AL's
+    capacitance follows the RP100's channel 1. Returns both. With stations > 1 a pair is registered for each
+    station, under the names from station_names(); the first pair is returned.
+    """
+    if engine is None:
+        engine = karp_engine
+    pairs = []
+    for station in range(stations):
+        device, resource = station_names(station)
+        rp100 = SimulatedRP100(device=device, serial_number="SIMRP100" + ("" if station == 0 else "-" + str(station + 1)),
+                               **(rp100_options or {}))
+        keysight = SimulatedE4980AL(resource_name=resource, rp100=rp100, **(keysight_options or {}))
+        engine.simulated_serial[rp100.name] = rp100
+        engine.simulated_visa[keysight.resource_info.resource_name] = keysight
+        pairs.append((rp100, keysight))
+    return pairs[0]